@@ -1,5 +1,80 @@
+import uuid
+
+from django.conf import settings
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+
+# The user loaded for each request is kept in the cache until the user row changes, this long at most
+USER_SNAPSHOT_TIMEOUT = 10 * 60
+# Never cached, the password hash is loaded from the row only when something reads it
+USER_SNAPSHOT_EXCLUDE = ('password',)
+
+
+def user_snapshot_keys(user_id):
+    return 'user-version:%s' % user_id, 'user-snapshot:%s' % user_id
+
+
+def _snapshot(user):
+    fields = [field.attname for field in user._meta.concrete_fields if field.attname not in USER_SNAPSHOT_EXCLUDE]
+    return {
+        'fields': fields,
+        'values': [getattr(user, attname) for attname in fields],
+        # What django.contrib.auth compares with the session, an HMAC of the password hash
+        'session_auth_hash': user.get_session_auth_hash(),
+    }
+
+
+def _restore(snapshot):
+    UserModel = get_user_model()
+    user = UserModel.from_db(UserModel._default_manager.db, snapshot['fields'], snapshot['values'])
+    user._session_auth_hash = snapshot['session_auth_hash']
+    return user
+
+
+def get_user_snapshot(user_id):
+    """
+    Returns the user rebuilt from its cached snapshot, loading it from the database only after
+    the user's version changed. The snapshot holds the non-secret fields and the session auth
+    hash, the password stays deferred. Without a shared cache another worker's save could not
+    reach this worker's version, so the row is read every time. Returns None for a user that
+    does not exist.
+    """
+    UserModel = get_user_model()
+    if not settings.SHARED_CACHE:
+        return UserModel._default_manager.filter(pk=user_id).first()
+
+    version_key, snapshot_key = user_snapshot_keys(user_id)
+    cached = cache.get_many([version_key, snapshot_key])
+    version = cached.get(version_key)
+    if version is None:
+        cache.add(version_key, uuid.uuid4().hex, None)
+        version = cache.get(version_key)
+
+    snapshot = cached.get(snapshot_key)
+    if snapshot is not None and snapshot['version'] == version:
+        return _restore(snapshot)
+
+    user = UserModel._default_manager.filter(pk=user_id).first()
+    if user is None:
+        return None
+    # Stored under the version read before the load, a save landing meanwhile still invalidates it
+    cache.set(snapshot_key, dict(_snapshot(user), version=version), USER_SNAPSHOT_TIMEOUT)
+    return user
+
+
+def invalidate_user_snapshot(user_id):
+    """
+    Gives the user a new version, now and again on commit, so no request keeps a snapshot of the old row.
+    """
+    version_key, _ = user_snapshot_keys(user_id)
+
+    def bump():
+        cache.set(version_key, uuid.uuid4().hex, None)
+    bump()
+    transaction.on_commit(bump)
+
 
 class EmailBackend(ModelBackend):
     def authenticate(self, request, email=None, password=None, **kwargs):
@@ -13,4 +88,9 @@ class EmailBackend(ModelBackend):
 
         if user.check_password(password) and self.user_can_authenticate(user):
             return user
-            
+
+    def get_user(self, user_id):
+        # Called on every authenticated request, the session hash is still checked against the
+        # snapshot's by django.contrib.auth, so a password change logs other sessions out
+        user = get_user_snapshot(user_id)
+        return user if user is not None and self.user_can_authenticate(user) else None
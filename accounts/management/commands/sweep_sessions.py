@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from ...sessions import SESSION_SWEEP_BATCH, SESSION_SWEEP_PAUSE, SessionStore
+
+class Command(BaseCommand):
+    help = "Delete expired sessions in small batches, pausing between them so the table stays available"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=SESSION_SWEEP_BATCH)
+        parser.add_argument('--pause', type=float, default=SESSION_SWEEP_PAUSE, help="Seconds to wait between batches")
+
+    def handle(self, *args, **kwargs):
+        deleted = SessionStore.clear_expired(batch_size=kwargs['batch_size'], pause=kwargs['pause'])
+        print("deleted " + str(deleted) + " expired sessions")
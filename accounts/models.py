@@ -1,4 +1,3 @@
-import os
 from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 
@@ -38,16 +37,14 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
 
     objects = CustomUserManager()
 
-    def delete(self, *args, **kwargs):
-        # Remove the associated image file from the file system
-        if self.profile_picture:
-            if os.path.isfile(self.profile_picture.path):
-                os.remove(self.profile_picture.path)
-        
-        super(CustomUser, self).delete(*args, **kwargs)
-
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['first_name', 'last_name']
+
+    def get_session_auth_hash(self):
+        # Users rebuilt from their cached snapshot (accounts.backends) carry the hash, not the password
+        if getattr(self, '_session_auth_hash', None) and 'password' in self.get_deferred_fields():
+            return self._session_auth_hash
+        return super(CustomUser, self).get_session_auth_hash()
     
     def __str__(self):
         return self.email
\ No newline at end of file
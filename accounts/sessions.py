@@ -0,0 +1,138 @@
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from django.core.cache import cache
+from django.utils import timezone
+
+
+SESSION_VERSION_PREFIX = 'session-version:'
+# Sessions kept decoded per worker, the least recently used one goes first
+SESSION_LRU_SIZE = 10000
+# An unchanged session is written again only once its expiry moved this far (seconds)
+SESSION_WRITE_COALESCE = 5 * 60
+# Expired sessions are deleted this many rows at a time, pausing between batches (seconds)
+SESSION_SWEEP_BATCH = 1000
+SESSION_SWEEP_PAUSE = 0.1
+
+# The serialized session, so a hit skips the signature check and decompression of session_data
+CachedSession = namedtuple('CachedSession', ['version', 'payload', 'digest', 'expire_date'])
+
+_lock = threading.Lock()
+_sessions = OrderedDict()
+
+
+def _lru_get(session_key):
+    with _lock:
+        entry = _sessions.get(session_key)
+        if entry is not None:
+            _sessions.move_to_end(session_key)
+        return entry
+
+
+def _lru_set(session_key, entry):
+    with _lock:
+        _sessions[session_key] = entry
+        _sessions.move_to_end(session_key)
+        while len(_sessions) > SESSION_LRU_SIZE:
+            _sessions.popitem(last=False)
+
+
+def _lru_delete(session_key):
+    with _lock:
+        _sessions.pop(session_key, None)
+
+
+class SessionStore(DBStore):
+    """
+    Database sessions with a per-worker LRU in front. Every write gives the session a new
+    version in the shared cache, and a worker trusts its copy only while the versions match,
+    so a request never sees a session older than the last write from any worker. Without a
+    shared cache (settings.SHARED_CACHE) every load reads the row. Saving a session whose data
+    did not change is skipped until its expiry has moved far enough.
+    """
+    def __init__(self, session_key=None):
+        super(SessionStore, self).__init__(session_key)
+        self._loaded_digest = None
+        self._loaded_expire_date = None
+
+    def _version_key(self, session_key):
+        return SESSION_VERSION_PREFIX + session_key
+
+    def load(self):
+        session_key = self.session_key
+        # Read before the database, a write landing meanwhile leaves the copy below outdated.
+        # Only a shared cache proves no other worker wrote since, a missing version proves nothing.
+        version = cache.get(self._version_key(session_key)) if settings.SHARED_CACHE else None
+        entry = _lru_get(session_key) if version is not None else None
+        if entry is not None and entry.version == version and entry.expire_date > timezone.now():
+            self._loaded_digest = entry.digest
+            self._loaded_expire_date = entry.expire_date
+            return self.serializer().loads(entry.payload)
+
+        s = self._get_session_from_db()
+        if s is None:
+            _lru_delete(session_key)
+            return {}
+        data = self.decode(s.session_data)
+        # Kept only under a version, the next write gives the session one
+        self._remember(session_key, version, data, s.expire_date)
+        return data
+
+    def _remember(self, session_key, version, data, expire_date):
+        payload = self.serializer().dumps(data)
+        digest = hashlib.md5(payload).hexdigest()
+        if version is not None:
+            _lru_set(session_key, CachedSession(version, payload, digest, expire_date))
+        else:
+            _lru_delete(session_key)
+        self._loaded_digest = digest
+        self._loaded_expire_date = expire_date
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        data = self._get_session(no_load=must_create)
+        expire_date = self.get_expiry_date()
+        if not must_create and self._loaded_digest is not None:
+            unchanged = hashlib.md5(self.serializer().dumps(data)).hexdigest() == self._loaded_digest
+            if unchanged and expire_date - self._loaded_expire_date < timedelta(seconds=SESSION_WRITE_COALESCE):
+                return
+
+        super(SessionStore, self).save(must_create=must_create)
+        version = None
+        if settings.SHARED_CACHE:
+            version = uuid.uuid4().hex
+            cache.set(self._version_key(self.session_key), version, self.get_expiry_age())
+        self._remember(self.session_key, version, data, expire_date)
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            session_key = self.session_key
+        super(SessionStore, self).delete(session_key)
+        if session_key is not None:
+            cache.delete(self._version_key(session_key))
+            _lru_delete(session_key)
+
+    @classmethod
+    def clear_expired(cls, batch_size=SESSION_SWEEP_BATCH, pause=SESSION_SWEEP_PAUSE):
+        """
+        Deletes the expired sessions a batch of primary keys at a time, so no statement holds
+        more than a batch of row locks. Returns the number of sessions deleted.
+        """
+        model = cls.get_model_class()
+        deleted = 0
+        while True:
+            session_keys = list(model.objects.filter(expire_date__lt=timezone.now()).values_list('session_key', flat=True)[:batch_size])
+            if not session_keys:
+                break
+            deleted += model.objects.filter(session_key__in=session_keys).delete()[0]
+            if len(session_keys) < batch_size:
+                break
+            time.sleep(pause)
+        return deleted
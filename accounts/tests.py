@@ -1,3 +1,139 @@
-from django.test import TestCase
+from datetime import timedelta
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import sessions
+from .backends import EmailBackend, get_user_snapshot, user_snapshot_keys
+from .models import CustomUser
+from .sessions import SessionStore
+
+
+@override_settings(SHARED_CACHE=True)
+class SessionStoreTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        sessions._sessions.clear()
+
+    def create_session(self):
+        store = SessionStore()
+        store['cart'] = [1, 2]
+        store.save(must_create=True)
+        return store.session_key
+
+    def test_copy_is_used_while_version_matches(self):
+        session_key = self.create_session()
+        self.assertEqual(SessionStore(session_key)['cart'], [1, 2])
+        with self.assertNumQueries(0):
+            self.assertEqual(SessionStore(session_key)['cart'], [1, 2])
+
+    def test_write_on_another_worker_is_seen(self):
+        session_key = self.create_session()
+        SessionStore(session_key).load()
+        stale = sessions._sessions[session_key]
+
+        store = SessionStore(session_key)
+        store['cart'] = [3]
+        store.save()
+        # This worker still holds the copy it loaded before the other worker's write
+        sessions._lru_set(session_key, stale)
+        self.assertEqual(SessionStore(session_key)['cart'], [3])
+
+    def test_deleted_session_is_not_served_by_another_worker(self):
+        session_key = self.create_session()
+        SessionStore(session_key).load()
+        stale = sessions._sessions[session_key]
+
+        SessionStore(session_key).delete()
+        sessions._lru_set(session_key, stale)
+        self.assertEqual(SessionStore(session_key).load(), {})
+
+    def test_missing_version_reads_the_row(self):
+        session_key = self.create_session()
+        SessionStore(session_key).load()
+        cache.delete(sessions.SESSION_VERSION_PREFIX + session_key)
+        Session.objects.filter(session_key=session_key).delete()
+        self.assertEqual(SessionStore(session_key).load(), {})
+
+    @override_settings(SHARED_CACHE=False)
+    def test_private_cache_always_reads_the_row(self):
+        session_key = self.create_session()
+        self.assertNotIn(session_key, sessions._sessions)
+        Session.objects.filter(session_key=session_key).delete()
+        self.assertEqual(SessionStore(session_key).load(), {})
+
+    def test_unchanged_session_write_is_coalesced(self):
+        session_key = self.create_session()
+        store = SessionStore(session_key)
+        store.load()
+        with self.assertNumQueries(0):
+            store.save()
+
+    def test_clear_expired_deletes_in_batches(self):
+        past = timezone.now() - timedelta(days=1)
+        Session.objects.bulk_create([Session(session_key='expired%03d' % i, session_data='', expire_date=past) for i in range(25)])
+        live = self.create_session()
+        self.assertEqual(SessionStore.clear_expired(batch_size=10, pause=0), 25)
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), [live])
+
+
+# Pages render without collectstatic
+PLAIN_STORAGES = dict(settings.STORAGES, staticfiles={'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'})
+
+
+@override_settings(SHARED_CACHE=True, STORAGES=PLAIN_STORAGES)
+class UserSnapshotTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user('seller@example.com', 'secret', first_name='a', last_name='b', user_type='seller')
+
+    def test_snapshot_holds_no_password(self):
+        get_user_snapshot(self.user.pk)
+        snapshot = cache.get(user_snapshot_keys(self.user.pk)[1])
+        self.assertNotIn('password', snapshot['fields'])
+        self.assertNotIn(self.user.password, snapshot['values'])
+
+    def test_snapshot_is_served_without_queries(self):
+        get_user_snapshot(self.user.pk)
+        with self.assertNumQueries(0):
+            user = EmailBackend().get_user(self.user.pk)
+        self.assertEqual(user.email, 'seller@example.com')
+        self.assertEqual(user.get_session_auth_hash(), self.user.get_session_auth_hash())
+
+    def test_password_change_logs_other_sessions_out(self):
+        client = Client()
+        client.force_login(self.user)
+        self.assertEqual(client.get(reverse('dashboard')).status_code, 200)
+
+        user = CustomUser.objects.get(pk=self.user.pk)
+        user.set_password('changed')
+        user.save()
+        response = client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_deactivated_user_is_refused(self):
+        get_user_snapshot(self.user.pk)
+        CustomUser.objects.filter(pk=self.user.pk).update(is_active=False)
+        # A queryset update sends no signal, the snapshot only goes once the row is saved
+        user = CustomUser.objects.get(pk=self.user.pk)
+        user.save()
+        self.assertIsNone(EmailBackend().get_user(self.user.pk))
+
+    def test_saving_a_restored_user_keeps_the_password(self):
+        get_user_snapshot(self.user.pk)
+        user = get_user_snapshot(self.user.pk)
+        user.first_name = 'c'
+        user.save()
+        user = CustomUser.objects.get(pk=self.user.pk)
+        self.assertEqual(user.first_name, 'c')
+        self.assertTrue(user.check_password('secret'))
+
+    @override_settings(SHARED_CACHE=False)
+    def test_private_cache_reads_the_row(self):
+        get_user_snapshot(self.user.pk)
+        with self.assertNumQueries(1):
+            get_user_snapshot(self.user.pk)
@@ -1,3 +1,62 @@
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
-# Create your tests here.
+from accounts.models import CustomUser
+from products.models import Code, Product
+from customer_site.tests import PLAIN_STORAGES
+from products.tests import CatalogMixin
+
+
+class ProductVariantsTests(CatalogMixin, TestCase):
+    def setUp(self):
+        super(ProductVariantsTests, self).setUp()
+        self.code = Code.objects.create(name='SHIRT')
+        self.client.force_login(self.seller)
+
+    def get(self, pk):
+        return self.client.get(reverse('product-variants', args=[pk]))
+
+    def test_only_the_sellers_own_variants_are_listed(self):
+        self.add_product(name='Red shirt', code=self.code)
+        other = self.add_product(name='Blue shirt', code=self.code)
+        Product.objects.filter(pk=other.pk).update(seller=CustomUser.objects.create_user('other@example.com', 'secret', first_name='c', last_name='d', user_type='seller'))
+
+        response = self.get(self.code.pk)
+        self.assertContains(response, 'Red shirt')
+        self.assertNotContains(response, 'Blue shirt')
+
+    def test_queries_do_not_grow_with_the_variants(self):
+        self.add_product(code=self.code)
+        # The session, the user and the active discounts are cached by the first request
+        self.get(self.code.pk)
+        with CaptureQueriesContext(connection) as one:
+            self.get(self.code.pk)
+        for _ in range(3):
+            self.add_product(code=self.code)
+        with CaptureQueriesContext(connection) as four:
+            response = self.get(self.code.pk)
+        self.assertEqual(response.content.count(b'name="content-SHIRT"'), 4)
+        self.assertEqual(len(four), len(one))
+
+    def test_unknown_code_and_other_users(self):
+        self.assertEqual(self.get(self.code.pk + 1).status_code, 404)
+        self.client.force_login(CustomUser.objects.create_user('customer@example.com', 'secret', first_name='e', last_name='f'))
+        self.assertRedirects(self.get(self.code.pk), reverse('admin-login'), fetch_redirect_response=False)
+
+
+@override_settings(STORAGES=PLAIN_STORAGES)
+class ProductTableTests(CatalogMixin, TestCase):
+    def test_one_row_per_code_five_to_a_page(self):
+        for number in range(7):
+            code = Code.objects.create(name='CODE-%d' % number)
+            for name in ('Shirt', 'Polo'):
+                self.add_product(name=name, code=code)
+        self.client.force_login(self.seller)
+
+        response = self.client.get(reverse('products'))
+        self.assertEqual(response.content.count(b'data-variants-url'), 5)
+        self.assertContains(response, 'Showing 1 to 5 of 7 entries')
+        response = self.client.get(reverse('products'), {'page': 2})
+        self.assertEqual([stock.code.name for stock in response.context['page_obj']], ['CODE-5', 'CODE-6'])
@@ -15,6 +15,7 @@ urlpatterns = [
 
     # Products URLs
     path('products/', views.products, name="products"),
+    path('product-variants/<str:pk>/', views.productVariants, name="product-variants"),
     path('add-product/', views.addProduct, name="add-product"),
     path('add-product-code/<str:pk>/', views.addProductCode, name="add-product-code"),
     path('edit-product/<str:pk>/', views.editProduct, name="edit-product"),
@@ -24,6 +25,11 @@ urlpatterns = [
     path('update-activation/<str:pk>/', views.updateActivation, name="update-activation"),
     path('update-dicount-product/<str:pk>/<str:discountPk>/', views.updateProductDiscount, name="update-discount-product"),
 
+    # Chunked image uploads
+    path('uploads/', views.startUpload, name="start-upload"),
+    path('uploads/<uuid:pk>/', views.uploadStatus, name="upload-status"),
+    path('uploads/<uuid:pk>/chunk/', views.uploadChunk, name="upload-chunk"),
+
     # Discounts URLs
     path('discounts/', views.discounts, name="discounts"),
     path('add-discount/', views.addDiscount, name="add-discount"),
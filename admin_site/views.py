@@ -1,4 +1,3 @@
-from django.core.paginator import Paginator
 from django.shortcuts import get_object_or_404, render, redirect
 from django.http import JsonResponse
 from django.utils.html import escape
@@ -6,10 +5,15 @@ from django.contrib import messages
 from accounts.models import CustomUser
 from accounts.forms import CustomUserForm, CustomAuthenticationForm, CustomPasswordChangeForm, CustomUpdateUserForm
 from accounts.decorators import seller_required
-from products.models import Code, Color, Product, Discount, Size, Stock
+from products.models import Code, Product, Discount, Stock
+from products.caching import PRODUCTS_TAG
 from products.forms import ProductForm, DiscountForm, StockForm
+from products.pagination import CachedCountPaginator
+from products.reference import get_reference_data
+from products.uploads import UPLOAD_MAX_SIZE, UploadError, append_chunk, completed_upload, get_upload, start_upload, upload_state
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse
+from django.views.decorators.http import require_GET, require_POST
 import json
 from django.contrib.auth import login, logout, update_session_auth_hash
 from django.utils.translation import gettext_lazy as _
@@ -108,58 +112,37 @@ def products(request):
     user = request.user
     page = "products"
     products = Product.objects.filter(seller=user)
-    stocks = Stock.objects.filter(product__seller=user)
+    stocks = Stock.objects.filter(product__seller=user).select_related('product__discount', 'color', 'size', 'code__summary')
 
-    codes = Code.objects.all()
-
-    total_quantities = {}
-    prices = {}
-    all_active = {}
-
-    # Calculate data by the code of the product
-    for code in codes:
-        # Calculate total quantity for each product by its code value
-        total_quantity = Stock.calculate_total_quantity(code_value=code)
-        total_quantities[code] = total_quantity
-
-        # Calculate min and max price for each product by its code value
-        min_price, max_price = Stock.get_price_range(code_value=code)
-        prices[code] = {'min_price': min_price, 'max_price': max_price}
-
-        # Check if all is active for each product by its code value
-        is_active = Stock.check_all_active(code_value=code)
-        all_active[code] = is_active
-
-
-    
-
-    # Filtering the products objects by the code value with no repeat
-    unique_values = set()
-    filtered_stocks = []
-    for obj in stocks:
-
-        if obj.code not in unique_values:
-            filtered_stocks.append(obj)
-            unique_values.add(obj.code)
-
-    
-    paginator = Paginator(filtered_stocks, 5)
+    # One row per code, grouped and paginated by the database
+    paginator = CachedCountPaginator(stocks.representatives(), 5, count_tags=[PRODUCTS_TAG])
     page_number = request.GET.get('page')
     page_obj = paginator.get_page(page_number)
 
-    discounts = Discount.objects.filter(active=True)
-    context = {'products': products, 'discounts': discounts, 'page': page, 'user': user, 'filtered_stocks': filtered_stocks, 'stocks': stocks, 'total_quantities': total_quantities, 'prices': prices, 'all_active': all_active, 'page_obj': page_obj}
+    context = {'products': products, 'page': page, 'user': user, 'page_obj': page_obj}
     return render(request, 'admin_site/products.html', context)
 
+# Variants of a product code, loaded when its row is expanded
+@login_required(login_url='admin-login')
+@seller_required(redirect_url='admin-login')
+def productVariants(request, pk):
+    code = get_object_or_404(Code, id=pk)
+    stocks = Stock.objects.filter(code=code, product__seller=request.user).select_related('product__discount', 'code', 'color', 'size')
+
+    discounts = get_reference_data().active_discounts
+    context = {'code': code, 'stocks': stocks, 'discounts': discounts}
+    return render(request, 'admin_site/product_variants.html', context)
+
 # Add products
 @login_required(login_url='admin-login')
 @seller_required(redirect_url='admin-login')
 def addProduct(request):
     form = ProductForm()
     stockForm = StockForm()
-    sizes = Size.objects.all()
-    colors = Color.objects.all()
-    codes = Code.objects.all()
+    reference = get_reference_data()
+    sizes = reference.sizes
+    colors = reference.colors
+    codes = reference.codes
     codeId = None
 
     if request.method == 'POST':
@@ -173,13 +156,16 @@ def addProduct(request):
             product = form.save()
             product.SKU = str(product.id) + '-'+ str(request.user.id)
             product.seller = request.user
+            thumbUpload = completed_upload(request.user, request.POST.get('thumb-upload'))
+            if thumbUpload:
+                product.thumb = thumbUpload
             product.save()
 
             stock = stockForm.save(commit=False)
             stock.product = product
-            stock.size = Size.objects.get(id=request.POST.get('size'))
-            stock.color = Color.objects.get(id=request.POST.get('color'))
-            stock.code = codeId if codeId is not None else Code.objects.get(id=request.POST.get('code'))
+            stock.size = reference.size(request.POST.get('size'))
+            stock.color = reference.color(request.POST.get('color'))
+            stock.code = codeId if codeId is not None else reference.code(request.POST.get('code'))
             stock.save()    
             print('done!')
             messages.success(request, 'Product Added Successfully!')
@@ -187,7 +173,7 @@ def addProduct(request):
         else:
             print(form.errors)
     
-    context = {'form': form, 'stockForm': stockForm, 'sizes': sizes, 'colors': colors, 'codes': codes}
+    context = {'form': form, 'stockForm': stockForm, 'sizes': sizes, 'colors': colors, 'codes': codes, 'uploadMaxSize': UPLOAD_MAX_SIZE}
     return render(request, 'admin_site/add_edit_product.html', context)
 
 # Add different size of the same product
@@ -198,11 +184,12 @@ def addProductCode(request, pk):
     stock = Stock.objects.get(product=product)
     form = ProductForm(instance=product)
     stockForm = StockForm()
-    currentCode = Code.objects.get(stock=stock)
+    reference = get_reference_data()
+    currentCode = reference.code(stock.code_id)
     currentImage = product.thumb
-    sizes = Size.objects.all()
-    colors = Color.objects.all()
-    codes = Code.objects.all()
+    sizes = reference.sizes
+    colors = reference.colors
+    codes = reference.codes
 
     if request.method == 'POST':
         form = ProductForm(request.POST, request.FILES)
@@ -216,8 +203,8 @@ def addProductCode(request, pk):
 
             stock = stockForm.save(commit=False)
             stock.product = product
-            stock.size = Size.objects.get(id=request.POST.get('size'))
-            stock.color = Color.objects.get(id=request.POST.get('color'))
+            stock.size = reference.size(request.POST.get('size'))
+            stock.color = reference.color(request.POST.get('color'))
             stock.code = currentCode
             stock.save()    
             print('done!')
@@ -237,10 +224,11 @@ def editProduct(request, pk):
     stock = Stock.objects.get(product=product)
     form = ProductForm(instance=product)
     stockForm = StockForm(instance=stock)
-    currentCode = Code.objects.get(stock=stock)
-    sizes = Size.objects.all()
-    colors = Color.objects.all()
-    codes = Code.objects.all()
+    reference = get_reference_data()
+    currentCode = reference.code(stock.code_id)
+    sizes = reference.sizes
+    colors = reference.colors
+    codes = reference.codes
     codeId = None
 
     if request.method == 'POST':
@@ -254,13 +242,16 @@ def editProduct(request, pk):
             product = form.save()
             product.SKU = str(product.id) + '-'+ str(request.user.id)
             product.seller = request.user
+            thumbUpload = completed_upload(request.user, request.POST.get('thumb-upload'))
+            if thumbUpload:
+                product.thumb = thumbUpload
             product.save()
 
             stock = stockForm.save(commit=False)
             stock.product = product
-            stock.size = Size.objects.get(id=request.POST.get('size'))
-            stock.color = Color.objects.get(id=request.POST.get('color'))
-            stock.code = codeId if codeId is not None else Code.objects.get(id=request.POST.get('code'))
+            stock.size = reference.size(request.POST.get('size'))
+            stock.color = reference.color(request.POST.get('color'))
+            stock.code = codeId if codeId is not None else reference.code(request.POST.get('code'))
             stock.save()    
             print('done!')
             messages.success(request, 'Product Added Successfully!')
@@ -268,9 +259,56 @@ def editProduct(request, pk):
         else:
             print(form.errors)
     
-    context = {'form': form, 'stockForm': stockForm, 'sizes': sizes, 'colors': colors, 'codes': codes, 'currentCode': currentCode}
+    context = {'form': form, 'stockForm': stockForm, 'sizes': sizes, 'colors': colors, 'codes': codes, 'currentCode': currentCode, 'uploadMaxSize': UPLOAD_MAX_SIZE}
     return render(request, 'admin_site/add_edit_product.html', context)
 
+# Start a chunked image upload, the product form then refers to it by id
+@login_required(login_url='admin-login')
+@seller_required(redirect_url='admin-login')
+@require_POST
+def startUpload(request):
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'message': 'Error', 'error': 'Invalid JSON payload'}, status=400)
+
+    try:
+        upload = start_upload(request.user, data.get('filename'), data.get('size'))
+    except UploadError as e:
+        return JsonResponse({'message': 'Error', 'error': str(e)}, status=e.status)
+    return JsonResponse(upload_state(upload), status=201)
+
+# Where an interrupted upload resumes
+@login_required(login_url='admin-login')
+@seller_required(redirect_url='admin-login')
+@require_GET
+def uploadStatus(request, pk):
+    upload = get_upload(request.user, pk)
+    if upload is None:
+        return JsonResponse({'message': 'Error', 'error': 'Unknown or expired upload'}, status=404)
+    return JsonResponse(upload_state(upload))
+
+# Receive one part of an upload, the raw request body starting at the Upload-Offset header
+@login_required(login_url='admin-login')
+@seller_required(redirect_url='admin-login')
+@require_POST
+def uploadChunk(request, pk):
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+        length = int(request.headers.get('Content-Length', ''))
+    except ValueError:
+        return JsonResponse({'message': 'Error', 'error': 'Missing Upload-Offset or Content-Length header'}, status=400)
+
+    try:
+        upload = append_chunk(request.user, pk, offset, request, length)
+    except UploadError as e:
+        response = {'message': 'Error', 'error': str(e)}
+        upload = get_upload(request.user, pk)
+        if upload is not None:
+            response.update(upload_state(upload))
+        return JsonResponse(response, status=e.status)
+    return JsonResponse(upload_state(upload))
+
 
 # Delete all products that has the same code
 @login_required(login_url='admin-login')
@@ -442,14 +480,13 @@ def addDiscount(request):
 def editDiscount(request, pk):
     discount = Discount.objects.get(id=pk)
     form = DiscountForm(instance=discount)
-    print(form)
 
     if request.method == 'POST':
         form = DiscountForm(request.POST, instance=discount)
         if form.is_valid():
             discount = form.save(commit=False)
             if not discount.active:
-                discount.product_set.update(discount=None)
+                discount.detach_products()
             discount.save()
             messages.success(request, 'Discount Updated Successfully!')
             return redirect('discounts')
@@ -491,11 +528,9 @@ def updateActivationDiscount(request, pk):
     try:
         if request.method == 'POST':
             if data_value == '1':
-                print(data_value)
                 discount.active = False
-                discount.product_set.update(discount=None)
+                discount.detach_products()
             elif data_value == '0':
-                print(data_value)
                 discount.active = True
             discount.save()
             back_to_url = reverse('discounts')
@@ -0,0 +1,147 @@
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.management.base import BaseCommand
+from django.utils._os import safe_join
+
+from ecommerce.media import parse_range
+
+
+# Hop-by-hop and proxy-only headers that are not passed on
+SKIPPED_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'host', 'content-length', 'surrogate-key', 'surrogate-control'}
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class StubProxyHandler(BaseHTTPRequestHandler):
+    """
+    Caching reverse proxy in the style of Varnish or Fastly: anonymous responses with a
+    Surrogate-Control max-age are cached by path and indexed by their Surrogate-Key header,
+    and a PURGE request with a Surrogate-Key header drops every object carrying one of the keys.
+    Like nginx, it answers an X-Accel-Redirect under accel_prefix with the file from media_root.
+    """
+    upstream = None
+    media_root = None
+    accel_prefix = None
+    opener = urllib.request.build_opener(_NoRedirect)
+    objects = {}
+    keys = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        anonymous = 'sessionid=' not in self.headers.get('Cookie', '')
+        if anonymous:
+            with self.lock:
+                cached = self.objects.get(self.path)
+            if cached and cached['expires'] > time.monotonic():
+                return self._send(cached['status'], cached['headers'], cached['body'], 'HIT')
+
+        status, headers, body = self._forward()
+        accel = dict(headers).get('X-Accel-Redirect')
+        if accel:
+            return self._send_file(status, headers, accel)
+        max_age = self._max_age(headers)
+        if anonymous and status == 200 and max_age and 'set-cookie' not in {name.lower() for name, _ in headers}:
+            keys = dict(headers).get('Surrogate-Key', '').split()
+            with self.lock:
+                self.objects[self.path] = {'status': status, 'headers': headers, 'body': body, 'keys': keys, 'expires': time.monotonic() + max_age}
+                for key in keys:
+                    self.keys.setdefault(key, set()).add(self.path)
+        self._send(status, headers, body, 'MISS')
+
+    def do_POST(self):
+        self._send(*self._forward(), 'PASS')
+
+    def do_PURGE(self):
+        purged = 0
+        with self.lock:
+            for key in self.headers.get('Surrogate-Key', '').split():
+                for path in self.keys.pop(key, ()):
+                    if self.objects.pop(path, None) is not None:
+                        purged += 1
+        self.log_message("purged %d objects for %s", purged, self.headers.get('Surrogate-Key', ''))
+        self._send(200, [('Content-Type', 'text/plain')], ('purged %d\n' % purged).encode(), 'PURGE')
+
+    def _forward(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        headers = {name: value for name, value in self.headers.items() if name.lower() not in SKIPPED_HEADERS}
+        request = urllib.request.Request(self.upstream + self.path, data=body, headers=headers, method=self.command)
+        try:
+            response = self.opener.open(request)
+        except urllib.error.HTTPError as e:
+            response = e
+        with response:
+            return response.status, list(response.headers.items()), response.read()
+
+    def _max_age(self, headers):
+        for name, value in headers:
+            if name.lower() == 'surrogate-control':
+                directives = [directive.strip() for directive in value.split(',')]
+                if 'no-store' in directives:
+                    return 0
+                for directive in directives:
+                    if directive.startswith('max-age='):
+                        return int(directive[len('max-age='):])
+        return 0
+
+    def _send_file(self, status, headers, accel):
+        headers = [(name, value) for name, value in headers if name.lower() != 'x-accel-redirect']
+        try:
+            if not accel.startswith(self.accel_prefix):
+                raise SuspiciousFileOperation(accel)
+            path = safe_join(self.media_root, urllib.parse.unquote(accel[len(self.accel_prefix):]))
+            with open(path, 'rb') as file:
+                body = file.read()
+        except (SuspiciousFileOperation, OSError):
+            return self._send(404, [('Content-Type', 'text/plain')], b'not found\n', 'ACCEL')
+
+        byte_range = parse_range(self.headers.get('Range'), len(body))
+        if byte_range is not None:
+            first, last = byte_range
+            if first >= len(body):
+                return self._send(416, headers + [('Content-Range', 'bytes */%d' % len(body))], b'', 'ACCEL')
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (first, last, len(body))))
+            status, body = 206, body[first:last + 1]
+        self._send(status, headers, body, 'ACCEL')
+
+    def _send(self, status, headers, body, cache_status):
+        self.send_response(status)
+        for name, value in headers:
+            if name.lower() not in SKIPPED_HEADERS:
+                self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Cache', cache_status)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Command(BaseCommand):
+    help = "Run a local caching proxy in front of the storefront that honours Surrogate-Key purges"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8080)
+        parser.add_argument('--upstream', default='http://127.0.0.1:8000')
+        parser.add_argument('--media-root', default=str(settings.MEDIA_ROOT), help="Directory X-Accel-Redirect paths are served from")
+
+    def handle(self, *args, **options):
+        StubProxyHandler.upstream = options['upstream'].rstrip('/')
+        StubProxyHandler.media_root = options['media_root']
+        StubProxyHandler.accel_prefix = settings.MEDIA_ACCEL_PREFIX
+        server = ThreadingHTTPServer(('127.0.0.1', options['port']), StubProxyHandler)
+        print("proxying http://127.0.0.1:" + str(options['port']) + " to " + StubProxyHandler.upstream)
+        print("set SURROGATE_PURGE_URL=http://127.0.0.1:" + str(options['port']) + "/ for the Django process")
+        print("and MEDIA_ACCEL=x-accel-redirect to have uploads sent from " + StubProxyHandler.media_root)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
@@ -0,0 +1,193 @@
+import copy
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from django.core.cache import cache
+from django.db import InterfaceError, OperationalError, connections
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+
+from products.caching import CATEGORY_COUNTS_TAG, CATEGORY_TREE_TAG, acquire_rebuild_lock, release_rebuild_lock, tags_purged_since, wait_for_rebuild
+from products.category_tree import get_category_tree
+
+
+PAGE_KEY_PREFIX = 'page:'
+# An entry is served as is for PAGE_CACHE_FRESH seconds, then served while a background render
+# replaces it until PAGE_CACHE_TIMEOUT. A tag purge ends both at once.
+PAGE_CACHE_FRESH = 10 * 60
+PAGE_CACHE_TIMEOUT = 60 * 60
+# How long the last good render of a page is kept to serve while the database is down
+LAST_GOOD_TIMEOUT = 24 * 60 * 60
+
+# Every storefront page shows the navbar tree. Only changes to the categories themselves purge it,
+# the product counts next to them are spliced into a cached page as it is served
+BASE_TAGS = (CATEGORY_TREE_TAG,)
+# What the validators of a page and the fronting proxy depend on, the counts included
+NAVBAR_TAGS = BASE_TAGS + (CATEGORY_COUNTS_TAG,)
+
+# customer_category_menu.html starts and ends with these
+MENU_START = b'<!-- category-menu -->'
+MENU_END = b'<!-- /category-menu -->'
+
+logger = logging.getLogger(__name__)
+
+# Background renders of stale pages, a couple per worker is enough to keep hot pages warm
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='page-refresh')
+
+# The tree the menu was last rendered from, with the rendered menu
+_menu = (None, b'')
+
+
+def page_key(request):
+    return PAGE_KEY_PREFIX + hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+
+
+def category_menu():
+    """
+    Returns the navbar category links with the current counts, rendered once per tree.
+    """
+    global _menu
+    tree = get_category_tree()
+    menu_tree, menu = _menu
+    if tree is not menu_tree:
+        menu = render_to_string('customer_category_menu.html', {'categories': tree}).strip().encode()
+        _menu = (tree, menu)
+    return menu
+
+
+def splice_category_menu(content):
+    start = content.find(MENU_START)
+    end = content.find(MENU_END, start)
+    if start == -1 or end == -1:
+        return content
+    return content[:start] + category_menu() + content[end + len(MENU_END):]
+
+
+def add_surrogate_headers(response, tags):
+    # The fronting proxy caches under the same tags the purges name, untagged pages stay uncached.
+    # It has no splicing of its own, so the counts are one of its keys
+    if tags is None:
+        response['Surrogate-Control'] = 'no-store'
+    else:
+        response['Surrogate-Key'] = ' '.join(sorted(set(tags) | set(NAVBAR_TAGS)))
+        response['Surrogate-Control'] = 'max-age=%d, stale-while-revalidate=%d, stale-if-error=%d' % (
+            PAGE_CACHE_FRESH, PAGE_CACHE_TIMEOUT - PAGE_CACHE_FRESH, LAST_GOOD_TIMEOUT)
+    return response
+
+
+def is_current(entry):
+    return not tags_purged_since(entry['tags'], entry['rendered_at'])
+
+
+def entry_response(entry, splice=True):
+    content = splice_category_menu(entry['content']) if splice else entry['content']
+    response = HttpResponse(content, status=entry['status'])
+    for header, value in entry['headers']:
+        response[header] = value
+    response.cache_tags = entry['tags']
+    return add_surrogate_headers(response, entry['tags'])
+
+
+def render_page(view, request, args, kwargs, key):
+    """
+    Renders the view and stores the page when the view tagged it.
+    """
+    # Taken before the view reads anything, so a purge landing mid-render still invalidates the entry
+    rendered_at = time.time()
+    response = view(request, *args, **kwargs)
+
+    tags = getattr(response, 'cache_tags', None)
+    if tags is None or response.status_code != 200 or response.streaming or response.cookies:
+        return add_surrogate_headers(response, None)
+
+    tags = sorted(set(tags) | set(BASE_TAGS))
+    response.cache_tags = tags
+    # The page's own tags are only known now, one seen for the first time just has to
+    # invalidate entries older than this render
+    if request.method == 'GET' and not tags_purged_since(tags, rendered_at, missing_since=rendered_at - 0.001):
+        cache.set(key, {
+            'content': response.content,
+            'status': response.status_code,
+            'headers': list(response.items()),
+            'tags': tags,
+            'rendered_at': rendered_at,
+        }, LAST_GOOD_TIMEOUT)
+    return add_surrogate_headers(response, tags)
+
+
+def refresh_page(view, request, args, kwargs, key, token):
+    try:
+        render_page(view, request, args, kwargs, key)
+    except Exception:
+        logger.exception("Background refresh of %s failed", request.path)
+    finally:
+        release_rebuild_lock(key, token)
+        # Connections are per thread, do not leave this one open
+        connections.close_all()
+
+
+def cache_anonymous_page(view):
+    """
+    Serves the view from the cache to anonymous visitors. The view names what its page depends on
+    in response.cache_tags, and purging any of those tags turns the entry into a miss. Responses
+    without cache_tags are never stored. Anonymous responses carry the tags as surrogate keys.
+    A page past its fresh period is served while one background render replaces it, and only one
+    request renders a purged or missing page at a time, the others wait for its entry.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or request.user.is_authenticated:
+            return add_surrogate_headers(view(request, *args, **kwargs), None)
+
+        key = page_key(request)
+        entry = cache.get(key)
+        if entry is not None and is_current(entry):
+            age = time.time() - entry['rendered_at']
+            if age < PAGE_CACHE_FRESH:
+                return entry_response(entry)
+            if age < PAGE_CACHE_TIMEOUT:
+                token = acquire_rebuild_lock(key)
+                if token is not None:
+                    _refresh_executor.submit(refresh_page, view, copy.copy(request), args, kwargs, key, token)
+                return entry_response(entry)
+
+        token = acquire_rebuild_lock(key)
+        if token is None:
+            entry = wait_for_rebuild(key, is_current)
+            if entry is not None:
+                return entry_response(entry)
+
+        try:
+            return render_page(view, request, args, kwargs, key)
+        finally:
+            if token is not None:
+                release_rebuild_lock(key, token)
+    return wrapper
+
+
+def serve_last_good_on_outage(view):
+    """
+    Answers with the last good render of the page, purged or not, when the database cannot be
+    reached, so the storefront stays readable through an outage. Goes outermost, since the
+    conditional GET validators query the database as well.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except (OperationalError, InterfaceError):
+            entry = cache.get(page_key(request)) if request.method in ('GET', 'HEAD') else None
+            if entry is None:
+                raise
+            logger.warning("Database unavailable, serving the last good render of %s", request.path)
+            # The counts of the last good render, the current ones need the database
+            response = entry_response(entry, splice=False)
+            response['X-Degraded-Mode'] = 'read-only'
+            # Neither the proxy nor the browser should keep the fallback around
+            response['Surrogate-Control'] = 'no-store'
+            response['Cache-Control'] = 'no-cache'
+            return response
+    return wrapper
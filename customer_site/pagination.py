@@ -0,0 +1,137 @@
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+class KeysetPage:
+    """
+    One page of a keyset paginated queryset, with links that carry an opaque cursor
+    instead of a page number.
+    """
+    def __init__(self, object_list, number, has_next, has_previous, next_url, previous_url, first_url):
+        self.object_list = object_list
+        self.number = number
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.next_url = next_url
+        self.previous_url = previous_url
+        self.first_url = first_url
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def elided_page_range(self):
+        """
+        Page links reachable without counting the result set: the first page,
+        the neighbours of the current page and an ellipsis for the gap.
+        """
+        pages = [{'number': 1, 'url': self.first_url}]
+        if self.number > 3:
+            pages.append({'ellipsis': True})
+        if self.number > 2:
+            pages.append({'number': self.number - 1, 'url': self.previous_url})
+        if self.number > 1:
+            pages.append({'number': self.number, 'current': True})
+        else:
+            pages[0]['current'] = True
+        if self.has_next:
+            pages.append({'number': self.number + 1, 'url': self.next_url})
+        return pages
+
+
+class KeysetPaginator:
+    """
+    Paginates a queryset with WHERE conditions on its sort keys, so every page costs
+    the same index range scan no matter how deep it is. The ordering must end with a
+    unique field such as 'id'.
+    """
+    cursor_param = 'cursor'
+
+    def __init__(self, queryset, per_page, ordering):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = ordering
+        self.fields = [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+
+    def get_page(self, request):
+        cursor = self._decode(request.GET.get(self.cursor_param))
+        if cursor is None:
+            rows = list(self.queryset.order_by(*self.ordering)[:self.per_page + 1])
+            number, has_previous = 1, False
+            has_next = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+        elif cursor['d'] == 'next':
+            rows = list(self.queryset.filter(self._seek(cursor['v'], forward=True)).order_by(*self.ordering)[:self.per_page + 1])
+            number, has_previous = cursor['n'], True
+            has_next = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+        else:
+            reverse_ordering = [name[1:] if name.startswith('-') else '-' + name for name in self.ordering]
+            rows = list(self.queryset.filter(self._seek(cursor['v'], forward=False)).order_by(*reverse_ordering)[:self.per_page + 1])
+            number, has_next = cursor['n'], True
+            has_previous = len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+            if not has_previous:
+                number = 1
+
+        next_url = previous_url = None
+        if rows and has_next:
+            next_url = self._url(request, self._encode(rows[-1], 'next', number + 1))
+        if rows and has_previous:
+            # The page before the second one is simply the first page
+            previous_url = self._url(request, self._encode(rows[0], 'prev', number - 1) if number > 2 else None)
+        return KeysetPage(rows, number, has_next, has_previous, next_url, previous_url, self._url(request, None))
+
+    def _seek(self, values, forward):
+        """
+        Builds (a > x) OR (a = x AND b > y) ... for the sort keys, flipped for descending keys
+        and when seeking backwards.
+        """
+        condition = Q()
+        equal = Q()
+        for (name, descending), value in zip(self.fields, values):
+            lookup = 'lt' if descending == forward else 'gt'
+            condition |= equal & Q(**{name + '__' + lookup: value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def _encode(self, row, direction, number):
+        payload = {'v': [getattr(row, name) for name, _ in self.fields], 'd': direction, 'n': number}
+        # default=str keeps full microseconds on datetimes, which the seek condition compares exactly
+        data = json.dumps(payload, default=str, separators=(',', ':')).encode()
+        return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+    def _decode(self, cursor):
+        if not cursor:
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            if len(payload['v']) != len(self.fields) or payload['d'] not in ('next', 'prev'):
+                return None
+            values = [self._field(name).to_python(value) for (name, _), value in zip(self.fields, payload['v'])]
+            return {'v': values, 'd': payload['d'], 'n': max(int(payload['n']), 1)}
+        except (binascii.Error, ValueError, TypeError, KeyError, ValidationError):
+            # A tampered or stale cursor falls back to the first page
+            return None
+
+    def _field(self, name):
+        # Sort keys can also be annotations, such as the search rank
+        annotation = self.queryset.query.annotations.get(name)
+        if annotation is not None:
+            return annotation.output_field
+        return self.queryset.model._meta.get_field(name)
+
+    def _url(self, request, cursor):
+        params = request.GET.copy()
+        params.pop(self.cursor_param, None)
+        if cursor:
+            params[self.cursor_param] = cursor
+        query = params.urlencode()
+        return '?' + query if query else request.path
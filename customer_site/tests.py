@@ -1,3 +1,226 @@
-from django.test import TestCase
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.db import OperationalError
+from django.db.models import QuerySet
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+
+from accounts.models import CustomUser
+from products import facets
+from products.caching import TAG_KEY_PREFIX, code_tag, get_purge_times, product_tag, seller_tag
+from products.models import Category, Code, Product, Size
+from products.tests import CatalogMixin
+from . import page_cache
+from .page_cache import PAGE_CACHE_FRESH, PAGE_CACHE_TIMEOUT, is_current, page_key
+from .pagination import KeysetPaginator
+
+
+# Pages render without collectstatic
+PLAIN_STORAGES = dict(settings.STORAGES, staticfiles={'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'})
+
+
+@override_settings(STORAGES=PLAIN_STORAGES)
+class PagePurgeTests(CatalogMixin, TestCase):
+    def setUp(self):
+        super(PagePurgeTests, self).setUp()
+        facets._index = None
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category = Category.objects.create(name='Shirts')
+
+    def add_shirt(self, size=None):
+        code = Code.objects.create(name='SHIRT-%s' % Code.objects.count())
+        self.add_product(code=code, size=size, category=self.category)
+        return code
+
+    def cached_entry(self, url):
+        return cache.get(page_key(RequestFactory().get(url)))
+
+    def test_product_count_change_keeps_other_pages(self):
+        self.assertEqual(self.client.get(reverse('home')).status_code, 200)
+        self.add_shirt()
+        self.assertTrue(is_current(self.cached_entry(reverse('home'))))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.name = 'Tops'
+            self.category.save()
+        self.assertFalse(is_current(self.cached_entry(reverse('home'))))
+
+    def test_cached_page_shows_current_counts(self):
+        response = self.client.get(reverse('home'))
+        self.assertContains(response, 'Shirts (0)')
+        etag = response['ETag']
+        self.add_shirt()
+
+        # Served from the entry, with the counts spliced in and a new validator
+        self.assertTrue(is_current(self.cached_entry(reverse('home'))))
+        response = self.client.get(reverse('home'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Shirts (1)')
+        self.assertIn('category-counts', response['Surrogate-Key'].split())
+        self.assertEqual(self.client.get(reverse('home'), HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_size_change_purges_listings_and_its_products_only(self):
+        code = self.add_shirt()
+        other_code = self.add_shirt(Size.objects.create(name='L'))
+        self.assertEqual(self.client.get(reverse('home')).status_code, 200)
+        self.assertEqual(self.client.get(reverse('show-all-products')).status_code, 200)
+        before = get_purge_times([code_tag(code.pk), code_tag(other_code.pk)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.size.name = 'Medium'
+            self.size.save()
+        after = get_purge_times([code_tag(code.pk), code_tag(other_code.pk)])
+        self.assertGreater(after[code_tag(code.pk)], before[code_tag(code.pk)])
+        self.assertEqual(after[code_tag(other_code.pk)], before[code_tag(other_code.pk)])
+        self.assertTrue(is_current(self.cached_entry(reverse('home'))))
+        self.assertFalse(is_current(self.cached_entry(reverse('show-all-products'))))
+
+
+@override_settings(STORAGES=PLAIN_STORAGES)
+class ConditionalGetTests(CatalogMixin, TestCase):
+    def setUp(self):
+        super(ConditionalGetTests, self).setUp()
+        facets._index = None
+
+    def test_unchanged_product_page_answers_304(self):
+        product = self.add_product()
+        url = reverse('product-detail', args=[product.pk])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+        # A color shown on the page changes the validators
+        with self.captureOnCommitCallbacks(execute=True):
+            self.color.name = 'Crimson'
+            self.color.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_listing_changes_with_the_products_in_it(self):
+        url = reverse('show-all-products')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.add_product()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_signed_in_users_get_their_own_etag(self):
+        etag = self.client.get(reverse('home'))['ETag']
+        self.client.force_login(self.seller)
+        response = self.client.get(reverse('home'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+@override_settings(STORAGES=PLAIN_STORAGES)
+class SurrogateKeyTests(CatalogMixin, TestCase):
+    def test_anonymous_pages_carry_their_tags(self):
+        code = Code.objects.create(name='SHIRT')
+        product = self.add_product(code=code)
+        response = self.client.get(reverse('product-detail', args=[product.pk]))
+        keys = response['Surrogate-Key'].split()
+        for tag in (product_tag(product.pk), code_tag(code.pk), seller_tag(self.seller.pk), 'category-tree', 'category-counts'):
+            self.assertIn(tag, keys)
+        self.assertTrue(response['Surrogate-Control'].startswith('max-age='))
+
+        # Served from the page cache with the same keys
+        self.assertEqual(self.client.get(reverse('product-detail', args=[product.pk]))['Surrogate-Key'].split(), keys)
+
+    def test_signed_in_pages_are_not_kept_by_the_proxy(self):
+        self.client.force_login(self.seller)
+        response = self.client.get(reverse('home'))
+        self.assertEqual(response['Surrogate-Control'], 'no-store')
+        self.assertFalse(response.has_header('Surrogate-Key'))
+
+
+@override_settings(STORAGES=PLAIN_STORAGES)
+class StalePageTests(CatalogMixin, TestCase):
+    def setUp(self):
+        super(StalePageTests, self).setUp()
+        self.product = self.add_product()
+        self.url = reverse('product-detail', args=[self.product.pk])
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.key = page_key(RequestFactory().get(self.url))
+
+    def age_entry(self, seconds):
+        # The tags were first seen by the render, they age along with it
+        entry = cache.get(self.key)
+        entry['rendered_at'] -= seconds
+        cache.set_many({TAG_KEY_PREFIX + tag: purged - seconds for tag, purged in get_purge_times(entry['tags']).items()}, None)
+        entry['content'] = entry['content'].replace(b'</body>', b'<!-- old render --></body>')
+        cache.set(self.key, entry)
+
+    def test_stale_page_is_served_while_one_refresh_runs(self):
+        self.age_entry(PAGE_CACHE_FRESH + 1)
+        with mock.patch.object(page_cache._refresh_executor, 'submit') as submit:
+            self.assertContains(self.client.get(self.url), 'old render')
+            self.assertContains(self.client.get(self.url), 'old render')
+        self.assertEqual(submit.call_count, 1)
+
+        # The refresh renders the page again in the background
+        function, *args = submit.call_args.args
+        with mock.patch.object(page_cache.connections, 'close_all'):
+            function(*args)
+        self.assertNotContains(self.client.get(self.url), 'old render')
+
+    def test_expired_page_is_rendered_again(self):
+        self.age_entry(PAGE_CACHE_TIMEOUT + 1)
+        with mock.patch.object(page_cache._refresh_executor, 'submit') as submit:
+            self.assertNotContains(self.client.get(self.url), 'old render')
+        submit.assert_not_called()
+
+    def test_last_good_render_is_served_during_an_outage(self):
+        self.age_entry(0)
+        # Purged, so only an outage serves it
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = 'Polo'
+            self.product.save()
+        with mock.patch.object(QuerySet, 'aggregate', side_effect=OperationalError('database is down')):
+            with self.assertLogs('customer_site.page_cache', 'WARNING'):
+                response = self.client.get(self.url)
+        self.assertContains(response, 'old render')
+        self.assertEqual(response['X-Degraded-Mode'], 'read-only')
+        self.assertEqual(response['Surrogate-Control'], 'no-store')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+
+    def test_outage_without_a_render_is_an_error(self):
+        cache.delete(self.key)
+        with mock.patch.object(QuerySet, 'aggregate', side_effect=OperationalError('database is down')):
+            with self.assertRaises(OperationalError):
+                self.client.get(self.url)
+
+
+class KeysetPaginatorTests(TestCase):
+    def setUp(self):
+        seller = CustomUser.objects.create_user('seller@example.com', 'secret', first_name='a', last_name='b', user_type='seller')
+        # Ties on the price are broken by the id
+        for price in (5, 20, 5, 10, 30, 5, 10):
+            Product.objects.create(name='Shirt', price=price, active=True, seller=seller)
+
+    def walk(self, ordering, url='/shop/', attr='next_url'):
+        paginator = KeysetPaginator(Product.objects.all(), 3, ordering)
+        pages = []
+        while url:
+            query = parse_qs(urlsplit(url).query)
+            page = paginator.get_page(RequestFactory().get('/shop/', {name: values[0] for name, values in query.items()}))
+            pages.append((page.number, [product.pk for product in page]))
+            url = getattr(page, attr)
+        return pages, page
+
+    def test_pages_cover_every_product_once_in_order(self):
+        for ordering in (('effective_price', 'id'), ('-effective_price', '-id')):
+            pages, last = self.walk(ordering)
+            expected = list(Product.objects.order_by(*ordering).values_list('pk', flat=True))
+            self.assertEqual([pk for _, pks in pages for pk in pks], expected)
+            self.assertEqual([number for number, _ in pages], [1, 2, 3])
+
+            # Walking back from the last page gives the same pages
+            back, _ = self.walk(ordering, last.previous_url, 'previous_url')
+            self.assertEqual(back, pages[-2::-1])
+
+    def test_tampered_cursor_falls_back_to_the_first_page(self):
+        paginator = KeysetPaginator(Product.objects.all(), 3, ('effective_price', 'id'))
+        page = paginator.get_page(RequestFactory().get('/shop/', {'cursor': 'not-a-cursor'}))
+        self.assertEqual((page.number, page.has_previous), (1, False))
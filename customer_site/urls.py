@@ -20,6 +20,9 @@ urlpatterns = [
     # All products with category filter URL
     path('show-all-product-categroy/<str:pk>/', views.allCategoryProducts, name="show-all-products-category"),
 
+    # Search results URL
+    path('search/', views.searchProducts, name="search-products"),
+
     # Product's detail URL
     path('product-detail/<str:pk>/', views.productDetail, name="product-detail"),
 ]
\ No newline at end of file
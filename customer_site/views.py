@@ -1,11 +1,19 @@
-from django.core.paginator import Paginator
 from django.contrib import messages
 from django.shortcuts import render, redirect
 from accounts.forms import CustomAuthenticationForm, CustomUserForm
-from products.models import Product, Category
+from django.db.models import Max, Q
+from django.views.decorators.http import condition
+from products.models import Product, Category, Stock
+from products.caching import CATALOG_TAG, PRODUCTS_TAG, category_tag, code_tag, discount_tag, product_tag, seller_tag, tags_last_purged
+from products.category_tree import get_category_tree, get_category_tree_version
+from products.facets import facet_index_is_current, get_facet_index
+from products.search import search_products
+from .page_cache import NAVBAR_TAGS, cache_anonymous_page, serve_last_good_on_outage
+from .pagination import KeysetPaginator
 from django.contrib.auth import login, logout, update_session_auth_hash
 
 from django.utils.translation import gettext_lazy as _
+import hashlib
 
 # Create your views here.
 
@@ -59,43 +67,174 @@ def logoutCustomer(request):
     context = {'page': page}
     return redirect('login')
 
+# Sort options of the product listings, each ending with a unique key for keyset pagination
+SORT_OPTIONS = {
+    'newest': ('Latest', ('-created_at', '-id')),
+    'price-asc': ('Price: Low to High', ('effective_price', 'id')),
+    'price-desc': ('Price: High to Low', ('-effective_price', '-id')),
+    'name': ('Name', ('name', 'id')),
+}
+
+# Search results are ranked by relevance unless another sort is picked
+SEARCH_SORT_OPTIONS = {
+    'relevance': ('Relevance', ('-search_rank', 'id')),
+    **SORT_OPTIONS,
+}
+
+def paginateProducts(request, products, sort_options=SORT_OPTIONS):
+    sort = request.GET.get('sort')
+    if sort not in sort_options:
+        sort = next(iter(sort_options))
+    paginator = KeysetPaginator(products, 12, sort_options[sort][1])
+    return paginator.get_page(request), sort
+
+def filterProducts(request, products, index, base, category_id=None):
+    # Filters run in SQL, the counts next to each option come from the in-memory facet index
+    selection = index.parse_selection(request.GET)
+    facets = index.facet_groups(base, selection, category_id)
+    return index.filter_products(products, selection), facets
+
+def filterQuery(request):
+    # Query string of the current search and filters, for the sort links
+    params = request.GET.copy()
+    for name in ('sort', KeysetPaginator.cursor_param):
+        params.pop(name, None)
+    return params.urlencode()
+
+def tagListing(response, page_obj, tags, index):
+    # Listings are only cached once their facet counts have caught up with the catalog
+    if facet_index_is_current(index):
+        response.cache_tags = tags + [product_tag(product.id) for product in page_obj]
+    return response
+
+# Validators for conditional GETs, a matching request gets its 304 before anything is rendered
+def pageEtag(request, last_modified, *parts):
+    # The navbar greets signed in users by name and shows this worker's category counts
+    user_id = request.user.pk if request.user.is_authenticated else ''
+    data = '|'.join(str(part) for part in (last_modified.timestamp(), user_id, get_category_tree_version()) + parts)
+    return hashlib.md5(data.encode()).hexdigest()
+
+def listingLastModified(request, pk=None):
+    # A listing changes with products leaving it as well, which no updated_at can show,
+    # so it uses the time of the last purge of its cache tags instead
+    if not hasattr(request, 'last_modified'):
+        tags = [PRODUCTS_TAG] if pk is None else [category_tag(pk)]
+        request.last_modified = tags_last_purged(list(NAVBAR_TAGS) + [CATALOG_TAG] + tags)
+    return request.last_modified
+
+def listingEtag(request, pk=None):
+    # The facet counts come from this worker's index, which may lag behind the catalog
+    return pageEtag(request, listingLastModified(request, pk), get_facet_index().version)
+
+def homeLastModified(request):
+    return tags_last_purged(NAVBAR_TAGS)
+
+def homeEtag(request):
+    return pageEtag(request, homeLastModified(request))
+
+def productLastModified(request, pk):
+    if not hasattr(request, 'last_modified'):
+        # The product and the products sharing its code, whose sizes and colors are shown
+        stats = Product.objects.filter(Q(pk=pk) | Q(stock__code__in=Stock.objects.filter(product_id=pk).values('code'))).aggregate(
+            product=Max('updated_at'),
+            discount=Max('discount__updated_at'),
+            size=Max('stock__size__updated_at'),
+            color=Max('stock__color__updated_at'),
+        )
+        if stats['product'] is None:
+            request.last_modified = None
+        else:
+            request.last_modified = max([value for value in stats.values() if value] + [tags_last_purged(NAVBAR_TAGS)])
+    return request.last_modified
+
+def productEtag(request, pk):
+    last_modified = productLastModified(request, pk)
+    return pageEtag(request, last_modified) if last_modified else None
+
 # Home page
+@serve_last_good_on_outage
+@condition(etag_func=homeEtag, last_modified_func=homeLastModified)
+@cache_anonymous_page
 def home(request):
-    categories = Category.objects.filter(category_parent__isnull=True)
+    categories = get_category_tree()
 
     context = {'categories': categories}
-    return render(request, 'customer_site/home.html', context)
+    response = render(request, 'customer_site/home.html', context)
+    # Only the navbar is dynamic, which every cached page depends on anyway
+    response.cache_tags = []
+    return response
 
 # All products page
+@serve_last_good_on_outage
+@condition(etag_func=listingEtag, last_modified_func=listingLastModified)
+@cache_anonymous_page
 def allProducts(request):
     page = "All Products"
+    categories = get_category_tree()
     products = Product.objects.filter(active=True)
-    paginator = Paginator(products, 12)
+    index = get_facet_index()
+    products, facets = filterProducts(request, products, index, index.all)
+    page_obj, sort = paginateProducts(request, products)
 
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
-
-    context = {'products': products, 'page_obj': page_obj, 'page': page}
-    return render(request, 'customer_site/show_all_products.html', context)
+    context = {'categories': categories, 'products': products, 'page_obj': page_obj, 'page': page, 'sort': sort, 'sort_options': SORT_OPTIONS, 'facets': facets, 'filter_query': filterQuery(request)}
+    response = render(request, 'customer_site/show_all_products.html', context)
+    return tagListing(response, page_obj, [CATALOG_TAG, PRODUCTS_TAG], index)
 
 # All products with category filter
+@serve_last_good_on_outage
+@condition(etag_func=listingEtag, last_modified_func=listingLastModified)
+@cache_anonymous_page
 def allCategoryProducts(request, pk):
-    categories = Category.objects.filter(category_parent__isnull=True)
+    categories = get_category_tree()
     category = Category.objects.get(id=pk)
     page = category
-    products = Product.objects.filter(category=category)
-    paginator = Paginator(products, 12)
-
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
-
-    context = {'categories': categories, 'products': products, 'page_obj': page_obj, 'page': page}
+    # The category page lists its whole subtree
+    products = Product.objects.filter(active=True, category__in=category.get_descendants())
+    index = get_facet_index()
+    products, facets = filterProducts(request, products, index, index.category_bits(category.id), category.id)
+    page_obj, sort = paginateProducts(request, products)
+
+    context = {'categories': categories, 'products': products, 'page_obj': page_obj, 'page': page, 'sort': sort, 'sort_options': SORT_OPTIONS, 'facets': facets, 'filter_query': filterQuery(request)}
+    response = render(request, 'customer_site/show_all_products.html', context)
+    return tagListing(response, page_obj, [CATALOG_TAG, category_tag(category.id)], index)
+
+# Search results page
+def searchProducts(request):
+    query = request.GET.get('q', '').strip()
+    page = "Search"
+    categories = get_category_tree()
+    products = search_products(query)
+    index = get_facet_index()
+    products, facets = filterProducts(request, products, index, index.bits_for(products.values_list('pk', flat=True)))
+    page_obj, sort = paginateProducts(request, products, SEARCH_SORT_OPTIONS)
+
+    context = {'categories': categories, 'products': products, 'page_obj': page_obj, 'page': page, 'sort': sort, 'sort_options': SEARCH_SORT_OPTIONS, 'query': query, 'facets': facets, 'filter_query': filterQuery(request)}
     return render(request, 'customer_site/show_all_products.html', context)
 
 # Product's detail page
+@serve_last_good_on_outage
+@condition(etag_func=productEtag, last_modified_func=productLastModified)
+@cache_anonymous_page
 def productDetail(request, pk):
     page = "Product Details"
+    categories = get_category_tree()
     product = Product.objects.get(id=pk)
 
-    context = {'page': page, 'product': product}
-    return render (request, 'customer_site/product_detail.html', context)
\ No newline at end of file
+    # Sizes and colors offered by the products sharing this product's code
+    variants = (
+        Stock.objects.filter(code__in=Stock.objects.filter(product=product).values('code'))
+        .filter(Q(product__active=True) | Q(product=product))
+        .select_related('size', 'color').order_by('size_id', 'color_id')
+    )
+    sizes = list(dict.fromkeys(stock.size for stock in variants))
+    colors = list(dict.fromkeys(stock.color for stock in variants))
+    product_stock = next((stock for stock in variants if stock.product_id == product.id), None)
+
+    context = {'categories': categories, 'page': page, 'product': product, 'sizes': sizes, 'colors': colors, 'product_stock': product_stock}
+    response = render (request, 'customer_site/product_detail.html', context)
+    response.cache_tags = [product_tag(product.id)] + [code_tag(code_id) for code_id in {stock.code_id for stock in variants}]
+    if product.discount_id:
+        response.cache_tags.append(discount_tag(product.discount_id))
+    if product.seller_id:
+        response.cache_tags.append(seller_tag(product.seller_id))
+    return response
\ No newline at end of file
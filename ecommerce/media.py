@@ -0,0 +1,122 @@
+import mimetypes
+import os
+import re
+import stat
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+
+# Uploads never change under their name, a new file gets a new name
+MEDIA_MAX_AGE = 365 * 24 * 60 * 60
+
+_range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header, size):
+    """
+    Returns the (first, last) byte positions of a single byte range, (size, size - 1) for one
+    that cannot be satisfied, or None to send the whole file: no header, several ranges or
+    anything malformed.
+    """
+    match = _range_re.match((header or '').strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        # A suffix range, the last n bytes
+        length = int(last)
+        return (max(size - length, 0), size - 1) if length else (size, size - 1)
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    return first, min(int(last), size - 1) if last else size - 1
+
+
+class RangeFile:
+    """
+    Reads at most length bytes from the current position of a file. The file descriptor stays
+    reachable, so servers that use sendfile send the range straight from the page cache.
+    """
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def _file_response(request, full_path, size, etag, last_modified, content_type):
+    accel = settings.MEDIA_ACCEL
+    if accel == 'x-accel-redirect':
+        # nginx sends the file from an internal location aliasing MEDIA_ROOT, ranges included
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + quote(os.path.relpath(full_path, settings.MEDIA_ROOT))
+        return response
+    if accel == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = full_path
+        return response
+
+    byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if byte_range is not None and if_range and if_range not in (etag, http_date(last_modified)):
+        byte_range = None
+    if byte_range is None:
+        return FileResponse(open(full_path, 'rb'), content_type=content_type)
+
+    first, last = byte_range
+    if first >= size:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+    file = open(full_path, 'rb')
+    file.seek(first)
+    response = FileResponse(RangeFile(file, last - first + 1), status=206, content_type=content_type)
+    response['Content-Length'] = last - first + 1
+    response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+    return response
+
+
+@require_safe
+def serveMedia(request, path):
+    """
+    Serves an uploaded file with long lived caching and byte ranges. With MEDIA_ACCEL set the
+    front server transfers the file and Django only answers with the headers, otherwise the
+    file goes out as a FileResponse, which gunicorn sends with sendfile.
+    """
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        file_stat = os.stat(full_path)
+    except (SuspiciousFileOperation, OSError):
+        raise Http404
+    if not stat.S_ISREG(file_stat.st_mode):
+        raise Http404
+
+    etag = '"%x-%x"' % (file_stat.st_mtime_ns, file_stat.st_size)
+    last_modified = int(file_stat.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+        response = _file_response(request, full_path, file_stat.st_size, etag, last_modified, content_type)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'public, max-age=%d, immutable' % MEDIA_MAX_AGE
+    response['Accept-Ranges'] = 'bytes'
+    return response
@@ -104,6 +104,33 @@ DATABASES = {
     # )
 }
 
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+
+# The page cache and the version tokens of the per-worker caches live here, so with several
+# workers every one of them has to see the same backend: set REDIS_URL. The local memory
+# fallback is private to each process, products refuses to start on it with more than one
+# worker or to run the management commands that purge, and the session and user caches skip
+# their per-worker copies without it.
+SHARED_CACHE = bool(os.environ.get('REDIS_URL'))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['REDIS_URL'],
+    } if SHARED_CACHE else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ecommerce',
+    }
+}
+
+# Purge endpoint of the caching proxy in front of the storefront, sent a PURGE request with a
+# Surrogate-Key header whenever the catalog changes (python manage.py run_stub_proxy for a local one)
+SURROGATE_PURGE_URL = os.environ.get('SURROGATE_PURGE_URL')
+
+# Database sessions behind a per-worker LRU, python manage.py sweep_sessions clears the expired ones
+SESSION_ENGINE = 'accounts.sessions'
+
 AUTH_USER_MODEL = 'accounts.CustomUser'
 AUTHENTICATION_BACKENDS = ['accounts.backends.EmailBackend']
 
@@ -148,11 +175,28 @@ STATICFILES_DIRS = [
 ]
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+STORAGES = {
+    # Uploads are named by their content, identical images are stored once
+    'default': {
+        'BACKEND': 'products.storage.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage',
+    },
+}
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / "media"
 
+# How uploads reach the client: unset sends them from Django (sendfile under gunicorn),
+# 'x-accel-redirect' hands them to nginx through the internal MEDIA_ACCEL_PREFIX location
+# and 'x-sendfile' to Apache or lighttpd
+MEDIA_ACCEL = os.environ.get('MEDIA_ACCEL')
+MEDIA_ACCEL_PREFIX = os.environ.get('MEDIA_ACCEL_PREFIX', '/protected-media/')
+
+# Parts of chunked uploads still being received, outside MEDIA_ROOT so they are never served
+CHUNKED_UPLOAD_ROOT = BASE_DIR / 'uploads'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
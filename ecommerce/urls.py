@@ -15,9 +15,12 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path, include
+import re
+
+from django.urls import path, include, re_path
 from django.conf import settings
-from django.conf.urls.static import static
+
+from .media import serveMedia
 
 
 
@@ -31,7 +34,8 @@ urlpatterns = [
     path('admin-panel/', include('admin_site.urls')),
     
     # super_user URL
-    path('superuser-panel/', include('superuser_site.urls'))
-]
+    path('superuser-panel/', include('superuser_site.urls')),
 
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    # Uploaded images, also in production
+    re_path(r'^%s(?P<path>.+)$' % re.escape(settings.MEDIA_URL.lstrip('/')), serveMedia, name='media'),
+]
@@ -1,6 +1,38 @@
+import os
+import shlex
+import sys
+
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+def worker_count():
+    """
+    Returns how many processes serve the site, the largest of gunicorn's --workers on its
+    command line or in GUNICORN_CMD_ARGS and WEB_CONCURRENCY, which gunicorn also reads.
+    """
+    args = shlex.split(os.environ.get('GUNICORN_CMD_ARGS', ''))
+    if os.path.basename(sys.argv[0]).startswith('gunicorn'):
+        args += sys.argv[1:]
+    counts = [os.environ.get('WEB_CONCURRENCY', '')]
+    for index, arg in enumerate(args):
+        if arg in ('-w', '--workers'):
+            counts.append(args[index + 1] if index + 1 < len(args) else '')
+        elif arg.startswith('--workers='):
+            counts.append(arg.split('=', 1)[1])
+        elif arg.startswith('-w'):
+            counts.append(arg[2:])
+    # A malformed count is refused by gunicorn itself
+    return max([1] + [int(count) for count in counts if count.strip().isdigit()])
 
 
 class ProductsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'products'
+
+    def ready(self):
+        # Version tokens and tag purges only reach every worker through a shared cache
+        if not settings.SHARED_CACHE and worker_count() > 1:
+            raise ImproperlyConfigured("REDIS_URL must be set to run more than one worker")
+        from . import signals  # noqa: F401
@@ -0,0 +1,230 @@
+import logging
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import CommandError
+from django.db import transaction
+
+from .models import Category, Product, Stock
+
+
+# The listings offer every size and color as a filter
+CATALOG_TAG = 'catalog'
+# Every cached page links the categories of the navbar tree
+CATEGORY_TREE_TAG = 'category-tree'
+# The product counts next to those links, which the page cache splices in on its own
+CATEGORY_COUNTS_TAG = 'category-counts'
+# The unfiltered product listing depends on every product
+PRODUCTS_TAG = 'products'
+
+TAG_KEY_PREFIX = 'cache-tag:'
+
+# Surrogate keys per purge request sent to the fronting proxy, keeps the header a sane size
+SURROGATE_PURGE_BATCH = 100
+SURROGATE_PURGE_TIMEOUT = 5
+
+# Single-flight rebuilds: how long a rebuild may hold its key, how long the others wait for it
+# and how often they look, all in seconds
+REBUILD_LOCK_TIMEOUT = 30
+REBUILD_WAIT_TIMEOUT = 3
+REBUILD_WAIT_INTERVAL = 0.05
+# Expired values are kept this much longer, to hand out while one caller recomputes them
+STALE_GRACE = 10 * 60
+
+logger = logging.getLogger(__name__)
+
+# One background sender, so a slow proxy never holds up the request that changed the catalog
+_purge_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='surrogate-purge')
+
+
+def product_tag(product_id):
+    return 'product:%s' % product_id
+
+def category_tag(category_id):
+    return 'category:%s' % category_id
+
+def code_tag(code_id):
+    return 'code:%s' % code_id
+
+def discount_tag(discount_id):
+    return 'discount:%s' % discount_id
+
+def seller_tag(seller_id):
+    return 'seller:%s' % seller_id
+
+
+def get_purge_times(tags, missing_since=None):
+    """
+    Returns when each tag was last purged. A tag the cache does not know counts as purged at
+    missing_since, now by default, so an evicted tag never resurrects old entries.
+    """
+    keys = {TAG_KEY_PREFIX + tag: tag for tag in tags}
+    purged_at = cache.get_many(keys)
+    if missing_since is None:
+        missing_since = time.time()
+    for key in keys.keys() - purged_at.keys():
+        cache.add(key, missing_since, None)
+        purged_at[key] = cache.get(key, missing_since)
+    return {keys[key]: value for key, value in purged_at.items()}
+
+
+def tags_purged_since(tags, timestamp, missing_since=None):
+    """
+    Tells whether any of the tags was purged at or after the timestamp.
+    """
+    return any(value >= timestamp for value in get_purge_times(tags, missing_since).values())
+
+
+def tags_last_purged(tags):
+    """
+    Returns the time of the latest purge of any of the tags as an aware datetime.
+    """
+    return datetime.fromtimestamp(max(get_purge_times(tags).values()), tz=timezone.utc)
+
+
+def purge_tags(tags):
+    """
+    Marks the tags as purged now, which turns every entry rendered before this moment into a miss.
+    """
+    if tags:
+        now = time.time()
+        cache.set_many({TAG_KEY_PREFIX + tag: now for tag in tags}, None)
+        if settings.SURROGATE_PURGE_URL:
+            _purge_executor.submit(send_surrogate_purge, sorted(tags))
+
+
+def send_surrogate_purge(keys):
+    """
+    Asks the fronting proxy to drop every object carrying one of the surrogate keys.
+    """
+    for start in range(0, len(keys), SURROGATE_PURGE_BATCH):
+        batch = keys[start:start + SURROGATE_PURGE_BATCH]
+        request = urllib.request.Request(settings.SURROGATE_PURGE_URL, method='PURGE', headers={'Surrogate-Key': ' '.join(batch)})
+        try:
+            urllib.request.urlopen(request, timeout=SURROGATE_PURGE_TIMEOUT).close()
+        except OSError as e:
+            logger.warning("Surrogate key purge failed: %s", e)
+
+
+def schedule_purge(tags):
+    """
+    Purges the tags once the current transaction commits, so nothing is re-cached from uncommitted data.
+    """
+    tags = set(tags)
+    if tags:
+        transaction.on_commit(partial(purge_tags, tags))
+
+
+def require_shared_cache():
+    """
+    Refuses to run a management command that purges or invalidates cached data unless the cache
+    is the one the web workers share. The local memory fallback is private to the command.
+    """
+    if not settings.SHARED_CACHE:
+        raise CommandError("REDIS_URL must be set, the purges would never reach the web workers without it")
+
+
+def acquire_rebuild_lock(key):
+    """
+    Claims the right to rebuild key, returning a token to release it with, or None while
+    somebody else holds it.
+    """
+    token = uuid.uuid4().hex
+    if cache.add('rebuild-lock:' + key, token, REBUILD_LOCK_TIMEOUT):
+        return token
+    return None
+
+
+def release_rebuild_lock(key, token):
+    if cache.get('rebuild-lock:' + key) == token:
+        cache.delete('rebuild-lock:' + key)
+
+
+def wait_for_rebuild(key, is_ready):
+    """
+    Polls key until is_ready accepts its value, the rebuild lock is gone or the wait times out.
+    Returns the accepted value or None.
+    """
+    deadline = time.monotonic() + REBUILD_WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(REBUILD_WAIT_INTERVAL)
+        value = cache.get(key)
+        if value is not None and is_ready(value):
+            return value
+        if cache.get('rebuild-lock:' + key) is None:
+            return None
+    return None
+
+
+def get_or_compute(key, compute, timeout, tags=()):
+    """
+    Returns the cached result of compute, which stays fresh for timeout seconds unless one of
+    the tags is purged. Only one caller rebuilds a stale key at a time, the others get the
+    previous value meanwhile, or wait for the new one when there is none.
+    """
+    def is_fresh(entry):
+        return entry['expires_at'] > time.time() and not tags_purged_since(tags, entry['computed_at'])
+
+    entry = cache.get(key)
+    if entry is not None and is_fresh(entry):
+        return entry['value']
+
+    token = acquire_rebuild_lock(key)
+    if token is None:
+        if entry is not None:
+            return entry['value']
+        entry = wait_for_rebuild(key, is_fresh)
+        if entry is not None:
+            return entry['value']
+
+    try:
+        # Tags seen for the first time must not count as purged after the compute started
+        get_purge_times(tags)
+        # Taken before compute reads anything, so a purge landing meanwhile still counts
+        computed_at = time.time()
+        value = compute()
+        cache.set(key, {'value': value, 'computed_at': computed_at, 'expires_at': computed_at + timeout}, timeout + STALE_GRACE)
+        return value
+    finally:
+        if token is not None:
+            release_rebuild_lock(key, token)
+
+
+def category_tags(category_ids):
+    """
+    Returns the tags of the listings of the categories and all of their ancestors.
+    """
+    tags = set()
+    for path in Category.objects.filter(pk__in=set(category_ids) - {None}).values_list('path', flat=True):
+        tags.update(category_tag(category_id) for category_id in path.split('/')[:-1])
+    return tags
+
+
+def product_tags(product_ids, category_ids=()):
+    """
+    Returns the tags of every page showing one of the products: their own pages, the pages sharing
+    their codes, the listings of their categories and the full listing.
+    """
+    product_ids = set(product_ids) - {None}
+    tags = {PRODUCTS_TAG}
+    tags.update(product_tag(product_id) for product_id in product_ids)
+    tags.update(code_tag(code_id) for code_id in Stock.objects.filter(product__in=product_ids).values_list('code_id', flat=True).distinct())
+    category_ids = set(category_ids) | set(Product.objects.filter(pk__in=product_ids).values_list('category_id', flat=True))
+    tags.update(category_tags(category_ids))
+    return tags
+
+
+def discount_tags(discount):
+    """
+    Returns the tags of everything showing a product with the discount. The product pages carry
+    the discount tag, the listings and the pages sharing their codes are reached through its products.
+    """
+    category_ids = Product.objects.filter(discount=discount).values_list('category_id', flat=True).distinct()
+    code_ids = Stock.objects.filter(product__discount=discount).values_list('code_id', flat=True).distinct()
+    return {discount_tag(discount.pk), PRODUCTS_TAG} | category_tags(category_ids) | {code_tag(code_id) for code_id in code_ids}
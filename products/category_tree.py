@@ -0,0 +1,71 @@
+import threading
+import uuid
+from collections import namedtuple
+
+from django.core.cache import cache
+
+from .caching import CATEGORY_COUNTS_TAG, CATEGORY_TREE_TAG, purge_tags
+from .models import Category
+
+
+# Immutable node of the cached category tree
+CategoryNode = namedtuple('CategoryNode', ['id', 'name', 'product_count', 'children'])
+
+# Shared token that tells every worker its copy of the tree is stale
+TREE_VERSION_KEY = 'category-tree-version'
+
+_lock = threading.Lock()
+_tree = ()
+_tree_version = None
+
+
+def _build_tree():
+    children = {}
+    rows = {}
+    for pk, name, product_count, parent_id in Category.objects.order_by('pk').values_list('pk', 'name', 'product_count', 'category_parent_id').cached():
+        rows[pk] = (name, product_count)
+        children.setdefault(parent_id, []).append(pk)
+
+    def build_node(pk):
+        return CategoryNode(pk, *rows[pk], tuple(build_node(child) for child in children.get(pk, [])))
+
+    return tuple(build_node(pk) for pk in children.get(None, []))
+
+
+def get_category_tree():
+    """
+    Returns the root categories as immutable nodes, rebuilt only after a category changed.
+    """
+    global _tree, _tree_version
+
+    version = cache.get(TREE_VERSION_KEY)
+    if version is None:
+        cache.add(TREE_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(TREE_VERSION_KEY)
+
+    if version != _tree_version:
+        with _lock:
+            if version != _tree_version:
+                _tree = _build_tree()
+                _tree_version = version
+    return _tree
+
+
+def get_category_tree_version():
+    """
+    Returns the version of the tree get_category_tree returns, which the pages rendering it validate against.
+    """
+    get_category_tree()
+    return _tree_version
+
+
+def invalidate_category_counts():
+    cache.set(TREE_VERSION_KEY, uuid.uuid4().hex, None)
+    # Cached pages get the current counts spliced in when served, only the validators and the proxy need telling
+    purge_tags([CATEGORY_COUNTS_TAG])
+
+
+def invalidate_category_tree():
+    invalidate_category_counts()
+    # Every storefront page links the categories in its navbar
+    purge_tags([CATEGORY_TREE_TAG])
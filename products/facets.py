@@ -0,0 +1,241 @@
+import logging
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Exists, OuterRef, Q
+
+from .models import Category, Color, Product, Size, Stock
+
+
+# Price bands of the storefront price filter, the last one is open ended
+PRICE_BANDS = ((0, 100), (100, 200), (200, 300), (300, 400), (400, 500), (500, None))
+
+FACETS = ('category', 'price', 'size', 'color', 'available')
+
+# One checkbox of a facet group, with the number of products it would show
+FacetOption = namedtuple('FacetOption', ['value', 'label', 'count', 'checked'])
+FacetGroup = namedtuple('FacetGroup', ['name', 'title', 'options'])
+
+# Shared token that tells every worker its copy of the index is stale
+FACET_VERSION_KEY = 'facet-index-version'
+# Stock quantities change with every order, so a worker rebuilds at most this often (seconds)
+FACET_REBUILD_INTERVAL = 30
+
+logger = logging.getLogger(__name__)
+
+# Rebuilds run off the request thread, requests keep using the previous index meanwhile
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='facet-index')
+
+_lock = threading.Lock()
+_index = None
+_index_built_at = 0
+_rebuild_pending = False
+
+
+def _bitset(positions, size):
+    data = bytearray((size + 7) // 8)
+    for position in positions:
+        data[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(data, 'little')
+
+
+class FacetIndex:
+    """
+    Bitsets of the active products per facet value. Bit n stands for the n-th active product
+    by id, so a combination of filters is a few big integer ANDs and a count is a popcount.
+    The version is the catalog version the index was built for.
+    """
+    def __init__(self, version=None):
+        self.version = version
+        product_rows = list(Product.objects.filter(active=True).order_by('pk').values_list('pk', 'category_id', 'effective_price'))
+        self.positions = {pk: position for position, (pk, _, _) in enumerate(product_rows)}
+        size = len(product_rows)
+        self.all = (1 << size) - 1
+
+        self.categories = {}
+        self.children = {}
+        for pk, name, path, parent_id in Category.objects.order_by('pk').values_list('pk', 'name', 'path', 'category_parent_id').cached():
+            self.categories[pk] = (name, path)
+            self.children.setdefault(parent_id, []).append(pk)
+        self.sizes = list(Size.objects.filter(active=True).order_by('pk').values_list('pk', 'name').cached())
+        self.colors = list(Color.objects.filter(active=True).order_by('pk').values_list('pk', 'name').cached())
+
+        positions = {facet: {} for facet in FACETS}
+        for position, (pk, category_id, price) in enumerate(product_rows):
+            # A product counts for its category and every ancestor of it
+            if category_id in self.categories:
+                for ancestor_id in self.categories[category_id][1].split('/')[:-1]:
+                    positions['category'].setdefault(int(ancestor_id), []).append(position)
+            for band, (low, high) in enumerate(PRICE_BANDS):
+                if price >= low and (high is None or price < high):
+                    positions['price'].setdefault(band, []).append(position)
+
+        stock_rows = Stock.objects.filter(product__active=True).values_list('product_id', 'size_id', 'color_id', 'quantity')
+        for product_id, size_id, color_id, quantity in stock_rows.iterator():
+            position = self.positions.get(product_id)
+            if position is None:
+                # Activated after the products were read, it joins the index on the next rebuild
+                continue
+            positions['size'].setdefault(size_id, []).append(position)
+            positions['color'].setdefault(color_id, []).append(position)
+            if quantity > 0:
+                positions['available'].setdefault(1, []).append(position)
+
+        self.bitsets = {
+            facet: {value: _bitset(value_positions, size) for value, value_positions in values.items()}
+            for facet, values in positions.items()
+        }
+
+    def bits_for(self, product_ids):
+        return _bitset([self.positions[pk] for pk in product_ids if pk in self.positions], len(self.positions))
+
+    def category_bits(self, category_id):
+        return self.bitsets['category'].get(category_id, 0)
+
+    def parse_selection(self, params):
+        """
+        Reads the selected facet values from the query string, dropping values the index does not know.
+        """
+        known = {
+            'category': self.categories,
+            'price': range(len(PRICE_BANDS)),
+            'size': dict(self.sizes),
+            'color': dict(self.colors),
+            'available': (1,),
+        }
+        selection = {}
+        for facet in FACETS:
+            values = []
+            for value in params.getlist(facet):
+                try:
+                    value = int(value)
+                except ValueError:
+                    continue
+                if value in known[facet] and value not in values:
+                    values.append(value)
+            selection[facet] = values
+        return selection
+
+    def filter_products(self, products, selection):
+        """
+        Applies the selection to a product queryset in SQL, values of one facet are ORed and facets ANDed.
+        """
+        if selection['category']:
+            in_categories = Q()
+            for category_id in selection['category']:
+                in_categories |= Q(category__path__startswith=self.categories[category_id][1])
+            products = products.filter(in_categories)
+        if selection['price']:
+            in_bands = Q()
+            for band in selection['price']:
+                low, high = PRICE_BANDS[band]
+                in_bands |= Q(effective_price__gte=low) & (Q(effective_price__lt=high) if high is not None else Q())
+            products = products.filter(in_bands)
+        if selection['size']:
+            products = products.filter(Exists(Stock.objects.filter(product=OuterRef('pk'), size__in=selection['size'])))
+        if selection['color']:
+            products = products.filter(Exists(Stock.objects.filter(product=OuterRef('pk'), color__in=selection['color'])))
+        if selection['available']:
+            products = products.filter(Exists(Stock.objects.filter(product=OuterRef('pk'), quantity__gt=0)))
+        return products
+
+    def facet_groups(self, base, selection, category_id=None):
+        """
+        Returns the facet groups of a listing whose unfiltered products are the base bitset. Each
+        option counts the products it would show together with the selections of the other facets.
+        """
+        masks = {}
+        for facet, values in selection.items():
+            if values:
+                mask = 0
+                for value in values:
+                    mask |= self.bitsets[facet].get(value, 0)
+                masks[facet] = mask
+
+        def options(facet, choices):
+            others = base
+            for other, mask in masks.items():
+                if other != facet:
+                    others &= mask
+            bitsets = self.bitsets[facet]
+            return [
+                FacetOption(value, label, (bitsets.get(value, 0) & others).bit_count(), value in selection[facet])
+                for value, label in choices
+            ]
+
+        category_choices = [(pk, self.categories[pk][0]) for pk in self.children.get(category_id, [])]
+        price_choices = [
+            (band, '$%d - $%d' % (low, high) if high is not None else '$%d+' % low)
+            for band, (low, high) in enumerate(PRICE_BANDS)
+        ]
+        groups = [
+            FacetGroup('category', 'Filter by category', options('category', category_choices)),
+            FacetGroup('price', 'Filter by price', options('price', price_choices)),
+            FacetGroup('color', 'Filter by color', options('color', self.colors)),
+            FacetGroup('size', 'Filter by size', options('size', self.sizes)),
+            FacetGroup('available', 'Availability', options('available', [(1, 'In stock')])),
+        ]
+        return [group for group in groups if group.options]
+
+
+def _rebuild(version):
+    global _index, _index_built_at, _rebuild_pending
+    try:
+        index = FacetIndex(version)
+    except Exception:
+        logger.exception("Rebuilding the facet index failed, the previous one stays in use")
+        index = None
+    finally:
+        # Connections are per thread, one left open here would outlive the server's idle timeout
+        connections.close_all()
+    with _lock:
+        if index is not None:
+            _index = index
+        # A failed rebuild is retried after the interval as well
+        _index_built_at = time.monotonic()
+        _rebuild_pending = False
+
+
+def get_facet_index():
+    """
+    Returns this worker's facet index. Only the first one is built in the request, after a catalog
+    change a new one is built in the background, at most once per interval, and swapped in when ready.
+    A request should use the index it got throughout, the bit positions differ between indexes.
+    """
+    global _index, _index_built_at, _rebuild_pending
+
+    version = cache.get(FACET_VERSION_KEY)
+    if version is None:
+        cache.add(FACET_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(FACET_VERSION_KEY)
+
+    index = _index
+    if index is None:
+        with _lock:
+            if _index is None:
+                _index = FacetIndex(version)
+                _index_built_at = time.monotonic()
+            return _index
+
+    if version != index.version and time.monotonic() - _index_built_at >= FACET_REBUILD_INTERVAL:
+        with _lock:
+            if not _rebuild_pending and version != _index.version and time.monotonic() - _index_built_at >= FACET_REBUILD_INTERVAL:
+                _rebuild_pending = True
+                _executor.submit(_rebuild, version)
+    return index
+
+
+def facet_index_is_current(index):
+    """
+    Tells whether the index has caught up with the last catalog change.
+    """
+    return index.version == cache.get(FACET_VERSION_KEY)
+
+
+def invalidate_facet_index():
+    cache.set(FACET_VERSION_KEY, uuid.uuid4().hex, None)
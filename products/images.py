@@ -0,0 +1,145 @@
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import transaction
+from PIL import Image, ImageOps
+
+from .caching import purge_tags
+
+
+# Widths the admin tables, storefront cards and product page pick from, never upscaled
+VARIANT_WIDTHS = (80, 160, 320, 640, 960)
+# Extension, Pillow format and save options of each encoding, WebP first with JPEG as the fallback
+VARIANT_FORMATS = (
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    ('jpg', 'JPEG', {'quality': 80, 'optimize': True, 'progressive': True}),
+)
+VARIANT_ROOT = 'variants/'
+# Variants live at names derived from their original, outside the content addressing of uploads
+variant_storage = FileSystemStorage()
+# How long a missing manifest is remembered before storage is asked again (seconds)
+PENDING_TIMEOUT = 60
+
+logger = logging.getLogger(__name__)
+
+# Re-encoding is CPU bound, a couple of threads keep uploads from piling up without starving requests
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='image-variants')
+
+
+def variant_dir(name):
+    return VARIANT_ROOT + os.path.splitext(name)[0] + '/'
+
+
+def variant_name(name, width, extension):
+    return '%s%d.%s' % (variant_dir(name), width, extension)
+
+
+def _manifest_name(name):
+    return variant_dir(name) + 'manifest.json'
+
+
+def _cache_key(name):
+    return 'image-variants:' + hashlib.md5(name.encode()).hexdigest()
+
+
+def _flatten(image):
+    # JPEG has no alpha channel, transparent areas go white
+    if image.mode == 'RGBA':
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image
+
+
+def generate_variants(name, force=False):
+    """
+    Writes the resized WebP and JPEG variants of a stored image and returns their widths.
+    The manifest listing the widths is written last, so it only exists once every variant does.
+    """
+    manifest_name = _manifest_name(name)
+    if not force and variant_storage.exists(manifest_name):
+        with variant_storage.open(manifest_name) as manifest:
+            return json.load(manifest)['widths']
+
+    with default_storage.open(name, 'rb') as original:
+        image = Image.open(original)
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if image.mode in ('LA', 'P', 'PA') else 'RGB')
+
+    widths = [width for width in VARIANT_WIDTHS if width < image.width]
+    if image.width <= VARIANT_WIDTHS[-1]:
+        widths.append(image.width)
+
+    for width in widths:
+        resized = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        for extension, image_format, options in VARIANT_FORMATS:
+            buffer = BytesIO()
+            (_flatten(resized) if image_format == 'JPEG' else resized).save(buffer, image_format, **options)
+            path = variant_name(name, width, extension)
+            variant_storage.delete(path)
+            variant_storage.save(path, ContentFile(buffer.getvalue()))
+
+    variant_storage.delete(manifest_name)
+    variant_storage.save(manifest_name, ContentFile(json.dumps({'widths': widths}).encode()))
+    cache.set(_cache_key(name), widths, None)
+    return widths
+
+
+def get_variant_widths(name):
+    """
+    Returns the widths of an image's variants, empty while they are still being built.
+    """
+    widths = cache.get(_cache_key(name))
+    if widths is None:
+        try:
+            with variant_storage.open(_manifest_name(name)) as manifest:
+                widths = json.load(manifest)['widths']
+            cache.set(_cache_key(name), widths, None)
+        except (OSError, ValueError, KeyError):
+            widths = []
+            cache.set(_cache_key(name), widths, PENDING_TIMEOUT)
+    return widths
+
+
+def delete_variants(name):
+    directory = variant_dir(name)
+    try:
+        _, files = variant_storage.listdir(directory)
+    except OSError:
+        files = []
+    for file_name in files:
+        variant_storage.delete(directory + file_name)
+    forget_variant_widths(name)
+
+
+def forget_variant_widths(name):
+    cache.delete(_cache_key(name))
+
+
+def _build(name, tags):
+    try:
+        generate_variants(name)
+    except Exception:
+        logger.exception("Building the variants of %s failed", name)
+    else:
+        # Pages cached meanwhile still point at the original
+        purge_tags(tags)
+
+
+def schedule_variants(name, tags=()):
+    """
+    Builds the variants of a newly stored image in the background once the current transaction
+    commits, then purges the tags of the pages showing it.
+    """
+    if name and not get_variant_widths(name):
+        transaction.on_commit(partial(_executor.submit, _build, name, list(tags)))
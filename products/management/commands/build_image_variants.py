@@ -0,0 +1,30 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from accounts.models import CustomUser
+from ...models import Product
+from ...images import generate_variants
+
+class Command(BaseCommand):
+    help = "Build the resized variants of every product thumb and profile picture that has none yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Rebuild variants that already exist")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+
+    def handle(self, *args, **kwargs):
+        names = set(Product.objects.exclude(thumb='').exclude(thumb__isnull=True).values_list('thumb', flat=True))
+        names |= set(CustomUser.objects.exclude(profile_picture='').exclude(profile_picture__isnull=True).values_list('profile_picture', flat=True))
+
+        def build(name):
+            try:
+                generate_variants(name, force=kwargs['force'])
+                return True
+            except (OSError, ValueError) as e:
+                print("skipped " + name + ": " + str(e))
+                return False
+
+        with ThreadPoolExecutor(max_workers=kwargs['workers']) as executor:
+            built = sum(executor.map(build, sorted(names)))
+        print("built variants for " + str(built) + " of " + str(len(names)) + " images")
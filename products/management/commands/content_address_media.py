@@ -0,0 +1,57 @@
+import os
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from accounts.backends import invalidate_user_snapshot
+from accounts.models import CustomUser
+from ...caching import product_tags, purge_tags, require_shared_cache, seller_tag
+from ...images import schedule_variants
+from ...models import Product, StoredFile
+from ...sweeper import SWEEP_GRACE
+
+def page_tags(model, pks):
+    # update() sends no signals, so the pages showing the rows are purged here
+    if model is Product:
+        return product_tags(pks)
+    if model is CustomUser:
+        # Signed in users are served from a cached snapshot of their row as well
+        for pk in pks:
+            invalidate_user_snapshot(pk)
+        return {seller_tag(pk) for pk in pks}
+    return set()
+
+class Command(BaseCommand):
+    help = "Move images uploaded before content addressing to their content names, merging duplicates, and recount the references"
+
+    def handle(self, *args, **kwargs):
+        require_shared_cache()
+        moved = 0
+        tags = set()
+        for model, field_name in StoredFile.referencing_fields():
+            names = model.objects.exclude(**{field_name: ''}).exclude(**{field_name + '__isnull': True}).values_list(field_name, flat=True).distinct()
+            for name in list(names):
+                try:
+                    with default_storage.open(name, 'rb') as original:
+                        new_name = default_storage.save(name, original)
+                except OSError as e:
+                    print("skipped " + name + ": " + str(e))
+                    continue
+                if new_name != name:
+                    rows = model.objects.filter(**{field_name: name})
+                    pks = list(rows.values_list('pk', flat=True))
+                    rows.update(**{field_name: new_name})
+                    name_tags = page_tags(model, pks)
+                    tags |= name_tags
+                    # Variants live at names derived from the original, the pages show the new ones once built
+                    schedule_variants(new_name, name_tags)
+                    # Pages cached before the purge still link the old name, the media sweep
+                    # deletes it once the grace period counted from now is over
+                    os.utime(default_storage.path(name))
+                    moved += 1
+        purge_tags(tags)
+
+        created, changed = StoredFile.rebuild_ref_counts()
+        print(
+            "moved " + str(moved) + " images and recounted " + str(created + changed) + " files, sweep_media removes the old names after "
+            + str(SWEEP_GRACE // 60) + " minutes"
+        )
@@ -1,9 +1,11 @@
 from django.core.management.base import BaseCommand
+from ...caching import require_shared_cache
 from ...utils import generate_products
 
 class Command(BaseCommand):
     help = "Generate dummy data for books"
 
     def handle(self, *args, **kwargs):
+        require_shared_cache()
         generate_products(50)
         print("complete")
\ No newline at end of file
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from ...models import Code, CodeSummary
+
+class Command(BaseCommand):
+    help = "Rebuild the per-code inventory summaries from the current stocks"
+
+    def handle(self, *args, **kwargs):
+        count = 0
+        for code_id in Code.objects.values_list('id', flat=True).iterator():
+            CodeSummary.refresh(code_id)
+            count += 1
+        print("rebuilt " + str(count) + " code summaries")
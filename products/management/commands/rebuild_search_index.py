@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from ...models import Product
+from ...search import reindex_products
+
+class Command(BaseCommand):
+    help = "Rebuild the product search index from the current products"
+
+    def handle(self, *args, **kwargs):
+        product_ids = list(Product.objects.values_list('id', flat=True))
+        reindex_products(product_ids)
+        print("reindexed " + str(len(product_ids)) + " products")
@@ -0,0 +1,38 @@
+import os
+
+from django.core.management.base import BaseCommand
+from ...caching import require_shared_cache
+from ...sweeper import SWEEP_BATCH, SWEEP_GRACE, SWEEP_PAUSE, sweep_media
+from ...uploads import clear_expired_uploads
+
+class Command(BaseCommand):
+    help = "Delete the files in MEDIA_ROOT that no image field references, in batches, or only report them with --dry-run"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="List the unreferenced files without deleting them")
+        parser.add_argument('--grace', type=int, default=SWEEP_GRACE, help="Seconds a file must be left unmodified before it is swept")
+        parser.add_argument('--batch-size', type=int, default=SWEEP_BATCH)
+        parser.add_argument('--pause', type=float, default=SWEEP_PAUSE, help="Seconds to wait between batches")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+
+    def handle(self, *args, **kwargs):
+        if not kwargs['dry_run']:
+            # Deleted variants are forgotten in the cache
+            require_shared_cache()
+        report = sweep_media(
+            dry_run=kwargs['dry_run'], grace=kwargs['grace'], batch_size=kwargs['batch_size'],
+            pause=kwargs['pause'], workers=kwargs['workers'],
+        )
+        if kwargs['dry_run']:
+            for media_file in report.orphans:
+                print(media_file.name + " (" + str(media_file.size) + " bytes)")
+            print(
+                "scanned " + str(report.scanned) + " files against " + str(report.referenced) + " referenced, "
+                + str(len(report.orphans)) + " unreferenced (" + str(sum(media_file.size for media_file in report.orphans)) + " bytes) would be deleted"
+            )
+        else:
+            print("cleared " + str(clear_expired_uploads()) + " expired chunked uploads")
+            print(
+                "scanned " + str(report.scanned) + " files against " + str(report.referenced) + " referenced, deleted "
+                + str(report.deleted) + " of " + str(len(report.orphans)) + " unreferenced (" + str(report.reclaimed) + " bytes reclaimed)"
+            )
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:48
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0024_alter_stock_code'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CodeSummary',
+            fields=[
+                ('code', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='products.code')),
+                ('total_quantity', models.IntegerField(default=0)),
+                ('min_price', models.FloatField(default=0)),
+                ('max_price', models.FloatField(default=0)),
+                ('all_active', models.BooleanField(default=True)),
+                ('variant_count', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('seller', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:50
+
+from django.db import migrations, models
+
+
+def build_category_paths(apps, schema_editor):
+    Category = apps.get_model('products', 'Category')
+    categories = list(Category.objects.all())
+    children = {}
+    for category in categories:
+        children.setdefault(category.category_parent_id, []).append(category)
+
+    pending = [(category, '', -1, '') for category in children.get(None, [])]
+    while pending:
+        category, parent_path, parent_depth, parent_full_path = pending.pop()
+        category.path = parent_path + str(category.pk) + '/'
+        category.depth = parent_depth + 1
+        category.full_path = parent_full_path + ' / ' + category.name if parent_full_path else category.name
+        pending.extend((child, category.path, category.depth, category.full_path) for child in children.get(category.pk, []))
+
+    Category.objects.bulk_update(categories, ['path', 'depth', 'full_path'], batch_size=500)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0025_codesummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='depth',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='full_path',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=255),
+        ),
+        migrations.RunPython(build_category_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:51
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_effective_prices(apps, schema_editor):
+    Discount = apps.get_model('products', 'Discount')
+    Product = apps.get_model('products', 'Product')
+    Product.objects.update(effective_price=F('price'))
+    for discount in Discount.objects.all():
+        discount_factor = 1 - (discount.discount_percent / 100)
+        Product.objects.filter(discount=discount).update(effective_price=F('price') * discount_factor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0026_category_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='effective_price',
+            field=models.FloatField(db_index=True, default=0, editable=False),
+        ),
+        migrations.RunPython(fill_effective_prices, migrations.RunPython.noop),
+    ]
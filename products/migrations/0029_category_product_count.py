@@ -0,0 +1,38 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:53
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_category_products(apps, schema_editor):
+    Category = apps.get_model('products', 'Category')
+    Product = apps.get_model('products', 'Product')
+    direct_counts = dict(
+        Product.objects.filter(active=True, category__isnull=False)
+        .order_by().values_list('category').annotate(count=Count('pk'))
+    )
+    categories = list(Category.objects.all())
+    totals = dict.fromkeys((category.pk for category in categories), 0)
+    for category in categories:
+        for ancestor_id in category.path.split('/')[:-1]:
+            if int(ancestor_id) in totals:
+                totals[int(ancestor_id)] += direct_counts.get(category.pk, 0)
+    for category in categories:
+        category.product_count = totals[category.pk]
+    Category.objects.bulk_update(categories, ['product_count'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0028_product_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='product_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_category_products, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.0.3 on 2026-10-18 18:24
+
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_file_references(apps, schema_editor):
+    StoredFile = apps.get_model('products', 'StoredFile')
+    counts = {}
+    for app_label, model_name, field_name in (('products', 'Product', 'thumb'), ('accounts', 'CustomUser', 'profile_picture')):
+        rows = apps.get_model(app_label, model_name).objects.exclude(**{field_name: ''}).exclude(**{field_name + '__isnull': True})
+        for name, count in rows.order_by().values_list(field_name).annotate(count=Count('pk')):
+            counts[name] = counts.get(name, 0) + count
+    StoredFile.objects.bulk_create([
+        StoredFile(name=name, size=default_storage.size(name) if default_storage.exists(name) else 0, ref_count=count)
+        for name, count in counts.items()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('products', '0030_searchtoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.BigIntegerField(default=0)),
+                ('ref_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(count_file_references, migrations.RunPython.noop),
+    ]
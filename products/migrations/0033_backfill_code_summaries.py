@@ -0,0 +1,45 @@
+from django.db import migrations
+from django.db.models import Count, Max, Min, Q, Sum
+
+
+def build_code_summaries(apps, schema_editor):
+    Code = apps.get_model('products', 'Code')
+    CodeSummary = apps.get_model('products', 'CodeSummary')
+    Stock = apps.get_model('products', 'Stock')
+    existing = set(CodeSummary.objects.values_list('code_id', flat=True))
+    stats = (
+        Stock.objects.filter(code__isnull=False).order_by().values('code')
+        .annotate(
+            total_quantity=Sum('quantity'),
+            min_price=Min('product__effective_price'),
+            max_price=Max('product__effective_price'),
+            variant_count=Count('pk'),
+            inactive_count=Count('pk', filter=Q(product__active=False)),
+            seller=Min('product__seller'),
+        )
+    )
+    by_code = {row['code']: row for row in stats}
+    summaries = []
+    for code_id in Code.objects.exclude(pk__in=existing).values_list('pk', flat=True):
+        row = by_code.get(code_id, {})
+        summaries.append(CodeSummary(
+            code_id=code_id,
+            seller_id=row.get('seller'),
+            total_quantity=row.get('total_quantity') or 0,
+            min_price=row.get('min_price') or 0,
+            max_price=row.get('max_price') or 0,
+            all_active=row.get('inactive_count', 0) == 0,
+            variant_count=row.get('variant_count', 0),
+        ))
+    CodeSummary.objects.bulk_create(summaries, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0032_chunkedupload'),
+    ]
+
+    operations = [
+        migrations.RunPython(build_code_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+from collections import defaultdict
+
+from django.db import migrations
+
+# The tokens must match what queries are split into, so the search module's own rules are used
+from products.search import FIELD_WEIGHTS, tokenize
+
+
+def build_search_tokens(apps, schema_editor):
+    Product = apps.get_model('products', 'Product')
+    SearchToken = apps.get_model('products', 'SearchToken')
+    Stock = apps.get_model('products', 'Stock')
+    indexed = set(SearchToken.objects.values_list('product_id', flat=True).distinct())
+    product_ids = sorted(set(Product.objects.values_list('pk', flat=True)) - indexed)
+    for start in range(0, len(product_ids), 500):
+        batch = product_ids[start:start + 500]
+
+        variants = defaultdict(lambda: (set(), set()))
+        for product_id, color, size in Stock.objects.filter(product__in=batch).values_list('product_id', 'color__name', 'size__name'):
+            variants[product_id][0].add(color)
+            variants[product_id][1].add(size)
+
+        tokens = []
+        for product in Product.objects.filter(pk__in=batch).select_related('category'):
+            colors, sizes = variants[product.pk]
+            fields = {
+                'name': product.name,
+                'category': (product.category.full_path or product.category.name) if product.category else '',
+                'color': ' '.join(sorted(colors)),
+                'size': ' '.join(sorted(sizes)),
+                'short_desc': product.short_desc,
+                'long_desc': product.long_desc,
+            }
+            weights = defaultdict(int)
+            for field, text in fields.items():
+                for token in set(tokenize(text)):
+                    weights[token] += FIELD_WEIGHTS[field]
+            tokens.extend(SearchToken(token=token, product_id=product.pk, weight=weight) for token, weight in weights.items())
+        SearchToken.objects.bulk_create(tokens, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0033_backfill_code_summaries'),
+    ]
+
+    operations = [
+        migrations.RunPython(build_search_tokens, migrations.RunPython.noop),
+    ]
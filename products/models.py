@@ -1,9 +1,15 @@
-from django.db import models
-from django.db.models import Min, Max
-import os
+from django.apps import apps
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
+from django.db.models import Count, F, Min, Max, Q, Sum
+from functools import partial
+import uuid
 
 from accounts.models import CustomUser
 
+from .querycache import CachedQuerySet
+
 # Create your models here.
 
 # Discount Model
@@ -15,8 +21,31 @@ class Discount(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CachedQuerySet.as_manager()
+
     def __str__(self):
         return self.name
+
+    def update_product_prices(self):
+        """
+        Recomputes the effective price of every product using this discount.
+        """
+        discount_factor = 1 - (self.discount_percent / 100)
+        self.product_set.update(effective_price=F('price') * discount_factor, updated_at=timezone.now())
+
+    def detach_products(self):
+        """
+        Removes this discount from every product using it, refreshes the affected code summaries
+        and purges the pages showing those products.
+        """
+        # caching imports the models
+        from .caching import discount_tags, schedule_purge
+
+        # Collected first, the products are only found through the discount until the update
+        schedule_purge(discount_tags(self))
+        code_ids = set(Stock.objects.filter(product__discount=self).values_list('code_id', flat=True))
+        self.product_set.update(discount=None, effective_price=F('price'), updated_at=timezone.now())
+        CodeSummary.schedule_refresh(code_ids)
     
 # Category Model
 class Category(models.Model):
@@ -24,35 +53,115 @@ class Category(models.Model):
     category_parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children')
     description = models.CharField(max_length=250, null=True, blank=True)
     active = models.BooleanField(default=False)
+    # Materialized path of ancestor ids ("1/4/9/"), kept in sync on save
+    path = models.CharField(max_length=255, db_index=True, blank=True, editable=False)
+    depth = models.IntegerField(default=0, editable=False)
+    full_path = models.TextField(blank=True, editable=False)
+    # Active products in this category and all of its descendants
+    product_count = models.IntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CachedQuerySet.as_manager()
+
     def __str__(self):
         return self.get_full_path()
-    
+
+    def save(self, *args, **kwargs):
+        # One transaction so the subtree never shows a half-moved path
+        with transaction.atomic():
+            previous = None
+            if self.pk:
+                previous = Category.objects.filter(pk=self.pk).values('path', 'depth', 'full_path').first()
+
+            if previous:
+                self._set_path()
+                # Renamed or reparented, so the subtree below has to follow
+                self._subtree_moved = bool(previous['path']) and previous['path'] != self.path
+                self._full_path_changed = previous['full_path'] != self.full_path
+                if 'update_fields' not in kwargs:
+                    # product_count is maintained with F() updates, never write back a stale copy of it
+                    kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields if not field.primary_key and field.name != 'product_count']
+                super(Category, self).save(*args, **kwargs)
+            else:
+                # The path ends with our own id, which only exists after the insert
+                super(Category, self).save(*args, **kwargs)
+                self._set_path()
+                Category.objects.filter(pk=self.pk).update(path=self.path, depth=self.depth, full_path=self.full_path)
+
+            if previous and previous['path'] and (previous['path'], previous['full_path']) != (self.path, self.full_path):
+                descendants = list(Category.objects.filter(path__startswith=previous['path']).exclude(pk=self.pk))
+                for descendant in descendants:
+                    descendant.path = self.path + descendant.path[len(previous['path']):]
+                    descendant.depth = descendant.depth - previous['depth'] + self.depth
+                    descendant.full_path = self.full_path + descendant.full_path[len(previous['full_path']):]
+                Category.objects.bulk_update(descendants, ['path', 'depth', 'full_path'], batch_size=500)
+
+    def _set_path(self):
+        parent = self.category_parent
+        if parent is not None:
+            self.path = parent.path + str(self.pk) + '/'
+            self.depth = parent.depth + 1
+            self.full_path = parent.full_path + ' / ' + self.name
+        else:
+            self.path = str(self.pk) + '/'
+            self.depth = 0
+            self.full_path = self.name
+
     def get_full_path(self):
-        path = [self.name]
-        current_category = self
-        while current_category.category_parent:
-            current_category = current_category.category_parent
-            path.insert(0, current_category.name)
-        return ' / '.join(path)
-    
+        return self.full_path or self.name
+
+    def get_ancestors_ids(self):
+        """
+        Returns the IDs of all ancestors of this category from the root down, excluding itself.
+        """
+        return [int(pk) for pk in self.path.split('/')[:-2]]
+
+    def get_ancestors(self):
+        return Category.objects.filter(pk__in=self.get_ancestors_ids()).order_by('depth')
+
+    def get_descendants(self):
+        """
+        Returns a queryset of all descendants of this category, including itself.
+        """
+        return Category.objects.filter(path__startswith=self.path)
+
     def get_descendants_ids(self):
         """
         Returns a set of IDs of all descendants of this category, including itself.
         """
-        descendants_ids = set()
-        self._collect_descendants_ids(descendants_ids)
-        return descendants_ids
+        return set(self.get_descendants().values_list('pk', flat=True))
+
+    @classmethod
+    def adjust_product_count(cls, category_id, delta):
+        """
+        Adds delta to the product count of a category and every ancestor of it.
+        """
+        path = cls.objects.filter(pk=category_id).values_list('path', flat=True).first()
+        if path:
+            cls.objects.filter(pk__in=path.split('/')[:-1]).update(product_count=F('product_count') + delta)
 
-    def _collect_descendants_ids(self, descendants_ids):
+    @classmethod
+    def rebuild_product_counts(cls):
         """
-        Recursively collects the IDs of all descendants of this category, including itself.
+        Recomputes every rolled-up product count from scratch, used after deletes and moves in the tree.
         """
-        descendants_ids.add(self.pk)
-        for child in Category.objects.filter(category_parent=self):
-            child._collect_descendants_ids(descendants_ids)
+        direct_counts = dict(
+            Product.objects.filter(active=True, category__isnull=False)
+            .order_by().values_list('category').annotate(count=Count('pk'))
+        )
+        categories = list(cls.objects.only('pk', 'path', 'product_count'))
+        totals = dict.fromkeys((category.pk for category in categories), 0)
+        for category in categories:
+            count = direct_counts.get(category.pk, 0)
+            if count:
+                for ancestor_id in category.path.split('/')[:-1]:
+                    if int(ancestor_id) in totals:
+                        totals[int(ancestor_id)] += count
+        changed = [category for category in categories if category.product_count != totals[category.pk]]
+        for category in changed:
+            category.product_count = totals[category.pk]
+        cls.objects.bulk_update(changed, ['product_count'], batch_size=500)
 
 
 # Product Size Model
@@ -62,6 +171,8 @@ class Size(models.Model):
     active = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    objects = CachedQuerySet.as_manager()
     
     def __str__(self):
         return self.name
@@ -74,6 +185,8 @@ class Color(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CachedQuerySet.as_manager()
+
     def __str__(self):
         return self.name
     
@@ -84,9 +197,24 @@ class Code(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CachedQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
+    @property
+    def current_summary(self):
+        """
+        The summary row of the code, built on the spot for a code that has none yet.
+        """
+        try:
+            return self.summary
+        except CodeSummary.DoesNotExist:
+            summary = CodeSummary.refresh(self.pk)
+            if summary is not None:
+                self.summary = summary
+            return summary
+
 # Product Model
 class Product(models.Model):
     SKU = models.CharField(max_length=50, null=True, blank=True)
@@ -100,17 +228,23 @@ class Product(models.Model):
     category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True)
     discount = models.ForeignKey(Discount, on_delete=models.SET_NULL, null=True, blank=True)
     price = models.FloatField()
+    # Price after discount, kept in sync so listings can sort and filter on it
+    effective_price = models.FloatField(default=0, db_index=True, editable=False)
     active = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
-    def delete(self, *args, **kwargs):
-        # Remove the associated image file from the file system
-        if self.thumb:
-            if os.path.isfile(self.thumb.path):
-                os.remove(self.thumb.path)
-        
-        super(Product, self).delete(*args, **kwargs)
+    class Meta:
+        # Storefront listings filter on active and seek on one of the sort keys
+        indexes = [
+            models.Index(fields=['active', 'created_at']),
+            models.Index(fields=['active', 'effective_price']),
+            models.Index(fields=['active', 'name']),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.effective_price = self.discounted_price
+        super(Product, self).save(*args, **kwargs)
 
     @property
     def discounted_price(self):
@@ -124,6 +258,16 @@ class Product(models.Model):
         return self.name
     
 
+class StockQuerySet(models.QuerySet):
+    def representatives(self):
+        """
+        Returns one stock per code (the first one added), grouped and ordered by the database
+        so it can be paginated with LIMIT/OFFSET.
+        """
+        first_ids = self.order_by().values('code').annotate(first_id=Min('pk')).values('first_id')
+        return self.filter(pk__in=first_ids).order_by('pk')
+
+
 # Stock Model
 class Stock(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
@@ -132,40 +276,172 @@ class Stock(models.Model):
     code = models.ForeignKey(Code, on_delete=models.CASCADE)
     quantity = models.IntegerField(default=0)
 
+    objects = StockQuerySet.as_manager()
+
+    def __int__(self):
+        return self.quantity
+
+
+# Product Code Summary Model
+class CodeSummary(models.Model):
+    code = models.OneToOneField(Code, on_delete=models.CASCADE, primary_key=True, related_name='summary')
+    seller = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True, blank=True)
+    total_quantity = models.IntegerField(default=0)
+    min_price = models.FloatField(default=0)
+    max_price = models.FloatField(default=0)
+    all_active = models.BooleanField(default=True)
+    variant_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.code_id)
+
     @classmethod
-    def calculate_total_quantity(cls, code_value):
-        total_quantity = 0
-        stocks = cls.objects.filter(code=code_value)
-        for stock_item in stocks:
-            total_quantity += stock_item.quantity
-        return total_quantity
-    
+    def refresh(cls, code_id):
+        """
+        Recomputes the summary row of a code with a single aggregate query over its stocks.
+        """
+        if not Code.objects.filter(pk=code_id).exists():
+            return None
+
+        stats = Stock.objects.filter(code_id=code_id).aggregate(
+            total_quantity=Sum('quantity'),
+            min_price=Min('product__effective_price'),
+            max_price=Max('product__effective_price'),
+            variant_count=Count('pk'),
+            inactive_count=Count('pk', filter=Q(product__active=False)),
+            seller=Min('product__seller'),
+        )
+        summary, _ = cls.objects.update_or_create(code_id=code_id, defaults={
+            'seller_id': stats['seller'],
+            'total_quantity': stats['total_quantity'] or 0,
+            'min_price': stats['min_price'] or 0,
+            'max_price': stats['max_price'] or 0,
+            'all_active': stats['inactive_count'] == 0,
+            'variant_count': stats['variant_count'],
+        })
+        return summary
+
     @classmethod
-    def get_price_range(cls, code_value):
-        products = Product.objects.filter(stock__code=code_value)
-        if products.exists():
-            min_price = min(product.discounted_price for product in products)
-            max_price = max(product.discounted_price for product in products)
-        else:
-            min_price = 0
-            max_price = 0
-        return min_price, max_price
-    
+    def schedule_refresh(cls, code_ids):
+        """
+        Refreshes the given codes once the current transaction commits.
+        """
+        for code_id in set(code_ids):
+            if code_id is not None:
+                transaction.on_commit(partial(cls.refresh, code_id))
+
+
+# Product Search Index Model
+class SearchToken(models.Model):
+    token = models.CharField(max_length=64)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='search_tokens')
+    # Sum of the weights of the fields the token appears in
+    weight = models.IntegerField(default=1)
+
+    class Meta:
+        # Exact and prefix lookups range-scan the token and read product and weight from the index
+        indexes = [
+            models.Index(fields=['token', 'product', 'weight']),
+        ]
+
+    def __str__(self):
+        return self.token
+
+
+# Uploaded File Model
+class StoredFile(models.Model):
+    # Uploads are stored once per content, the count says how many rows use the file
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField(default=0)
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
     @classmethod
-    def check_all_active(cls, code_value):
-        stocks_1 = cls.objects.filter(code=code_value)
-        for stock in stocks_1:
-            if stock.product.active == False:
-                return False
-            
-        return True
-            
-    
-    def __int__(self):
-        return self.quantity
-    
+    def referencing_fields(cls):
+        """
+        Returns the (model, field name) of every file field pointing into the media storage.
+        """
+        return [
+            (model, field.name)
+            for model in apps.get_models()
+            for field in model._meta.concrete_fields
+            if isinstance(field, models.FileField)
+        ]
+
+    @classmethod
+    def retain(cls, name):
+        """
+        Counts one more reference to a stored file, registering it on its first reference.
+        """
+        if cls.objects.filter(name=name).update(ref_count=F('ref_count') + 1):
+            return
+        size = default_storage.size(name) if default_storage.exists(name) else 0
+        try:
+            with transaction.atomic():
+                cls.objects.create(name=name, size=size, ref_count=1)
+        except IntegrityError:
+            cls.objects.filter(name=name).update(ref_count=F('ref_count') + 1)
 
+    @classmethod
+    def release(cls, name):
+        """
+        Counts one reference less to a stored file. Returns whether it is registered, files
+        stored before content addressing are not and have no count to drop.
+        """
+        return bool(cls.objects.filter(name=name).update(ref_count=F('ref_count') - 1))
+
+    @classmethod
+    def rebuild_ref_counts(cls):
+        """
+        Recounts the references of every stored file from the file fields, registering the ones
+        in use and dropping the counts of the ones no longer referenced to zero.
+        """
+        counts = {}
+        for model, field_name in cls.referencing_fields():
+            rows = model.objects.exclude(**{field_name: ''}).exclude(**{field_name + '__isnull': True})
+            for name, count in rows.order_by().values_list(field_name).annotate(count=Count('pk')):
+                counts[name] = counts.get(name, 0) + count
+
+        stored = {stored_file.name: stored_file for stored_file in cls.objects.all()}
+        created, changed = [], []
+        for name, count in counts.items():
+            stored_file = stored.get(name)
+            if stored_file is None:
+                size = default_storage.size(name) if default_storage.exists(name) else 0
+                created.append(cls(name=name, size=size, ref_count=count))
+            elif stored_file.ref_count != count:
+                stored_file.ref_count = count
+                changed.append(stored_file)
+        for name, stored_file in stored.items():
+            if name not in counts and stored_file.ref_count != 0:
+                stored_file.ref_count = 0
+                changed.append(stored_file)
+        cls.objects.bulk_create(created, batch_size=500)
+        cls.objects.bulk_update(changed, ['ref_count'], batch_size=500)
+        return len(created), len(changed)
 
 
+# Chunked Upload Model
+class ChunkedUpload(models.Model):
+    # An image sent in parts, received says where the next part starts
+    upload_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='uploads')
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    # Storage name once every part arrived and the image checked out
+    stored_name = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
+    def __str__(self):
+        return self.filename
 
+    @property
+    def complete(self):
+        return bool(self.stored_name)
@@ -0,0 +1,116 @@
+import hashlib
+
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+from .caching import get_or_compute
+
+
+COUNT_KEY_PREFIX = 'page-count:'
+# Counts are dropped when one of the paginator's tags is purged, the timeout bounds the rest
+COUNT_CACHE_TIMEOUT = 10 * 60
+# Table statistics are only trusted past this many rows, below it an exact count is cheap enough
+APPROXIMATE_COUNT_THRESHOLD = 100000
+ESTIMATE_CACHE_TIMEOUT = 5 * 60
+
+
+def estimate_table_rows(model):
+    """
+    Returns the row estimate the database keeps for the model's table, None where there is none.
+    """
+    connection = connections[model.objects.db]
+    table = model._meta.db_table
+    if connection.vendor == 'mysql':
+        sql = 'SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s'
+    elif connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)'
+    else:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None and row[0] >= 0 else None
+
+
+class CountedPage(Page):
+    def has_next(self):
+        if self.paginator.approximate:
+            return self._has_more
+        return super(CountedPage, self).has_next()
+
+    # A page past an estimated count can come back empty
+    def start_index(self):
+        if self.paginator.approximate:
+            return (self.number - 1) * self.paginator.per_page + 1 if self.object_list else 0
+        return super(CountedPage, self).start_index()
+
+    def end_index(self):
+        if self.paginator.approximate:
+            return (self.number - 1) * self.paginator.per_page + len(self.object_list) if self.object_list else 0
+        return super(CountedPage, self).end_index()
+
+    @property
+    def elided_page_range(self):
+        return self.paginator.get_elided_page_range(self.number)
+
+
+class CachedCountPaginator(Paginator):
+    """
+    Paginator that caches its COUNT(*) per query until one of count_tags is purged. Given an
+    estimate_model whose table has about as many rows as the unfiltered object list, a large
+    enough estimate from the table statistics stands in for the count. approximate is then set,
+    and whether there is a next page comes from the rows rather than the estimate.
+    """
+    def __init__(self, object_list, per_page, count_tags=(), estimate_model=None, **kwargs):
+        super(CachedCountPaginator, self).__init__(object_list, per_page, **kwargs)
+        self.count_tags = list(count_tags)
+        self.estimate_model = estimate_model
+
+    @cached_property
+    def estimate(self):
+        model = self.estimate_model
+        if model is None:
+            return None
+        estimate = get_or_compute('table-estimate:' + model._meta.db_table, lambda: estimate_table_rows(model), ESTIMATE_CACHE_TIMEOUT)
+        return estimate if estimate is not None and estimate >= APPROXIMATE_COUNT_THRESHOLD else None
+
+    @property
+    def approximate(self):
+        return self.estimate is not None
+
+    @cached_property
+    def count(self):
+        if self.approximate:
+            return self.estimate
+        return get_or_compute(self._count_key(), self.object_list.count, COUNT_CACHE_TIMEOUT, self.count_tags)
+
+    def _count_key(self):
+        sql, params = self.object_list.query.get_compiler(using=self.object_list.db).as_sql()
+        return COUNT_KEY_PREFIX + hashlib.md5(('%s\n%r' % (sql, params)).encode()).hexdigest()
+
+    def validate_number(self, number):
+        if not self.approximate:
+            return super(CachedCountPaginator, self).validate_number(number)
+        # Pages past the estimate may still hold rows
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(self.error_messages['invalid_page'])
+        if number < 1:
+            raise EmptyPage(self.error_messages['min_page'])
+        return number
+
+    def page(self, number):
+        if not self.approximate:
+            return super(CachedCountPaginator, self).page(number)
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        # One row more than the page tells whether there is a next one
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        page = self._get_page(rows[:self.per_page], number, self)
+        page._has_more = len(rows) > self.per_page
+        return page
+
+    def _get_page(self, *args, **kwargs):
+        return CountedPage(*args, **kwargs)
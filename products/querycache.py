@@ -0,0 +1,122 @@
+import hashlib
+import uuid
+
+from django.apps import apps
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db import models, transaction
+
+
+QUERY_KEY_PREFIX = 'query:'
+TABLE_VERSION_PREFIX = 'table-version:'
+# A version bump makes old results unreachable, the timeout only bounds how long they linger
+QUERY_CACHE_TIMEOUT = 60 * 60
+
+_tables = None
+
+
+def _versioned_tables():
+    """
+    Returns the tables whose writes bump a version, the ones of models managed by a CachedQuerySet.
+    """
+    global _tables
+    if _tables is None:
+        _tables = frozenset(
+            model._meta.db_table for model in apps.get_models()
+            if issubclass(model._default_manager._queryset_class, CachedQuerySet)
+        )
+    return _tables
+
+
+def get_table_versions(tables):
+    keys = {TABLE_VERSION_PREFIX + table: table for table in tables}
+    versions = cache.get_many(keys)
+    for key in keys.keys() - versions.keys():
+        cache.add(key, uuid.uuid4().hex, None)
+        versions[key] = cache.get(key)
+    return {keys[key]: value for key, value in versions.items()}
+
+
+def bump_table_versions(tables):
+    """
+    Gives the tables a new version, which turns every cached result read from them into a miss.
+    Bumped again on commit, so a result cached from the rows the transaction is replacing does not survive it.
+    """
+    tables = set(tables)
+    if tables:
+        def bump():
+            cache.set_many({TABLE_VERSION_PREFIX + table: uuid.uuid4().hex for table in tables}, None)
+        bump()
+        transaction.on_commit(bump)
+
+
+def bump_model_version(model):
+    bump_table_versions([model._meta.db_table])
+
+
+class CachedQuerySet(models.QuerySet):
+    """
+    QuerySet with an opt-in result cache: qs.cached() is evaluated once per distinct SQL and
+    served from the cache until one of the tables it reads is written to. Writes through this
+    queryset and the save/delete signals of the model bump the table version. Only the tables
+    of the FROM clause and its joins are tracked, so subqueries are never cached, and neither
+    are queries joining a table of a model without this queryset.
+    """
+    def __init__(self, *args, **kwargs):
+        super(CachedQuerySet, self).__init__(*args, **kwargs)
+        self._cache_timeout = None
+
+    def cached(self, timeout=QUERY_CACHE_TIMEOUT):
+        clone = self._chain()
+        clone._cache_timeout = timeout
+        return clone
+
+    def _clone(self):
+        clone = super(CachedQuerySet, self)._clone()
+        clone._cache_timeout = self._cache_timeout
+        return clone
+
+    def _fetch_all(self):
+        if self._cache_timeout is not None and self._result_cache is None:
+            key = self._result_key()
+            if key is not None:
+                results = cache.get(key)
+                if results is None:
+                    results = list(self._iterable_class(self))
+                    cache.set(key, results, self._cache_timeout)
+                self._result_cache = results
+        super(CachedQuerySet, self)._fetch_all()
+
+    def _result_key(self):
+        try:
+            sql, params = self.query.get_compiler(using=self.db).as_sql()
+        except EmptyResultSet:
+            return None
+        tables = {join.table_name for join in self.query.alias_map.values()}
+        # Tables read by a subquery are not in the alias map, so those results would never be invalidated
+        if not tables or not tables <= _versioned_tables() or '(SELECT ' in sql.upper():
+            return None
+
+        versions = get_table_versions(sorted(tables))
+        # The same SQL gives model instances, dicts or tuples depending on the iterable class
+        parts = [self.db, self._iterable_class.__name__, repr(self._fields), sql, repr(params)]
+        parts.extend('%s=%s' % item for item in sorted(versions.items()))
+        return QUERY_KEY_PREFIX + hashlib.md5('\n'.join(parts).encode()).hexdigest()
+
+    def update(self, **kwargs):
+        rows = super(CachedQuerySet, self).update(**kwargs)
+        bump_model_version(self.model)
+        return rows
+    update.alters_data = True
+
+    def bulk_create(self, *args, **kwargs):
+        objs = super(CachedQuerySet, self).bulk_create(*args, **kwargs)
+        bump_model_version(self.model)
+        return objs
+
+    def delete(self):
+        result = super(CachedQuerySet, self).delete()
+        bump_model_version(self.model)
+        return result
+    delete.alters_data = True
+    delete.queryset_only = True
@@ -0,0 +1,74 @@
+import threading
+import uuid
+
+from django.core.cache import cache
+
+from .models import Code, Color, Discount, Size
+
+
+# Shared token that tells every worker its snapshot is stale
+REFERENCE_VERSION_KEY = 'reference-data-version'
+
+_lock = threading.Lock()
+_snapshot = None
+_snapshot_version = None
+
+
+class ReferenceData:
+    """
+    Snapshot of the sizes, colors, codes and discounts the product forms choose from. The
+    lookups validate a submitted id against the snapshot and raise the model's DoesNotExist
+    like objects.get does. The instances are shared, read them but never save them. The rows
+    come from the query cache, so only the first worker to rebuild after a change reads the tables.
+    """
+    def __init__(self):
+        self.sizes = tuple(Size.objects.order_by('pk').cached())
+        self.colors = tuple(Color.objects.order_by('pk').cached())
+        self.codes = tuple(Code.objects.order_by('pk').cached())
+        self.discounts = tuple(Discount.objects.order_by('pk').cached())
+        self.active_discounts = tuple(Discount.objects.filter(active=True).order_by('pk').cached())
+        self._by_id = {
+            model: {obj.pk: obj for obj in objs}
+            for model, objs in ((Size, self.sizes), (Color, self.colors), (Code, self.codes), (Discount, self.discounts))
+        }
+
+    def _get(self, model, pk):
+        try:
+            return self._by_id[model][int(pk)]
+        except (KeyError, TypeError, ValueError):
+            raise model.DoesNotExist('%s matching id %r does not exist.' % (model._meta.object_name, pk))
+
+    def size(self, pk):
+        return self._get(Size, pk)
+
+    def color(self, pk):
+        return self._get(Color, pk)
+
+    def code(self, pk):
+        return self._get(Code, pk)
+
+    def discount(self, pk):
+        return self._get(Discount, pk)
+
+
+def get_reference_data():
+    """
+    Returns this worker's reference data snapshot, rebuilt only after one of its tables changed.
+    """
+    global _snapshot, _snapshot_version
+
+    version = cache.get(REFERENCE_VERSION_KEY)
+    if version is None:
+        cache.add(REFERENCE_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(REFERENCE_VERSION_KEY)
+
+    if version != _snapshot_version:
+        with _lock:
+            if version != _snapshot_version:
+                _snapshot = ReferenceData()
+                _snapshot_version = version
+    return _snapshot
+
+
+def invalidate_reference_data():
+    cache.set(REFERENCE_VERSION_KEY, uuid.uuid4().hex, None)
@@ -0,0 +1,135 @@
+import re
+import unicodedata
+from collections import defaultdict
+from functools import partial
+
+from django.db import transaction
+from django.db.models import Case, Count, IntegerField, Q, Sum, Value, When
+
+from .models import Product, SearchToken, Stock
+
+
+# How much a match in each indexed field counts towards the rank
+FIELD_WEIGHTS = {
+    'name': 8,
+    'category': 4,
+    'color': 3,
+    'size': 3,
+    'short_desc': 2,
+    'long_desc': 1,
+}
+
+# Ranked candidates fetched per query, 40 pages of the storefront listing
+SEARCH_LIMIT = 480
+MAX_QUERY_TERMS = 6
+# Terms shorter than this (sizes like "s" or "xl") only match whole tokens
+PREFIX_MIN_LENGTH = 3
+
+REINDEX_BATCH_SIZE = 500
+
+TOKEN_LENGTH = SearchToken._meta.get_field('token').max_length
+
+_word_re = re.compile(r'\w+')
+# Dotless i has no decomposition, fold it by hand so "gömlek" and "GOMLEK" meet
+_fold_table = str.maketrans({'ı': 'i'})
+
+
+def tokenize(text):
+    """
+    Splits text into lowercase tokens with accents stripped, used for both indexing and queries.
+    """
+    if not text:
+        return []
+    text = unicodedata.normalize('NFKD', str(text).casefold().translate(_fold_table))
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return [word[:TOKEN_LENGTH] for word in _word_re.findall(text)]
+
+
+def build_tokens(product, colors, sizes):
+    """
+    Returns the token weights of a product, each field counted once per token.
+    """
+    fields = {
+        'name': product.name,
+        'category': product.category.get_full_path() if product.category else '',
+        'color': ' '.join(colors),
+        'size': ' '.join(sizes),
+        'short_desc': product.short_desc,
+        'long_desc': product.long_desc,
+    }
+    weights = defaultdict(int)
+    for field, text in fields.items():
+        for token in set(tokenize(text)):
+            weights[token] += FIELD_WEIGHTS[field]
+    return weights
+
+
+def reindex_products(product_ids):
+    """
+    Rebuilds the search tokens of the given products, dropping the tokens of products that are gone.
+    """
+    product_ids = sorted(set(product_ids) - {None})
+    for start in range(0, len(product_ids), REINDEX_BATCH_SIZE):
+        batch = product_ids[start:start + REINDEX_BATCH_SIZE]
+
+        variants = defaultdict(lambda: (set(), set()))
+        for product_id, color, size in Stock.objects.filter(product__in=batch).values_list('product_id', 'color__name', 'size__name'):
+            variants[product_id][0].add(color)
+            variants[product_id][1].add(size)
+
+        tokens = []
+        for product in Product.objects.filter(pk__in=batch).select_related('category'):
+            colors, sizes = variants[product.pk]
+            for token, weight in build_tokens(product, sorted(colors), sorted(sizes)).items():
+                tokens.append(SearchToken(token=token, product=product, weight=weight))
+
+        with transaction.atomic():
+            SearchToken.objects.filter(product__in=batch).delete()
+            SearchToken.objects.bulk_create(tokens, batch_size=1000)
+
+
+def schedule_reindex(product_ids):
+    """
+    Reindexes the given products once the current transaction commits.
+    """
+    product_ids = set(product_ids) - {None}
+    if product_ids:
+        transaction.on_commit(partial(reindex_products, product_ids))
+
+
+def rank_products(query, limit=SEARCH_LIMIT):
+    """
+    Returns (product_id, score) pairs of the active products matching every term of the query, best first.
+    """
+    terms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return []
+
+    matches = Q()
+    term_counts = {}
+    for index, term in enumerate(terms):
+        # Longer terms match as prefixes so a half typed word still finds something
+        term_match = Q(token__startswith=term) if len(term) >= PREFIX_MIN_LENGTH else Q(token=term)
+        matches |= term_match
+        term_counts['term_%d' % index] = Count('pk', filter=term_match)
+
+    rows = (
+        SearchToken.objects.filter(matches, product__active=True)
+        .values('product')
+        .annotate(score=Sum('weight'), **term_counts)
+        .filter(**{name + '__gt': 0 for name in term_counts})
+        .order_by('-score', 'product')[:limit]
+    )
+    return [(row['product'], row['score']) for row in rows]
+
+
+def search_products(query):
+    """
+    Returns the active products matching the query, annotated with their search_rank.
+    """
+    ranking = rank_products(query)
+    if not ranking:
+        return Product.objects.none().annotate(search_rank=Value(0, output_field=IntegerField()))
+
+    search_rank = Case(*[When(pk=product_id, then=Value(score)) for product_id, score in ranking], output_field=IntegerField())
+    return Product.objects.filter(active=True, pk__in=[product_id for product_id, _ in ranking]).annotate(search_rank=search_rank)
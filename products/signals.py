@@ -0,0 +1,247 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from accounts.models import CustomUser
+
+from .caching import CATALOG_TAG, code_tag, discount_tags, product_tags, schedule_purge, seller_tag
+from .category_tree import invalidate_category_counts, invalidate_category_tree
+from .facets import invalidate_facet_index
+from .images import get_variant_widths, schedule_variants
+from .models import Category, Code, CodeSummary, Color, Discount, Product, Size, Stock, StoredFile
+from .querycache import bump_model_version
+from .reference import invalidate_reference_data
+from .search import schedule_reindex
+from .sweeper import schedule_file_deletion
+
+
+# Drop the cached query results of the reference tables, queryset writes bump them on their own.
+# Connected first, so the versions move on commit before the snapshots built from these queries are rebuilt
+@receiver([post_save, post_delete], sender=Discount)
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Size)
+@receiver([post_save, post_delete], sender=Color)
+@receiver([post_save, post_delete], sender=Code)
+def bump_query_versions(sender, **kwargs):
+    bump_model_version(sender)
+
+
+# Keep the per-code summaries current on stock writes
+@receiver(pre_save, sender=Stock)
+def remember_stock_code(sender, instance, **kwargs):
+    # A stock can be moved to another code from the edit page, so the old code needs a refresh as well
+    instance._previous_code_id = None
+    if instance.pk:
+        instance._previous_code_id = Stock.objects.filter(pk=instance.pk).values_list('code_id', flat=True).first()
+
+@receiver(post_save, sender=Stock)
+def refresh_summary_on_stock_save(sender, instance, **kwargs):
+    CodeSummary.schedule_refresh([instance.code_id, getattr(instance, '_previous_code_id', None)])
+
+@receiver(post_delete, sender=Stock)
+def refresh_summary_on_stock_delete(sender, instance, **kwargs):
+    CodeSummary.schedule_refresh([instance.code_id])
+
+@receiver(post_save, sender=Stock)
+@receiver(post_delete, sender=Stock)
+def touch_product_on_stock_change(sender, instance, **kwargs):
+    # Stocks have no timestamp of their own, the product's updated_at stands in for its variants
+    Product.objects.filter(pk=instance.product_id).update(updated_at=timezone.now())
+
+
+# Price, activation and seller live on the product
+@receiver(post_save, sender=Product)
+def refresh_summary_on_product_save(sender, instance, **kwargs):
+    CodeSummary.schedule_refresh(Stock.objects.filter(product=instance).values_list('code_id', flat=True))
+
+
+# Keep the rolled-up category product counts current
+@receiver(pre_save, sender=Product)
+def remember_product_category(sender, instance, **kwargs):
+    instance._previous_listing = None
+    if instance.pk:
+        instance._previous_listing = Product.objects.filter(pk=instance.pk).values_list('category_id', 'active').first()
+
+@receiver(post_save, sender=Product)
+def update_category_counts_on_product_save(sender, instance, **kwargs):
+    previous = getattr(instance, '_previous_listing', None)
+    previous_category_id = previous[0] if previous and previous[1] else None
+    category_id = instance.category_id if instance.active else None
+    if previous_category_id != category_id:
+        if previous_category_id:
+            Category.adjust_product_count(previous_category_id, -1)
+        if category_id:
+            Category.adjust_product_count(category_id, 1)
+        transaction.on_commit(invalidate_category_counts)
+
+@receiver(post_delete, sender=Product)
+def update_category_counts_on_product_delete(sender, instance, **kwargs):
+    if instance.active and instance.category_id:
+        Category.adjust_product_count(instance.category_id, -1)
+        transaction.on_commit(invalidate_category_counts)
+
+def rebuild_category_counts():
+    Category.rebuild_product_counts()
+    invalidate_category_counts()
+
+
+# Discount percent changes the effective price of every product using it
+@receiver(post_save, sender=Discount)
+def refresh_prices_on_discount_save(sender, instance, **kwargs):
+    instance.update_product_prices()
+    CodeSummary.schedule_refresh(Stock.objects.filter(product__discount=instance).values_list('code_id', flat=True))
+    schedule_purge(discount_tags(instance))
+
+@receiver(pre_delete, sender=Discount)
+def refresh_prices_on_discount_delete(sender, instance, **kwargs):
+    # on_delete=SET_NULL is a bare queryset update, so detach the products ourselves first
+    instance.detach_products()
+
+
+# The storefront navbar renders from the cached category tree
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def refresh_category_tree(sender, instance, **kwargs):
+    transaction.on_commit(invalidate_category_tree)
+    # Deleting a category detaches its products and moving one carries its subtree counts along
+    if kwargs['signal'] is post_delete or getattr(instance, '_subtree_moved', False):
+        transaction.on_commit(rebuild_category_counts)
+
+
+# Keep the search index current, products carry the names of their category, colors and sizes
+@receiver(post_save, sender=Product)
+def reindex_product_on_save(sender, instance, **kwargs):
+    schedule_reindex([instance.pk])
+
+@receiver(post_save, sender=Stock)
+@receiver(post_delete, sender=Stock)
+def reindex_product_on_stock_change(sender, instance, **kwargs):
+    schedule_reindex([instance.product_id])
+
+@receiver(post_save, sender=Category)
+def reindex_products_on_category_save(sender, instance, **kwargs):
+    if getattr(instance, '_full_path_changed', False):
+        schedule_reindex(Product.objects.filter(category__in=instance.get_descendants()).values_list('pk', flat=True))
+
+@receiver(pre_delete, sender=Category)
+def remember_category_products(sender, instance, **kwargs):
+    # The products are detached by the delete, so collect them while the subtree still exists
+    instance._search_product_ids = list(Product.objects.filter(category__in=instance.get_descendants()).values_list('pk', flat=True))
+
+@receiver(post_delete, sender=Category)
+def reindex_products_on_category_delete(sender, instance, **kwargs):
+    schedule_reindex(getattr(instance, '_search_product_ids', []))
+
+@receiver(post_save, sender=Color)
+@receiver(post_save, sender=Size)
+def reindex_products_on_variant_rename(sender, instance, created, **kwargs):
+    if not created:
+        lookup = 'color' if sender is Color else 'size'
+        schedule_reindex(Stock.objects.filter(**{lookup: instance}).values_list('product_id', flat=True))
+
+
+# The storefront facet counts are built from all of these
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Stock)
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Size)
+@receiver([post_save, post_delete], sender=Color)
+@receiver([post_save, post_delete], sender=Discount)
+def refresh_facet_index(sender, **kwargs):
+    transaction.on_commit(invalidate_facet_index)
+
+
+# The product forms choose from a snapshot of these
+@receiver([post_save, post_delete], sender=Size)
+@receiver([post_save, post_delete], sender=Color)
+@receiver([post_save, post_delete], sender=Code)
+@receiver([post_save, post_delete], sender=Discount)
+def refresh_reference_data(sender, **kwargs):
+    transaction.on_commit(invalidate_reference_data)
+
+
+# Purge the cached storefront pages showing what changed
+@receiver(post_save, sender=Product)
+def purge_pages_on_product_save(sender, instance, **kwargs):
+    previous = getattr(instance, '_previous_listing', None)
+    schedule_purge(product_tags([instance.pk], [previous[0] if previous else None]))
+
+@receiver(post_delete, sender=Product)
+def purge_pages_on_product_delete(sender, instance, **kwargs):
+    schedule_purge(product_tags([instance.pk], [instance.category_id]))
+
+@receiver(post_save, sender=Stock)
+@receiver(post_delete, sender=Stock)
+def purge_pages_on_stock_change(sender, instance, **kwargs):
+    tags = product_tags([instance.product_id])
+    tags.update(code_tag(code_id) for code_id in (instance.code_id, getattr(instance, '_previous_code_id', None)) if code_id)
+    schedule_purge(tags)
+
+@receiver([post_save, post_delete], sender=Size)
+@receiver([post_save, post_delete], sender=Color)
+def purge_pages_on_variant_change(sender, instance, **kwargs):
+    # The listings offer every size and color as a filter, a product page shows the ones of its codes
+    lookup = 'color' if sender is Color else 'size'
+    code_ids = Stock.objects.filter(**{lookup: instance}).values_list('code_id', flat=True).distinct()
+    schedule_purge({CATALOG_TAG} | {code_tag(code_id) for code_id in code_ids})
+
+@receiver([post_save, post_delete], sender=CustomUser)
+def purge_pages_on_seller_change(sender, instance, **kwargs):
+    # Logging in only stamps last_login
+    if instance.user_type == 'seller' and set(kwargs.get('update_fields') or ()) != {'last_login'}:
+        schedule_purge([seller_tag(instance.pk)])
+
+
+# Resized variants of uploaded images, built in the background
+@receiver(post_save, sender=Product)
+def build_thumb_variants(sender, instance, **kwargs):
+    if instance.thumb and not get_variant_widths(instance.thumb.name):
+        schedule_variants(instance.thumb.name, product_tags([instance.pk]))
+
+@receiver(post_save, sender=CustomUser)
+def build_profile_picture_variants(sender, instance, **kwargs):
+    if instance.profile_picture:
+        schedule_variants(instance.profile_picture.name)
+
+
+# Reference counts of the uploaded files, shared between every row with the same content
+@receiver(pre_save, sender=Product)
+def remember_thumb(sender, instance, **kwargs):
+    instance._previous_thumb = None
+    if instance.pk:
+        instance._previous_thumb = Product.objects.filter(pk=instance.pk).values_list('thumb', flat=True).first()
+
+@receiver(pre_save, sender=CustomUser)
+def remember_profile_picture(sender, instance, update_fields=None, **kwargs):
+    instance._previous_profile_picture = None
+    if instance.pk:
+        if update_fields is not None and 'profile_picture' not in update_fields:
+            # Logins only save last_login, no need to read the row back
+            instance._previous_profile_picture = instance.profile_picture.name
+        else:
+            instance._previous_profile_picture = CustomUser.objects.filter(pk=instance.pk).values_list('profile_picture', flat=True).first()
+
+@receiver(post_save, sender=Product)
+def count_thumb_references(sender, instance, **kwargs):
+    swap_file_reference(getattr(instance, '_previous_thumb', None), instance.thumb.name)
+
+@receiver(post_save, sender=CustomUser)
+def count_profile_picture_references(sender, instance, **kwargs):
+    swap_file_reference(getattr(instance, '_previous_profile_picture', None), instance.profile_picture.name)
+
+@receiver(post_delete, sender=Product)
+def release_thumb(sender, instance, **kwargs):
+    swap_file_reference(instance.thumb.name, None)
+
+@receiver(post_delete, sender=CustomUser)
+def release_profile_picture(sender, instance, **kwargs):
+    swap_file_reference(instance.profile_picture.name, None)
+
+def swap_file_reference(previous, name):
+    if (previous or None) == (name or None):
+        return
+    if name:
+        StoredFile.retain(name)
+    if previous and StoredFile.release(previous):
+        schedule_file_deletion(previous)
@@ -0,0 +1,64 @@
+import hashlib
+import os
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage that names every upload after the SHA-256 of its bytes, inside the
+    directory the field uploads to ("images/3f/3f2a....jpg"). Uploading the same image again
+    stores nothing and returns the existing name, so a name always stands for the same bytes.
+    How many rows use a file is counted by StoredFile.
+    """
+    def content_name(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        digest = digest.hexdigest()
+        extension = os.path.splitext(name)[1].lower()
+        return '%s/%s%s' % (os.path.join(os.path.dirname(name), digest[:2]).lstrip('/'), digest, extension)
+
+    def get_available_name(self, name, max_length=None):
+        # Names are picked by content in _save, a taken name is the same file
+        return name
+
+    def _save(self, name, content):
+        name = self.content_name(name, content)
+        full_path = self.path(name)
+        if os.path.exists(full_path):
+            # Touched so the media sweep leaves it alone until the new reference is committed
+            try:
+                os.utime(full_path)
+                return name
+            except FileNotFoundError:
+                # Deleted since the check, stored again below
+                pass
+
+        directory = os.path.dirname(full_path)
+        if self.directory_permissions_mode is not None:
+            old_umask = os.umask(0o777 & ~self.directory_permissions_mode)
+            try:
+                os.makedirs(directory, self.directory_permissions_mode, exist_ok=True)
+            finally:
+                os.umask(old_umask)
+        else:
+            os.makedirs(directory, exist_ok=True)
+
+        # Written aside and renamed into place, a concurrent upload of the same bytes simply wins the rename
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in content.chunks():
+                    temp_file.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(temp_path, self.file_permissions_mode)
+            os.replace(temp_path, full_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return name
@@ -0,0 +1,188 @@
+import logging
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+
+from .images import VARIANT_ROOT, delete_variants, forget_variant_widths, variant_dir
+from .models import StoredFile
+from .uploads import held_upload_names
+
+
+# Files younger than this are never swept, their rows may not be committed yet (seconds)
+SWEEP_GRACE = 60 * 60
+# Unreferenced files are deleted this many at a time, pausing between batches (seconds)
+SWEEP_BATCH = 500
+SWEEP_PAUSE = 0.1
+# A released file touched this recently may be getting stored again, the sweep reclaims it later (seconds)
+DELETE_GRACE = 10 * 60
+
+MediaFile = namedtuple('MediaFile', ['name', 'size', 'mtime'])
+SweepReport = namedtuple('SweepReport', ['scanned', 'referenced', 'orphans', 'deleted', 'reclaimed'])
+
+logger = logging.getLogger(__name__)
+
+# Removing files never holds up the request that released them
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='media-deletion')
+
+
+def _reclaim(path, cutoff):
+    """
+    Removes the file unless it was modified after cutoff, returning whether it did. The file
+    is moved aside before its age is checked: a save of the same content either touched it
+    before, or finds it missing and writes it anew.
+    """
+    aside = os.path.join(os.path.dirname(path), '.deleting-' + os.path.basename(path))
+    os.rename(path, aside)
+    if os.stat(aside).st_mtime > cutoff:
+        os.replace(aside, path)
+        return False
+    os.remove(aside)
+    return True
+
+
+def delete_unreferenced_file(name):
+    # Checked again when it runs, the same content may have been uploaded meanwhile. The row
+    # stays locked until the file is gone, so retain() waits and then finds no row to revive.
+    try:
+        with transaction.atomic():
+            stored_file = StoredFile.objects.select_for_update().filter(name=name, ref_count__lte=0).first()
+            if stored_file is None or held_upload_names([name]):
+                return
+            try:
+                removed = _reclaim(default_storage.path(name), time.time() - DELETE_GRACE)
+            except FileNotFoundError:
+                removed = True
+            if removed:
+                stored_file.delete()
+                delete_variants(name)
+    except Exception:
+        logger.exception("Deleting %s failed, the media sweep will reclaim it", name)
+    finally:
+        # Connections are per thread, one left open here would outlive the server's idle timeout
+        connections.close_all()
+
+
+def schedule_file_deletion(name):
+    """
+    Removes a stored file and its variants in the background once the current transaction
+    commits, provided nothing references it by then.
+    """
+    if name:
+        transaction.on_commit(partial(_executor.submit, delete_unreferenced_file, name))
+
+
+def referenced_names():
+    """
+    Returns the names of every file referenced by a file field or held by a finished upload.
+    """
+    names = held_upload_names()
+    for model, field_name in StoredFile.referencing_fields():
+        rows = model.objects.exclude(**{field_name: ''}).exclude(**{field_name + '__isnull': True})
+        names.update(rows.values_list(field_name, flat=True).distinct().iterator(chunk_size=2000))
+    return names
+
+
+def _list_directory(root, directory):
+    files, directories = [], []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                entry_stat = entry.stat(follow_symlinks=False)
+                name = os.path.relpath(entry.path, root).replace(os.sep, '/')
+                files.append(MediaFile(name, entry_stat.st_size, entry_stat.st_mtime))
+    return files, directories
+
+
+def scan_media(workers):
+    """
+    Lists every file under MEDIA_ROOT a level at a time, the directories of each level listed
+    in parallel. MEDIA_ROOT itself only holds images/ and variants/, the work spreads out over
+    the hash buckets below them.
+    """
+    root = str(settings.MEDIA_ROOT)
+    if not os.path.isdir(root):
+        return []
+    files, directories = [], [root]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while directories:
+            level = directories
+            directories = []
+            for level_files, subdirectories in executor.map(partial(_list_directory, root), level):
+                files.extend(level_files)
+                directories.extend(subdirectories)
+    return files
+
+
+def _still_referenced(names):
+    referenced = held_upload_names(names)
+    for model, field_name in StoredFile.referencing_fields():
+        referenced.update(model.objects.filter(**{field_name + '__in': names}).values_list(field_name, flat=True))
+    return referenced
+
+
+def _remove_empty_directories(names):
+    root = str(settings.MEDIA_ROOT)
+    for directory in sorted({os.path.dirname(name) for name in names}, key=len, reverse=True):
+        while directory:
+            try:
+                os.rmdir(os.path.join(root, directory))
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+
+def sweep_media(dry_run=False, grace=SWEEP_GRACE, batch_size=SWEEP_BATCH, pause=SWEEP_PAUSE, workers=4):
+    """
+    Mark and sweep over MEDIA_ROOT: every file no file field references or finished upload
+    holds, and not a variant of one that is, is deleted a batch at a time along with its
+    StoredFile row. Files modified within the grace period are left alone, as are files
+    referenced again by the time their batch runs. Returns a SweepReport, whose orphans list what was, or with dry_run would be, deleted.
+    """
+    referenced = referenced_names()
+    live_variant_dirs = {variant_dir(name) for name in referenced}
+    cutoff = time.time() - grace
+
+    scanned = scan_media(workers)
+    orphans = []
+    for media_file in scanned:
+        if media_file.name in referenced or media_file.mtime > cutoff:
+            continue
+        if media_file.name.startswith(VARIANT_ROOT) and media_file.name.rsplit('/', 1)[0] + '/' in live_variant_dirs:
+            continue
+        orphans.append(media_file)
+    orphans.sort()
+
+    deleted = reclaimed = 0
+    if not dry_run:
+        for start in range(0, len(orphans), batch_size):
+            batch = orphans[start:start + batch_size]
+            taken = _still_referenced([media_file.name for media_file in batch])
+            removed = []
+            for media_file in batch:
+                path = default_storage.path(media_file.name)
+                try:
+                    if media_file.name in taken or not _reclaim(path, cutoff):
+                        continue
+                except OSError:
+                    continue
+                removed.append(media_file.name)
+                reclaimed += media_file.size
+            StoredFile.objects.filter(name__in=removed).delete()
+            for name in removed:
+                if not name.startswith(VARIANT_ROOT):
+                    # A later upload of the same image builds its variants again
+                    forget_variant_widths(name)
+            _remove_empty_directories(removed)
+            deleted += len(removed)
+            if start + batch_size < len(orphans):
+                time.sleep(pause)
+
+    return SweepReport(len(scanned), len(referenced), orphans, deleted, reclaimed)
@@ -0,0 +1,52 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+
+from ..images import get_variant_widths, variant_name, variant_storage
+
+
+register = template.Library()
+
+# Width of the JPEG in src, for browsers that ignore srcset
+FALLBACK_WIDTH = 320
+
+
+def _srcset(name, widths, extension):
+    return ', '.join('%s %dw' % (variant_storage.url(variant_name(name, width, extension)), width) for width in widths)
+
+
+@register.simple_tag
+def responsive_image(image, sizes='100vw', **attrs):
+    """
+    Renders a <picture> choosing between the WebP and JPEG variants of an image field for the
+    given sizes, or an <img> of the original while the variants are still being built.
+    Extra keyword arguments become attributes of the <img>, which loads lazily unless told otherwise.
+    """
+    if not image:
+        return ''
+    attrs.setdefault('loading', 'lazy')
+    attributes = format_html_join('', ' {}="{}"', sorted(attrs.items()))
+    widths = get_variant_widths(image.name)
+    if not widths:
+        return format_html('<img src="{}"{}>', image.url, attributes)
+
+    fallback = max([width for width in widths if width <= FALLBACK_WIDTH] or widths[:1])
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}" sizes="{}"><img src="{}" srcset="{}" sizes="{}"{}></picture>',
+        _srcset(image.name, widths, 'webp'), sizes,
+        variant_storage.url(variant_name(image.name, fallback, 'jpg')), _srcset(image.name, widths, 'jpg'), sizes,
+        attributes,
+    )
+
+
+@register.simple_tag
+def image_variant_url(image, width):
+    """
+    Returns the URL of the smallest JPEG variant at least width pixels wide, the original's while there are none.
+    """
+    if not image:
+        return ''
+    widths = get_variant_widths(image.name)
+    if not widths:
+        return image.url
+    width = min([candidate for candidate in widths if candidate >= width] or widths[-1:])
+    return variant_storage.url(variant_name(image.name, width, 'jpg'))
@@ -1,3 +1,784 @@
-from django.test import TestCase
+import http.server
+import importlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+
+from accounts.backends import get_user_snapshot
+from accounts.models import CustomUser
+from . import caching, facets, images, pagination, sweeper
+from .apps import worker_count
+from .caching import PRODUCTS_TAG, acquire_rebuild_lock, category_tag, code_tag, get_or_compute, get_purge_times, product_tag, purge_tags
+from .category_tree import get_category_tree
+from .facets import FacetIndex, get_facet_index
+from .images import generate_variants, get_variant_widths, variant_dir, variant_name, variant_storage
+from .models import Category, ChunkedUpload, Code, CodeSummary, Color, Discount, Product, SearchToken, Size, Stock, StoredFile
+from .pagination import APPROXIMATE_COUNT_THRESHOLD, CachedCountPaginator, estimate_table_rows
+from .reference import get_reference_data
+from .search import search_products
+from .templatetags.product_images import image_variant_url, responsive_image
+from .sweeper import SWEEP_GRACE, scan_media, sweep_media
+from .uploads import UPLOAD_EXPIRY, UploadError, append_chunk, completed_upload, part_dir, start_upload
+
+
+class CatalogMixin:
+    """
+    A seller with products in stock, every product variant under its own code unless told otherwise.
+    """
+    def setUp(self):
+        cache.clear()
+        self.seller = CustomUser.objects.create_user('seller@example.com', 'secret', first_name='a', last_name='b', user_type='seller')
+        self.size = Size.objects.create(name='M')
+        self.color = Color.objects.create(name='Red')
+
+    def add_product(self, name='Shirt', price=10, quantity=1, code=None, active=True, size=None, **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.create(name=name, price=price, active=active, seller=self.seller, **fields)
+            code = code or Code.objects.create(name='%s-%s' % (name, product.pk))
+            Stock.objects.create(product=product, size=size or self.size, color=self.color, code=code, quantity=quantity)
+        return product
+
+
+class CodeSummaryTests(CatalogMixin, TestCase):
+    def test_summary_follows_stock_and_product_changes(self):
+        code = Code.objects.create(name='SHIRT')
+        cheap = self.add_product(price=10, quantity=2, code=code)
+        self.add_product(price=30, quantity=3, code=code, active=False)
+        summary = CodeSummary.objects.get(code=code)
+        self.assertEqual((summary.total_quantity, summary.min_price, summary.max_price, summary.all_active, summary.variant_count), (5, 10, 30, False, 2))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            cheap.price = 20
+            cheap.save()
+            Stock.objects.get(product=cheap).delete()
+        summary.refresh_from_db()
+        self.assertEqual((summary.total_quantity, summary.min_price, summary.variant_count), (3, 30, 1))
+
+    def test_missing_summary_is_built_on_access(self):
+        product = self.add_product(price=15, quantity=4)
+        code = Stock.objects.get(product=product).code
+        CodeSummary.objects.all().delete()
+        code = Code.objects.get(pk=code.pk)
+        self.assertEqual(code.current_summary.total_quantity, 4)
+        self.assertTrue(CodeSummary.objects.filter(code=code).exists())
+
+    def test_migration_backfills_every_code(self):
+        code = Code.objects.create(name='SHIRT')
+        self.add_product(price=10, quantity=2, code=code)
+        self.add_product(price=12, quantity=1, code=code)
+        empty = Code.objects.create(name='EMPTY')
+        CodeSummary.objects.all().delete()
+
+        migration = importlib.import_module('products.migrations.0033_backfill_code_summaries')
+        migration.build_code_summaries(apps, None)
+        summary = CodeSummary.objects.get(code=code)
+        self.assertEqual((summary.total_quantity, summary.min_price, summary.max_price, summary.seller_id), (3, 10, 12, self.seller.pk))
+        self.assertEqual(CodeSummary.objects.get(code=empty).variant_count, 0)
+
+
+class StubProxy(http.server.BaseHTTPRequestHandler):
+    # Records the surrogate keys of every PURGE it receives
+    purged = []
+
+    def do_PURGE(self):
+        self.purged.append(self.headers['Surrogate-Key'].split())
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class SurrogatePurgeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        StubProxy.purged = []
+        server = http.server.HTTPServer(('127.0.0.1', 0), StubProxy)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = 'http://127.0.0.1:%d/' % server.server_port
+        # The purge requests go out on their own thread, here they are sent in place
+        patcher = mock.patch.object(caching._purge_executor, 'submit', lambda function, *args: function(*args))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_purged_tags_reach_the_proxy_in_batches(self):
+        tags = [product_tag(pk) for pk in range(5)]
+        with override_settings(SURROGATE_PURGE_URL=self.url), mock.patch.object(caching, 'SURROGATE_PURGE_BATCH', 2):
+            purge_tags(tags)
+        self.assertEqual(StubProxy.purged, [sorted(tags)[:2], sorted(tags)[2:4], sorted(tags)[4:]])
+
+    def test_unreachable_proxy_is_only_logged(self):
+        with override_settings(SURROGATE_PURGE_URL='http://127.0.0.1:1/'):
+            with self.assertLogs('products.caching', 'WARNING'):
+                purge_tags([product_tag(1)])
+        # The cache purge happened all the same
+        self.assertIn(product_tag(1), get_purge_times([product_tag(1)]))
+
+    def test_nothing_is_sent_without_a_proxy(self):
+        with override_settings(SURROGATE_PURGE_URL=None):
+            purge_tags([product_tag(1)])
+        self.assertEqual(StubProxy.purged, [])
+
+
+class SingleFlightTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.calls = []
+
+    def compute(self, value='fresh', delay=0):
+        def compute():
+            self.calls.append(value)
+            time.sleep(delay)
+            return value
+        return compute
+
+    def test_value_is_kept_until_it_expires_or_a_tag_is_purged(self):
+        self.assertEqual(get_or_compute('key', self.compute('first'), 60, ['tag']), 'first')
+        self.assertEqual(get_or_compute('key', self.compute('second'), 60, ['tag']), 'first')
+        purge_tags(['tag'])
+        self.assertEqual(get_or_compute('key', self.compute('third'), 60, ['tag']), 'third')
+        self.assertEqual(self.calls, ['first', 'third'])
+
+    def test_stale_value_is_served_while_another_caller_rebuilds(self):
+        get_or_compute('key', self.compute('stale'), 0)
+        self.assertIsNotNone(acquire_rebuild_lock('key'))
+        self.assertEqual(get_or_compute('key', self.compute(), 60), 'stale')
+        self.assertEqual(self.calls, ['stale'])
+
+    def test_concurrent_misses_compute_once(self):
+        barrier = threading.Barrier(5)
+        results = []
+
+        def call():
+            barrier.wait()
+            results.append(get_or_compute('key', self.compute(delay=0.2), 60))
+
+        threads = [threading.Thread(target=call) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((results, self.calls), (['fresh'] * 5, ['fresh']))
+
+    def test_failed_compute_releases_the_key(self):
+        def fail():
+            raise ValueError('broken')
+
+        with self.assertRaises(ValueError):
+            get_or_compute('key', fail, 60)
+        self.assertEqual(get_or_compute('key', self.compute(), 60), 'fresh')
+
+
+class RepresentativeTests(CatalogMixin, TestCase):
+    def setUp(self):
+        super(RepresentativeTests, self).setUp()
+        self.codes = [Code.objects.create(name='CODE-%d' % number) for number in range(3)]
+        # Added round robin, so the stocks of a code are spread over the table
+        for name in ('Shirt', 'Polo', 'Hat'):
+            for code in self.codes:
+                self.add_product(name=name, code=code)
+
+    def test_first_stock_of_every_code_in_order(self):
+        representatives = list(Stock.objects.representatives())
+        self.assertEqual([stock.code_id for stock in representatives], [code.pk for code in self.codes])
+        for stock in representatives:
+            self.assertEqual(stock.pk, Stock.objects.filter(code=stock.code).order_by('pk').first().pk)
+
+    def test_filters_apply_before_grouping(self):
+        first = Stock.objects.filter(code=self.codes[0]).order_by('pk').first()
+        seller = CustomUser.objects.create_user('other@example.com', 'secret', first_name='c', last_name='d', user_type='seller')
+        Product.objects.filter(pk=first.product_id).update(seller=seller)
+
+        representatives = {stock.code_id: stock for stock in Stock.objects.filter(product__seller=self.seller).representatives()}
+        self.assertEqual(set(representatives), {code.pk for code in self.codes})
+        self.assertNotEqual(representatives[self.codes[0].pk].pk, first.pk)
+
+    def test_page_is_sliced_by_the_database(self):
+        with self.assertNumQueries(1) as queries:
+            page = list(Stock.objects.representatives()[1:2])
+        self.assertEqual([stock.code_id for stock in page], [self.codes[1].pk])
+        self.assertIn('LIMIT', queries.captured_queries[0]['sql'])
+
+
+class QueryCacheTests(CatalogMixin, TestCase):
+    def test_cached_query_is_served_until_a_write(self):
+        Discount.objects.create(name='Sale', discount_percent=10, active=True)
+        self.assertEqual(len(Discount.objects.filter(active=True).cached()), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(Discount.objects.filter(active=True).cached()), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Discount.objects.create(name='Clearance', discount_percent=50, active=True)
+        self.assertEqual(len(Discount.objects.filter(active=True).cached()), 2)
+
+    def test_reference_data_follows_changes(self):
+        self.assertEqual([size.name for size in get_reference_data().sizes], ['M'])
+        with self.captureOnCommitCallbacks(execute=True):
+            Size.objects.create(name='L')
+            Discount.objects.create(name='Sale', discount_percent=10, active=False)
+        reference = get_reference_data()
+        self.assertEqual([size.name for size in reference.sizes], ['M', 'L'])
+        self.assertEqual((len(reference.discounts), len(reference.active_discounts)), (1, 0))
+
+    def test_category_tree_follows_product_counts(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            category = Category.objects.create(name='Shirts')
+        self.assertEqual(get_category_tree()[0].product_count, 0)
+        self.add_product(category=category)
+        self.assertEqual(get_category_tree()[0].product_count, 1)
+
+
+class CachedCountTests(CatalogMixin, TestCase):
+    def setUp(self):
+        super(CachedCountTests, self).setUp()
+        for name in ('Shirt', 'Polo', 'Hat'):
+            self.add_product(name=name)
+
+    def paginator(self, **kwargs):
+        return CachedCountPaginator(Product.objects.order_by('pk'), 2, count_tags=[PRODUCTS_TAG], **kwargs)
+
+    def test_count_is_kept_until_its_tags_are_purged(self):
+        self.assertEqual(self.paginator().count, 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.paginator().count, 3)
+        self.add_product(name='Cap')
+        self.assertEqual(self.paginator().count, 4)
+
+    def test_large_tables_are_estimated(self):
+        with mock.patch.object(pagination, 'estimate_table_rows', return_value=APPROXIMATE_COUNT_THRESHOLD):
+            paginator = self.paginator(estimate_model=Product)
+            with self.assertNumQueries(0):
+                self.assertEqual(paginator.count, APPROXIMATE_COUNT_THRESHOLD)
+            self.assertTrue(paginator.approximate)
+            # Whether there is more comes from the rows
+            self.assertTrue(paginator.page(1).has_next())
+            last = paginator.page(2)
+            self.assertEqual((last.has_next(), last.start_index(), last.end_index()), (False, 3, 3))
+            past = paginator.page(1000)
+            self.assertEqual((len(past), past.start_index(), past.end_index()), (0, 0, 0))
+
+    def test_small_or_unknown_estimates_are_counted(self):
+        for estimate in (APPROXIMATE_COUNT_THRESHOLD - 1, None):
+            cache.clear()
+            with mock.patch.object(pagination, 'estimate_table_rows', return_value=estimate):
+                paginator = self.paginator(estimate_model=Product)
+                self.assertEqual((paginator.approximate, paginator.count), (False, 3))
+        # SQLite keeps no row estimate
+        self.assertIsNone(estimate_table_rows(Product))
+
+
+class DiscountTests(CatalogMixin, TestCase):
+    def setUp(self):
+        super(DiscountTests, self).setUp()
+        self.discount = Discount.objects.create(name='Sale', discount_percent=20, active=True)
+        self.code = Code.objects.create(name='SHIRT')
+        self.discounted = self.add_product(price=100, code=self.code, discount=self.discount)
+        self.plain = self.add_product(price=90, code=self.code)
+
+    def effective_prices(self):
+        return list(Product.objects.filter(pk__in=[self.discounted.pk, self.plain.pk]).order_by('pk').values_list('effective_price', flat=True))
+
+    def test_saved_products_carry_their_effective_price(self):
+        self.assertEqual(self.effective_prices(), [80, 90])
+        self.assertEqual(list(Product.objects.order_by('effective_price').values_list('pk', flat=True)), [self.discounted.pk, self.plain.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.plain.discount = self.discount
+            self.plain.save()
+        self.assertEqual(self.effective_prices(), [80, 72])
+
+    def test_percent_change_reprices_its_products(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.discount.discount_percent = 50
+            self.discount.save()
+        self.assertEqual(self.effective_prices(), [50, 90])
+        summary = CodeSummary.objects.get(code=self.code)
+        self.assertEqual((summary.min_price, summary.max_price), (50, 90))
+
+    def test_deactivated_or_deleted_discount_restores_the_price(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.discount.active = False
+            self.discount.detach_products()
+            self.discount.save()
+        self.assertEqual(self.effective_prices(), [100, 90])
+        self.assertIsNone(Product.objects.get(pk=self.discounted.pk).discount)
+        self.assertEqual(CodeSummary.objects.get(code=self.code).max_price, 100)
+
+        other = Discount.objects.create(name='Clearance', discount_percent=10, active=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.plain.discount = other
+            self.plain.save()
+        self.assertEqual(self.effective_prices(), [100, 81])
+        with self.captureOnCommitCallbacks(execute=True):
+            other.delete()
+        self.assertEqual(self.effective_prices(), [100, 90])
+        self.assertEqual(CodeSummary.objects.get(code=self.code).min_price, 90)
+
+    def test_deactivating_purges_the_pages_of_its_products(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            category = Category.objects.create(name='Shirts')
+            discount = Discount.objects.create(name='Sale', discount_percent=50, active=True)
+        product = self.add_product(price=100, category=category, discount=discount)
+        code_id = Stock.objects.get(product=product).code_id
+        tags = [category_tag(category.pk), code_tag(code_id)]
+        before = get_purge_times(tags)
+
+        # As the admin does it, the products are detached before the discount is saved
+        with self.captureOnCommitCallbacks(execute=True):
+            discount.active = False
+            discount.detach_products()
+            discount.save()
+        after = get_purge_times(tags)
+        for tag in tags:
+            self.assertGreater(after[tag], before[tag])
+
+
+class FacetIndexTests(CatalogMixin, TestCase):
+    def setUp(self):
+        super(FacetIndexTests, self).setUp()
+        facets._index = None
+        facets._index_built_at = 0
+        facets._rebuild_pending = False
+
+    def test_product_activated_while_building_is_skipped(self):
+        product = self.add_product()
+        late = self.add_product(name='Hat')
+        # The stock rows are read after the products, a product activated in between has no position
+        products = Product.objects.get_queryset()
+        with mock.patch.object(Product.objects, 'filter', lambda **kwargs: products.filter(**kwargs).exclude(pk=late.pk)):
+            index = FacetIndex()
+        self.assertNotIn(late.pk, index.positions)
+        self.assertEqual(index.bitsets['size'][self.size.pk], index.bits_for([product.pk]))
+
+    def test_old_index_is_served_while_rebuilding(self):
+        self.add_product()
+        index = get_facet_index()
+        self.add_product(name='Hat')
+        facets._index_built_at -= facets.FACET_REBUILD_INTERVAL
+
+        with mock.patch.object(facets._executor, 'submit') as submit:
+            self.assertIs(get_facet_index(), index)
+            self.assertIs(get_facet_index(), index)
+        submit.assert_called_once()
+        self.assertFalse(facets.facet_index_is_current(index))
+
+        with mock.patch.object(facets.connections, 'close_all') as close_all:
+            facets._rebuild(*submit.call_args.args[1:])
+        # The executor thread does not keep its connection open between rebuilds
+        close_all.assert_called_once()
+        rebuilt = get_facet_index()
+        self.assertEqual(len(rebuilt.positions), 2)
+        self.assertTrue(facets.facet_index_is_current(rebuilt))
+
+
+class DroppedStream(io.BytesIO):
+    """
+    Request body whose connection drops after the given number of bytes.
+    """
+    def __init__(self, data, drop_after):
+        super(DroppedStream, self).__init__(data)
+        self.drop_after = drop_after
+
+    def read(self, size=-1):
+        if self.tell() >= self.drop_after:
+            raise OSError('Connection reset')
+        return super(DroppedStream, self).read(min(size, self.drop_after - self.tell()))
+
+
+class ChunkedUploadTests(CatalogMixin, TestCase):
+    def setUp(self):
+        super(ChunkedUploadTests, self).setUp()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        settings = override_settings(MEDIA_ROOT=os.path.join(root, 'media'), CHUNKED_UPLOAD_ROOT=os.path.join(root, 'uploads'))
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        image = io.BytesIO()
+        Image.new('RGB', (64, 64), 'red').save(image, 'PNG')
+        self.image = image.getvalue()
+        self.upload = start_upload(self.seller, 'thumb.png', len(self.image))
+
+    def send(self, offset, data, length=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            return append_chunk(self.seller, self.upload.upload_id, offset, io.BytesIO(data), len(data) if length is None else length)
+
+    def test_parts_are_joined_into_storage(self):
+        half = len(self.image) // 2
+        self.assertEqual(self.send(0, self.image[:half]).received, half)
+        upload = self.send(half, self.image[half:])
+        self.assertTrue(upload.complete)
+        with default_storage.open(upload.stored_name) as stored:
+            self.assertEqual(stored.read(), self.image)
+        self.assertFalse(os.path.exists(part_dir(upload)))
+
+    def test_finished_upload_is_kept_until_it_expires(self):
+        upload = self.send(0, self.image)
+        self.assertEqual(sweep_media(grace=0, workers=1, pause=0).deleted, 0)
+        self.assertEqual(completed_upload(self.seller, upload.upload_id), upload.stored_name)
+
+        ChunkedUpload.objects.filter(pk=upload.pk).update(updated_at=timezone.now() - UPLOAD_EXPIRY)
+        self.assertIsNone(completed_upload(self.seller, upload.upload_id))
+        self.assertEqual(sweep_media(grace=0, workers=1, pause=0).deleted, 1)
+        self.assertFalse(default_storage.exists(upload.stored_name))
+
+    def test_duplicate_and_out_of_order_parts_are_refused(self):
+        half = len(self.image) // 2
+        self.send(0, self.image[:half])
+        for offset in (0, half + 1):
+            with self.assertRaises(UploadError) as raised:
+                self.send(offset, self.image[offset:])
+            self.assertEqual(raised.exception.status, 409)
+        self.assertTrue(self.send(half, self.image[half:]).complete)
+
+    def test_retry_arriving_first_wins(self):
+        half = len(self.image) // 2
+        first = self.image[:half]
+
+        class SlowStream(io.BytesIO):
+            # While this part is still being read, a retry of it is delivered in full
+            def read(inner, size=-1):
+                if inner.tell() == 0:
+                    append_chunk(self.seller, self.upload.upload_id, 0, io.BytesIO(first), half)
+                return super(SlowStream, inner).read(size)
+
+        with self.assertRaises(UploadError) as raised:
+            append_chunk(self.seller, self.upload.upload_id, 0, SlowStream(first), half)
+        self.assertEqual(raised.exception.status, 409)
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.received, half)
+        self.assertEqual(os.listdir(part_dir(self.upload)), ['%012d.part' % 0])
+
+    def test_dropped_connection_resumes_where_it_stopped(self):
+        upload = append_chunk(self.seller, self.upload.upload_id, 0, DroppedStream(self.image, 20), len(self.image))
+        self.assertEqual(upload.received, 20)
+        self.assertTrue(self.send(20, self.image[20:]).complete)
+
+    def test_file_that_is_not_an_image_is_discarded(self):
+        with self.assertRaises(UploadError) as raised:
+            self.send(0, b'#!/bin/sh' + b'x' * (len(self.image) - 9))
+        self.assertEqual(raised.exception.status, 415)
+        self.assertFalse(ChunkedUpload.objects.filter(pk=self.upload.pk).exists())
+        self.assertFalse(os.path.exists(part_dir(self.upload)))
+
+
+class MediaTestMixin(CatalogMixin):
+    """
+    An empty MEDIA_ROOT, with the image variants built in place instead of on their thread.
+    """
+    def setUp(self):
+        super(MediaTestMixin, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        settings = override_settings(MEDIA_ROOT=self.root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        patcher = mock.patch.object(images._executor, 'submit', lambda function, *args: function(*args))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+@override_settings(SHARED_CACHE=True)
+class ContentAddressMediaTests(MediaTestMixin, TestCase):
+    def test_moved_thumbs_purge_their_pages(self):
+        image = io.BytesIO()
+        Image.new('RGB', (8, 8), 'blue').save(image, 'PNG')
+        # Stored under its upload name, as before content addressing
+        FileSystemStorage().save('images/old.png', ContentFile(image.getvalue()))
+        product = self.add_product(thumb='images/old.png')
+        before = get_purge_times([product_tag(product.pk)])[product_tag(product.pk)]
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command('content_address_media')
+        product.refresh_from_db()
+        self.assertNotEqual(product.thumb.name, 'images/old.png')
+        self.assertTrue(default_storage.exists(product.thumb.name))
+        self.assertTrue(get_variant_widths(product.thumb.name))
+        self.assertGreater(get_purge_times([product_tag(product.pk)])[product_tag(product.pk)], before)
+
+        # The old name outlives the pages cached before the purge
+        self.assertTrue(default_storage.exists('images/old.png'))
+        self.assertEqual(sweep_media(workers=1, pause=0).deleted, 0)
+        sweep_media(grace=0, workers=1, pause=0)
+        self.assertFalse(default_storage.exists('images/old.png'))
+        self.assertTrue(default_storage.exists(product.thumb.name))
+
+    def test_moved_profile_picture_invalidates_the_user_snapshot(self):
+        image = io.BytesIO()
+        Image.new('RGB', (8, 8), 'green').save(image, 'PNG')
+        FileSystemStorage().save('images/face.png', ContentFile(image.getvalue()))
+        CustomUser.objects.filter(pk=self.seller.pk).update(profile_picture='images/face.png')
+        self.assertEqual(get_user_snapshot(self.seller.pk).profile_picture.name, 'images/face.png')
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command('content_address_media')
+        self.assertNotEqual(get_user_snapshot(self.seller.pk).profile_picture.name, 'images/face.png')
+
+    @override_settings(SHARED_CACHE=False)
+    def test_refuses_to_purge_a_private_cache(self):
+        with self.assertRaises(CommandError):
+            call_command('content_address_media')
+
+
+class WorkerCountTests(TestCase):
+    def test_gunicorn_workers_are_counted(self):
+        with mock.patch.dict(os.environ, {'GUNICORN_CMD_ARGS': '', 'WEB_CONCURRENCY': ''}):
+            for argv, expected in (
+                (['gunicorn', '-w', '4', 'ecommerce.wsgi'], 4),
+                (['/usr/bin/gunicorn', '--workers=3', '--worker-class', 'gthread'], 3),
+                (['gunicorn', '-w2'], 2),
+                (['manage.py', 'runserver', '-w', '4'], 1),
+            ):
+                with mock.patch.object(sys, 'argv', argv):
+                    self.assertEqual(worker_count(), expected)
+            os.environ['GUNICORN_CMD_ARGS'] = '--workers 5'
+            self.assertEqual(worker_count(), 5)
+
+
+class ImageVariantTests(MediaTestMixin, TestCase):
+    def store(self, width, height=300, mode='RGB'):
+        image = io.BytesIO()
+        # Half transparent in RGBA
+        Image.new(mode, (width, height), (255, 0, 0, 128)).save(image, 'PNG')
+        return default_storage.save('images/thumb.png', ContentFile(image.getvalue()))
+
+    def test_saved_thumb_gets_its_variants(self):
+        product = self.add_product(thumb=self.store(400, mode='RGBA'))
+        name = product.thumb.name
+        self.assertEqual(get_variant_widths(name), [80, 160, 320, 400])
+        for width in (80, 160, 320, 400):
+            for extension in ('webp', 'jpg'):
+                self.assertTrue(variant_storage.exists(variant_name(name, width, extension)))
+        with variant_storage.open(variant_name(name, 160, 'jpg')) as variant, Image.open(variant) as image:
+            self.assertEqual((image.format, image.mode, image.size), ('JPEG', 'RGB', (160, 120)))
+        with variant_storage.open(variant_name(name, 160, 'webp')) as variant, Image.open(variant) as image:
+            self.assertEqual((image.format, image.mode), ('WEBP', 'RGBA'))
+
+    def test_images_are_never_upscaled(self):
+        self.assertEqual(generate_variants(self.store(50, 50)), [50])
+        self.assertEqual(generate_variants(self.store(2000, 100)), [80, 160, 320, 640, 960])
+
+    def test_picture_falls_back_to_the_original_until_the_variants_exist(self):
+        name = self.store(400)
+        product = Product(thumb=name)
+        with mock.patch.object(images._executor, 'submit'):
+            self.assertEqual(get_variant_widths(name), [])
+            html = responsive_image(product.thumb, alt='Shirt')
+        self.assertEqual(html, '<img src="%s" alt="Shirt" loading="lazy">' % product.thumb.url)
+        self.assertEqual(image_variant_url(product.thumb, 100), product.thumb.url)
+
+        generate_variants(name)
+        html = responsive_image(product.thumb, sizes='50vw', loading='eager')
+        self.assertIn('<source type="image/webp" srcset="%s 80w, ' % variant_storage.url(variant_name(name, 80, 'webp')), html)
+        self.assertIn('%s 400w" sizes="50vw">' % variant_storage.url(variant_name(name, 400, 'webp')), html)
+        self.assertIn('<img src="%s"' % variant_storage.url(variant_name(name, 320, 'jpg')), html)
+        self.assertIn('loading="eager"', html)
+        self.assertEqual(image_variant_url(product.thumb, 100), variant_storage.url(variant_name(name, 160, 'jpg')))
+        self.assertEqual(image_variant_url(product.thumb, 1000), variant_storage.url(variant_name(name, 400, 'jpg')))
+
+
+class MediaDeliveryTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super(MediaDeliveryTests, self).setUp()
+        os.makedirs(os.path.join(self.root, 'images'))
+        with open(os.path.join(self.root, 'images', 'thumb.jpg'), 'wb') as thumb:
+            thumb.write(b'0123456789')
+
+    def get(self, path='images/thumb.jpg', **headers):
+        response = self.client.get(settings.MEDIA_URL + path, **headers)
+        self.addCleanup(response.close)
+        return response
+
+    def test_file_is_sent_whole_and_cached_for_good(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_byte_ranges(self):
+        response = self.get(HTTP_RANGE='bytes=2-5')
+        self.assertEqual((response.status_code, response['Content-Range'], response['Content-Length']), (206, 'bytes 2-5/10', '4'))
+        self.assertEqual(b''.join(response.streaming_content), b'2345')
+        self.assertEqual(b''.join(self.get(HTTP_RANGE='bytes=-3').streaming_content), b'789')
+        self.assertEqual(b''.join(self.get(HTTP_RANGE='bytes=8-').streaming_content), b'89')
+
+        response = self.get(HTTP_RANGE='bytes=20-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */10'))
+        # Several ranges, or a validator that no longer matches, get the whole file
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-1,4-5').status_code, 200)
+        self.assertEqual(self.get(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"stale"').status_code, 200)
+
+    def test_only_files_inside_media_root_are_served(self):
+        self.assertEqual(self.get('images/missing.jpg').status_code, 404)
+        self.assertEqual(self.get('images/').status_code, 404)
+        self.assertEqual(self.get('../settings.py').status_code, 404)
+        self.assertEqual(self.client.post(settings.MEDIA_URL + 'images/thumb.jpg').status_code, 405)
+
+    def test_front_server_sends_the_file(self):
+        with override_settings(MEDIA_ACCEL='x-accel-redirect', MEDIA_ACCEL_PREFIX='/protected-media/'):
+            response = self.get(HTTP_RANGE='bytes=2-5')
+        self.assertEqual((response.status_code, response['X-Accel-Redirect'], response.content), (200, '/protected-media/images/thumb.jpg', b''))
+        self.assertIn('immutable', response['Cache-Control'])
+        with override_settings(MEDIA_ACCEL='x-sendfile'):
+            response = self.get()
+        self.assertEqual(response['X-Sendfile'], os.path.join(self.root, 'images', 'thumb.jpg'))
+
+
+class CategoryPathTests(CatalogMixin, TestCase):
+    def create(self, name, parent=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Category.objects.create(name=name, category_parent=parent)
+
+    def test_subtree_and_ancestors_take_one_query(self):
+        clothes = self.create('Clothes')
+        shirts = self.create('Shirts', clothes)
+        polo = self.create('Polo', shirts)
+        self.create('Shoes')
+        with self.assertNumQueries(1):
+            self.assertEqual(set(clothes.get_descendants()), {clothes, shirts, polo})
+        with self.assertNumQueries(1):
+            self.assertEqual(list(polo.get_ancestors()), [clothes, shirts])
+        self.assertEqual(str(polo), 'Clothes / Shirts / Polo')
+
+    def test_moved_subtree_follows_with_its_counts(self):
+        clothes = self.create('Clothes')
+        sale = self.create('Sale')
+        shirts = self.create('Shirts', clothes)
+        polo = self.create('Polo', shirts)
+        self.add_product(category=polo)
+        self.assertEqual(Category.objects.get(pk=clothes.pk).product_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            shirts.category_parent = sale
+            shirts.save()
+        polo.refresh_from_db()
+        self.assertEqual(polo.path, '%d/%d/%d/' % (sale.pk, shirts.pk, polo.pk))
+        self.assertEqual(polo.full_path, 'Sale / Shirts / Polo')
+        self.assertEqual(list(Category.objects.filter(pk__in=[clothes.pk, sale.pk]).order_by('pk').values_list('product_count', flat=True)), [0, 1])
+
+
+class SearchTests(CatalogMixin, TestCase):
+    def search(self, query):
+        return [product.name for product in search_products(query).order_by('-search_rank', 'pk')]
+
+    def test_matches_rank_by_field(self):
+        self.add_product(name='Linen summer dress', short_desc='Light')
+        self.add_product(name='Blue jeans', short_desc='Goes with a summer dress')
+        self.add_product(name='Summer hat', active=False)
+        self.assertEqual(self.search('summer dress'), ['Linen summer dress', 'Blue jeans'])
+        # Every term has to match, longer ones as prefixes
+        self.assertEqual(self.search('summ jeans'), ['Blue jeans'])
+        self.assertEqual(self.search('dress xyz'), [])
+
+    def test_accents_and_case_are_folded(self):
+        self.add_product(name='GÖMLEK Café')
+        self.assertEqual(self.search('gomlek cafe'), ['GÖMLEK Café'])
+
+    def test_color_rename_reindexes_its_products(self):
+        self.add_product(name='Shirt')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.color.name = 'Crimson'
+            self.color.save()
+        self.assertEqual(self.search('crimson'), ['Shirt'])
+        self.assertEqual(self.search('red'), [])
+
+    def test_migration_backfills_the_same_tokens(self):
+        self.add_product(name='Linen summer dress', short_desc='Light', category=Category.objects.create(name='Dresses'))
+        self.add_product(name='Blue jeans')
+        expected = sorted(SearchToken.objects.values_list('product_id', 'token', 'weight'))
+        SearchToken.objects.all().delete()
+
+        migration = importlib.import_module('products.migrations.0034_backfill_search_tokens')
+        migration.build_search_tokens(apps, None)
+        self.assertEqual(sorted(SearchToken.objects.values_list('product_id', 'token', 'weight')), expected)
+        self.assertEqual(self.search('summer dress'), ['Linen summer dress'])
+
+
+class MediaSweepTests(MediaTestMixin, TestCase):
+    def store(self, color, name='images/thumb.png', age=2 * SWEEP_GRACE, storage=default_storage):
+        image = io.BytesIO()
+        Image.new('RGB', (8, 8), color).save(image, 'PNG')
+        name = storage.save(name, ContentFile(image.getvalue()))
+        then = time.time() - age
+        os.utime(default_storage.path(name), (then, then))
+        return name
+
+    def test_dry_run_only_reports(self):
+        kept = self.store('red')
+        self.add_product(thumb=kept)
+        orphan = self.store('blue')
+        recent = self.store('green', age=0)
+        variant = self.store('red', name=variant_dir(kept) + '80.webp', storage=variant_storage)
+        stale_variant = self.store('blue', name=variant_dir(orphan) + '80.webp', storage=variant_storage)
+
+        report = sweep_media(dry_run=True, workers=1)
+        self.assertEqual([media_file.name for media_file in report.orphans], sorted([orphan, stale_variant]))
+        self.assertEqual(report.deleted, 0)
+        for name in (kept, orphan, recent, variant, stale_variant):
+            self.assertTrue(default_storage.exists(name))
+
+        report = sweep_media(workers=1, pause=0)
+        self.assertEqual(report.deleted, 2)
+        self.assertFalse(default_storage.exists(orphan))
+        self.assertFalse(default_storage.exists(stale_variant))
+        for name in (kept, recent, variant):
+            self.assertTrue(default_storage.exists(name))
+
+    def test_scan_lists_every_file_below_the_buckets(self):
+        names = {self.store(color) for color in ('red', 'green', 'blue')}
+        names.add(self.store('red', name=variant_dir(min(names)) + '80.webp', storage=variant_storage))
+        with mock.patch.object(sweeper, '_list_directory', wraps=sweeper._list_directory) as list_directory:
+            scanned = scan_media(workers=4)
+        self.assertEqual(sorted(media_file.name for media_file in scanned), sorted(names))
+        # Every bucket is a separate work item
+        listed = {os.path.relpath(call.args[1], settings.MEDIA_ROOT).replace(os.sep, '/') for call in list_directory.call_args_list}
+        self.assertTrue({os.path.dirname(name) for name in names} <= listed)
+
+    def test_replaced_thumb_is_deleted_after_commit(self):
+        old = self.store('red')
+        product = self.add_product(thumb=old)
+        # The deletion runs on the sweeper's thread, here it runs in place
+        with mock.patch.object(sweeper._executor, 'submit', lambda function, *args: function(*args)):
+            with mock.patch.object(sweeper.connections, 'close_all') as close_all:
+                with self.captureOnCommitCallbacks(execute=True):
+                    product.thumb = self.store('blue')
+                    product.save()
+        close_all.assert_called_once()
+        self.assertFalse(default_storage.exists(old))
+        self.assertFalse(StoredFile.objects.filter(name=old).exists())
+        self.assertTrue(default_storage.exists(product.thumb.name))
+
+    def test_released_file_stored_again_is_kept(self):
+        old = self.store('red')
+        product = self.add_product(thumb=old)
+        with mock.patch.object(sweeper._executor, 'submit', lambda function, *args: function(*args)):
+            with self.captureOnCommitCallbacks(execute=True):
+                product.thumb = self.store('blue')
+                product.save()
+                # Another upload of the same image, its reference not committed yet
+                self.assertEqual(self.store('red', age=0), old)
+        self.assertTrue(default_storage.exists(old))
+        StoredFile.retain(old)
+        self.assertEqual(StoredFile.objects.get(name=old).ref_count, 1)
@@ -0,0 +1,260 @@
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image
+
+from .models import ChunkedUpload, Product
+
+
+# Largest image accepted, checked against the declared size before any byte arrives
+UPLOAD_MAX_SIZE = 20 * 1024 * 1024
+# Part size clients are told to send, and the most one request may carry
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_MAX_CHUNK = 8 * 1024 * 1024
+# Request bodies are copied to the part file this many bytes at a time
+UPLOAD_READ_SIZE = 64 * 1024
+# Decoded size limit, guards against small files that expand to huge bitmaps
+UPLOAD_MAX_PIXELS = 40 * 1000 * 1000
+# Unfinished uploads can be resumed this long after their last part
+UPLOAD_EXPIRY = timedelta(hours=24)
+
+UPLOAD_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+UPLOAD_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP')
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400, discard=False):
+        super(UploadError, self).__init__(message)
+        self.status = status
+        # The upload can never succeed, it is dropped along with what was received
+        self.discard = discard
+
+
+def _sniff(head):
+    # Magic numbers of the accepted formats, so a renamed file is refused on its first part
+    return (
+        head.startswith(b'\xff\xd8\xff')
+        or head.startswith(b'\x89PNG\r\n\x1a\n')
+        or head[:6] in (b'GIF87a', b'GIF89a')
+        or (head[:4] == b'RIFF' and head[8:12] == b'WEBP')
+    )
+
+
+def part_dir(upload):
+    return os.path.join(settings.CHUNKED_UPLOAD_ROOT, upload.upload_id.hex)
+
+
+def part_path(upload, offset):
+    # Zero padded, so the parts sort in the order they are assembled in
+    return os.path.join(part_dir(upload), '%012d.part' % offset)
+
+
+def upload_state(upload):
+    state = {
+        'id': str(upload.upload_id),
+        'offset': upload.received,
+        'size': upload.size,
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+        'complete': upload.complete,
+    }
+    if upload.complete:
+        state['url'] = default_storage.url(upload.stored_name)
+    return state
+
+
+def start_upload(user, filename, size):
+    """
+    Registers an upload after checking its name and declared size, nothing is stored yet.
+    """
+    filename = os.path.basename(str(filename or ''))[:200]
+    if os.path.splitext(filename)[1].lower() not in UPLOAD_EXTENSIONS:
+        raise UploadError("Only JPEG, PNG, GIF and WebP images can be uploaded", 415)
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError("Missing upload size")
+    if size <= 0:
+        raise UploadError("The file is empty")
+    if size > UPLOAD_MAX_SIZE:
+        raise UploadError("Images are limited to %d MB" % (UPLOAD_MAX_SIZE // (1024 * 1024)), 413)
+    return ChunkedUpload.objects.create(user=user, filename=filename, size=size)
+
+
+def get_upload(user, upload_id):
+    try:
+        return ChunkedUpload.objects.get(upload_id=upload_id, user=user, updated_at__gte=timezone.now() - UPLOAD_EXPIRY)
+    except (ChunkedUpload.DoesNotExist, ValueError):
+        return None
+
+
+def _remove_parts(directory):
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def append_chunk(user, upload_id, offset, stream, length):
+    """
+    Writes the part starting at offset straight from the request stream to a file of its own,
+    a read buffer at a time. A part cut short by a dropped connection keeps the bytes that
+    arrived, the client resumes from the offset returned. The last part finishes the upload.
+    """
+    try:
+        return _append_chunk(user, upload_id, offset, stream, length)
+    except UploadError as e:
+        if e.discard:
+            for upload in ChunkedUpload.objects.filter(upload_id=upload_id, user=user):
+                _remove_parts(part_dir(upload))
+                upload.delete()
+        raise
+
+
+def _locked_upload(user, upload_id):
+    upload = ChunkedUpload.objects.select_for_update().filter(upload_id=upload_id, user=user).first()
+    if upload is None or upload.updated_at < timezone.now() - UPLOAD_EXPIRY:
+        raise UploadError("Unknown or expired upload", 404)
+    return upload
+
+
+def _append_chunk(user, upload_id, offset, stream, length):
+    # The row lock is only held to check the offset and to move it on, never while the part is read
+    with transaction.atomic():
+        upload = _locked_upload(user, upload_id)
+        if upload.complete:
+            return upload
+        if upload.received and not os.path.isdir(part_dir(upload)):
+            # The parts went missing, start over
+            upload.received = 0
+            upload.save(update_fields=['received', 'updated_at'])
+        if offset == upload.received == upload.size:
+            # Every part arrived before, only finishing failed
+            finish_upload(upload)
+            return upload
+    if offset != upload.received:
+        raise UploadError("Expected the part at offset %d" % upload.received, 409)
+    if length is None or length <= 0:
+        raise UploadError("Missing part length", 411)
+    if length > UPLOAD_MAX_CHUNK or offset + length > upload.size:
+        raise UploadError("Part too large", 413)
+
+    path, written = _receive_part(upload, offset, stream, length)
+    try:
+        with transaction.atomic():
+            upload = _locked_upload(user, upload_id)
+            if upload.complete:
+                return upload
+            if offset != upload.received:
+                # A retry of the same part got in first
+                raise UploadError("Expected the part at offset %d" % upload.received, 409)
+            if written:
+                os.replace(path, part_path(upload, offset))
+                upload.received += written
+                upload.save(update_fields=['received', 'updated_at'])
+            if upload.received == upload.size:
+                finish_upload(upload)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return upload
+
+
+def _receive_part(upload, offset, stream, length):
+    """
+    Copies the part from the request stream to a temporary file beside the parts.
+    Returns the file's path and the number of bytes that arrived.
+    """
+    directory = part_dir(upload)
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, prefix='.incoming-')
+    written = 0
+    try:
+        with os.fdopen(fd, 'wb') as part:
+            while written < length:
+                try:
+                    data = stream.read(min(UPLOAD_READ_SIZE, length - written))
+                except OSError:
+                    # The client went away, what arrived so far is kept
+                    break
+                if not data:
+                    break
+                if offset == 0 and written == 0 and not _sniff(data[:12]):
+                    raise UploadError("Only JPEG, PNG, GIF and WebP images can be uploaded", 415, discard=True)
+                part.write(data)
+                written += len(data)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, written
+
+
+def _assemble(upload):
+    directory = part_dir(upload)
+    path = os.path.join(directory, 'assembled')
+    with open(path, 'wb') as assembled:
+        for name in sorted(name for name in os.listdir(directory) if name.endswith('.part')):
+            with open(os.path.join(directory, name), 'rb') as part:
+                shutil.copyfileobj(part, assembled)
+    return path
+
+
+def finish_upload(upload):
+    """
+    Joins the parts, checks the image without decoding it and moves it into storage under its content name.
+    """
+    try:
+        path = _assemble(upload)
+        with Image.open(path) as image:
+            image_format = image.format
+            pixels = image.width * image.height
+            image.verify()
+    except Exception:
+        raise UploadError("The file is not a readable image", 415, discard=True)
+    if image_format not in UPLOAD_FORMATS:
+        raise UploadError("Only JPEG, PNG, GIF and WebP images can be uploaded", 415, discard=True)
+    if pixels > UPLOAD_MAX_PIXELS:
+        raise UploadError("The image dimensions are too large", 413, discard=True)
+
+    with open(path, 'rb') as assembled:
+        name = Product._meta.get_field('thumb').generate_filename(None, upload.filename)
+        upload.stored_name = default_storage.save(name, File(assembled))
+    upload.save(update_fields=['stored_name', 'updated_at'])
+    # Kept should the transaction roll back, the client then finishes the upload again
+    transaction.on_commit(partial(_remove_parts, part_dir(upload)))
+
+
+def completed_upload(user, upload_id):
+    """
+    Returns the storage name of a finished upload of the user, None for anything else.
+    """
+    upload = get_upload(user, upload_id) if upload_id else None
+    if upload is None or not upload.complete or not default_storage.exists(upload.stored_name):
+        return None
+    return upload.stored_name
+
+
+def held_upload_names(names=None):
+    """
+    Returns the storage names of finished uploads that can still be attached, limited to names
+    when given. The media sweep and deferred deletions leave these files alone.
+    """
+    uploads = ChunkedUpload.objects.exclude(stored_name='').filter(updated_at__gte=timezone.now() - UPLOAD_EXPIRY)
+    if names is not None:
+        uploads = uploads.filter(stored_name__in=names)
+    return set(uploads.values_list('stored_name', flat=True))
+
+
+def clear_expired_uploads():
+    """
+    Deletes the uploads untouched for longer than UPLOAD_EXPIRY with their part files.
+    Returns the number of uploads deleted.
+    """
+    expired = list(ChunkedUpload.objects.filter(updated_at__lt=timezone.now() - UPLOAD_EXPIRY))
+    for upload in expired:
+        _remove_parts(part_dir(upload))
+    return ChunkedUpload.objects.filter(pk__in=[upload.pk for upload in expired]).delete()[0]
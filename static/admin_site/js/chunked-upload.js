@@ -0,0 +1,132 @@
+// Chunked, resumable thumb upload for the product form.
+// The dropzone only provides the drop area, previews and progress: each file is sent as raw
+// parts to the upload endpoints, and an interrupted upload continues where the server left off.
+Dropzone.autoDiscover = false;
+
+document.addEventListener('DOMContentLoaded', function () {
+  var element = document.getElementById('thumb-dropzone');
+  if (!element) {
+    return;
+  }
+  var field = document.getElementById('thumb-upload');
+  var startUrl = element.getAttribute('data-start-url');
+  var maxSize = parseInt(element.getAttribute('data-max-size'), 10);
+  var retryLimit = 5;
+
+  function send(method, url, body, headers, onProgress) {
+    return new Promise(function (resolve, reject) {
+      var xhr = new XMLHttpRequest();
+      xhr.open(method, url, true);
+      xhr.setRequestHeader('Accept', 'application/json');
+      xhr.setRequestHeader('X-CSRFToken', getCookie('csrftoken'));
+      for (var name in headers || {}) {
+        xhr.setRequestHeader(name, headers[name]);
+      }
+      if (onProgress && xhr.upload) {
+        xhr.upload.onprogress = function (e) { onProgress(e.loaded); };
+      }
+      xhr.onload = function () {
+        var data = {};
+        try {
+          data = JSON.parse(xhr.responseText);
+        } catch (e) {
+          data = {error: 'Unexpected response from the server'};
+        }
+        resolve({status: xhr.status, data: data});
+      };
+      xhr.onerror = function () { reject(new Error('Network error')); };
+      xhr.send(body);
+    });
+  }
+
+  function storageKey(file) {
+    return 'thumb-upload:' + file.name + ':' + file.size + ':' + file.lastModified;
+  }
+
+  // The upload this file was already being sent as, or a new one
+  function begin(file) {
+    var uploadId = window.localStorage.getItem(storageKey(file));
+    var resumed = uploadId
+      ? send('GET', startUrl + uploadId + '/').then(function (r) { return r.status === 200 ? r.data : null; })
+      : Promise.resolve(null);
+    return resumed.then(function (state) {
+      if (state) {
+        return state;
+      }
+      return send('POST', startUrl, JSON.stringify({filename: file.name, size: file.size}), {'Content-Type': 'application/json'})
+        .then(function (r) {
+          if (r.status !== 201) {
+            throw new Error(r.data.error);
+          }
+          window.localStorage.setItem(storageKey(file), r.data.id);
+          return r.data;
+        });
+    });
+  }
+
+  function sendParts(dropzone, file, state, failures) {
+    if (state.complete) {
+      return Promise.resolve(state);
+    }
+    var end = Math.min(state.offset + state.chunk_size, file.size);
+    var headers = {'Content-Type': 'application/octet-stream', 'Upload-Offset': state.offset};
+    var onProgress = function (loaded) {
+      var sent = state.offset + loaded;
+      dropzone.emit('uploadprogress', file, 100 * sent / file.size, sent);
+    };
+    return send('POST', startUrl + state.id + '/chunk/', file.slice(state.offset, end), headers, onProgress)
+      .then(function (r) {
+        if (r.status === 200 || r.status === 409) {
+          // A 409 carries the offset the server expects, continue from there
+          return sendParts(dropzone, file, r.data, 0);
+        }
+        throw new Error(r.data.error || 'Upload failed');
+      }, function (error) {
+        if (failures >= retryLimit) {
+          throw error;
+        }
+        // Wait longer after every failure, then ask the server how far it got
+        return new Promise(function (resolve) { setTimeout(resolve, 1000 * Math.pow(2, failures)); })
+          .then(function () { return send('GET', startUrl + state.id + '/'); })
+          .then(function (r) {
+            if (r.status !== 200) {
+              throw new Error(r.data.error);
+            }
+            return sendParts(dropzone, file, r.data, failures + 1);
+          }, function () { return sendParts(dropzone, file, state, failures + 1); });
+      });
+  }
+
+  var dropzone = new Dropzone(element, {
+    url: startUrl,
+    maxFiles: 1,
+    maxFilesize: maxSize / (1024 * 1024),
+    acceptedFiles: 'image/jpeg,image/png,image/gif,image/webp',
+    addRemoveLinks: true,
+    dictDefaultMessage: 'Drop the thumb here or click to choose it',
+  });
+
+  dropzone.uploadFiles = function (files) {
+    var self = this;
+    files.forEach(function (file) {
+      begin(file)
+        .then(function (state) { return sendParts(self, file, state, 0); })
+        .then(function (state) {
+          window.localStorage.removeItem(storageKey(file));
+          field.value = state.id;
+          self._finished([file], JSON.stringify(state), null);
+        })
+        .catch(function (error) {
+          self._errorProcessing([file], error.message || 'Upload failed', null);
+        });
+    });
+  };
+
+  dropzone.on('maxfilesexceeded', function (file) {
+    this.removeAllFiles();
+    this.addFile(file);
+  });
+  dropzone.on('removedfile', function () {
+    field.value = '';
+  });
+});
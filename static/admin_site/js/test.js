@@ -50,9 +50,30 @@ document.addEventListener('DOMContentLoaded', function () {
   });
 });
 
-function extendItems(id) {
+function extendItems(id, cell) {
   rows = document.getElementsByName('content-'+id);
 
+  // Variant rows are fetched the first time their product row is expanded
+  if (rows.length == 0 && cell && cell.dataset.variantsUrl) {
+    if (cell.dataset.loading) {
+      return;
+    }
+    cell.dataset.loading = 'true';
+    fetch(cell.dataset.variantsUrl)
+      .then(response => response.text())
+      .then(html => {
+        cell.parentElement.insertAdjacentHTML('afterend', html);
+        delete cell.dataset.variantsUrl;
+        delete cell.dataset.loading;
+        extendItems(id);
+      })
+      .catch(error => {
+        delete cell.dataset.loading;
+        console.error('Error:', error);
+      });
+    return;
+  }
+
   for (var i = 0; i < rows.length; i++) {
     rows[i].classList.toggle('show')
   }
@@ -1,3 +1,33 @@
 from django.test import TestCase
+from django.urls import reverse
 
-# Create your tests here.
+from accounts.models import CustomUser
+from products.models import Code, Product
+from products.tests import CatalogMixin
+
+
+class AllProductVariantsTests(CatalogMixin, TestCase):
+    def setUp(self):
+        super(AllProductVariantsTests, self).setUp()
+        self.code = Code.objects.create(name='SHIRT')
+        self.admin = CustomUser.objects.create_user('admin@example.com', 'secret', first_name='g', last_name='h', user_type='admin')
+
+    def get(self, pk):
+        return self.client.get(reverse('all-product-variants', args=[pk]))
+
+    def test_variants_of_every_seller_are_listed(self):
+        self.add_product(name='Red shirt', code=self.code)
+        other = self.add_product(name='Blue shirt', code=self.code)
+        Product.objects.filter(pk=other.pk).update(seller=CustomUser.objects.create_user('other@example.com', 'secret', first_name='c', last_name='d', user_type='seller'))
+        self.add_product(name='Hat')
+
+        self.client.force_login(self.admin)
+        response = self.get(self.code.pk)
+        self.assertContains(response, 'Red shirt')
+        self.assertContains(response, 'Blue shirt')
+        self.assertNotContains(response, 'Hat')
+        self.assertEqual(self.get(self.code.pk + 10).status_code, 404)
+
+    def test_sellers_are_redirected(self):
+        self.client.force_login(self.seller)
+        self.assertRedirects(self.get(self.code.pk), reverse('superuser-login'), fetch_redirect_response=False)
@@ -34,6 +34,7 @@ urlpatterns = [
 
     # All Products URLs
     path('all-products/', views.allProducts, name="all-products"),
+    path('all-product-variants/<str:pk>/', views.allProductVariants, name="all-product-variants"),
     path('edit-all-product/<str:pk>/', views.editAllProduct, name="edit-all-product"),
     path('delete-all-product/<str:pk>/', views.deleteAllProduct, name="delete-all-product"),
     path('delete-all-products-code/<str:pk>/', views.deleteAllProductsCode, name="delete-all-products-code"),
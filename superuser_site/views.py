@@ -1,4 +1,3 @@
-from django.core.paginator import Paginator
 from django.shortcuts import get_object_or_404, render, redirect
 from django.urls import reverse
 from django.contrib import messages
@@ -10,9 +9,12 @@ from accounts.decorators import superuser_required
 from django.http import JsonResponse
 from django.utils.translation import gettext_lazy as _
 import json
+from products.caching import PRODUCTS_TAG
 from products.forms import CategoryForm, ColorForm, ProductForm, SizeForm, StockForm
 from django.db.models import Count
 from products.models import Category, Code, Color, Product, Size, Stock
+from products.pagination import CachedCountPaginator
+from products.reference import get_reference_data
 from django.core import serializers
 
 
@@ -361,47 +363,27 @@ def updateCategoryActivation(request, pk):
 @superuser_required(redirect_url='superuser-login')
 def allProducts(request):
     page = "allProducts"
-    stocks = Stock.objects.all()
+    stocks = Stock.objects.select_related('product__seller', 'product__discount', 'color', 'size', 'code__summary')
 
-    codes = Code.objects.all()
-
-    total_quantities = {}
-    prices = {}
-    all_active = {}
-
-    # Calculate data by the code of the product
-    for code in codes:
-        # Calculate total quantity for each product by its code value
-        total_quantity = Stock.calculate_total_quantity(code_value=code)
-        total_quantities[code] = total_quantity
-
-        # Calculate min and max price for each product by its code value
-        min_price, max_price = Stock.get_price_range(code_value=code)
-        prices[code] = {'min_price': min_price, 'max_price': max_price}
-
-        # Check if all is active for each product by its code value
-        is_active = Stock.check_all_active(code_value=code)
-        all_active[code] = is_active
-
-
-    
-
-    # Filtering the products objects by the code value with no repeat
-    unique_values = set()
-    filtered_stocks = []
-    for obj in stocks:
-
-        if obj.code not in unique_values:
-            filtered_stocks.append(obj)
-            unique_values.add(obj.code)
-
-    paginator = Paginator(filtered_stocks, 5)
+    # One row per code, grouped and paginated by the database
+    # Every code has at least one stock, so the code table statistics estimate the row count
+    paginator = CachedCountPaginator(stocks.representatives(), 5, count_tags=[PRODUCTS_TAG], estimate_model=Code)
     page_number = request.GET.get('page')
     page_obj = paginator.get_page(page_number)
 
-    context = {'page': page, 'filtered_stocks': filtered_stocks, 'stocks': stocks, 'total_quantities': total_quantities, 'prices': prices, 'all_active': all_active, 'page_obj': page_obj}
+    context = {'page': page, 'page_obj': page_obj}
     return render(request, 'superuser_site/all_products.html', context)
 
+# Variants of a product code, loaded when its row is expanded
+@login_required(login_url='superuser-login')
+@superuser_required(redirect_url='superuser-login')
+def allProductVariants(request, pk):
+    code = get_object_or_404(Code, id=pk)
+    stocks = Stock.objects.filter(code=code).select_related('product__seller', 'product__discount', 'code', 'color', 'size')
+
+    context = {'code': code, 'stocks': stocks}
+    return render(request, 'superuser_site/product_variants.html', context)
+
 # Edit all products
 @login_required(login_url='superuser-login')
 @superuser_required(redirect_url='superuser-login')
@@ -412,8 +394,9 @@ def editAllProduct(request, pk):
     seller = CustomUser.objects.get(product=product)
     form = ProductForm(instance=product)
     stockForm = StockForm(instance=stock)
-    sizes = Size.objects.all()
-    colors = Color.objects.all()
+    reference = get_reference_data()
+    sizes = reference.sizes
+    colors = reference.colors
 
     if request.method == 'POST':
         form = ProductForm(request.POST, request.FILES, instance=product)
@@ -426,8 +409,8 @@ def editAllProduct(request, pk):
 
             stock = stockForm.save(commit=False)
             stock.product = product
-            stock.size = Size.objects.get(id=request.POST.get('size'))
-            stock.color = Color.objects.get(id=request.POST.get('color'))
+            stock.size = reference.size(request.POST.get('size'))
+            stock.color = reference.color(request.POST.get('color'))
             stock.save()
             messages.success(request, 'Product Updated Successfully!')
 
@@ -607,45 +590,14 @@ def sellerProducts(request, pk):
     seller = CustomUser.objects.get(id=pk)
     page = "products"
     products = Product.objects.filter(seller=seller)
-    stocks = Stock.objects.filter(product__seller=seller)
-
-    codes = Code.objects.all()
-
-    total_quantities = {}
-    prices = {}
-    all_active = {}
-
-    # Calculate data by the code of the product
-    for code in codes:
-        # Calculate total quantity for each product by its code value
-        total_quantity = Stock.calculate_total_quantity(code_value=code)
-        total_quantities[code] = total_quantity
-
-        # Calculate min and max price for each product by its code value
-        min_price, max_price = Stock.get_price_range(code_value=code)
-        prices[code] = {'min_price': min_price, 'max_price': max_price}
-
-        # Check if all is active for each product by its code value
-        is_active = Stock.check_all_active(code_value=code)
-        all_active[code] = is_active
+    stocks = Stock.objects.filter(product__seller=seller).select_related('product__seller', 'product__discount', 'color', 'size', 'code__summary')
 
-
-    
-
-    # Filtering the products objects by the code value with no repeat
-    unique_values = set()
-    filtered_stocks = []
-    for obj in stocks:
-
-        if obj.code not in unique_values:
-            filtered_stocks.append(obj)
-            unique_values.add(obj.code)
-
-    paginator = Paginator(filtered_stocks, 5)
+    # One row per code, grouped and paginated by the database
+    paginator = CachedCountPaginator(stocks.representatives(), 5, count_tags=[PRODUCTS_TAG])
     page_number = request.GET.get('page')
     page_obj = paginator.get_page(page_number)
 
-    context = {'products': products, 'page': page, 'seller': seller, 'filtered_stocks': filtered_stocks, 'stocks': stocks, 'total_quantities': total_quantities, 'prices': prices, 'all_active': all_active, 'page_obj': page_obj}
+    context = {'products': products, 'page': page, 'seller': seller, 'page_obj': page_obj}
     return render(request, 'superuser_site/all_products.html', context)
 
 
@@ -659,8 +611,9 @@ def editSellerProduct(request, pk):
     seller = CustomUser.objects.get(product=product)
     form = ProductForm(instance=product)
     stockForm = StockForm(instance=stock)
-    sizes = Size.objects.all()
-    colors = Color.objects.all()
+    reference = get_reference_data()
+    sizes = reference.sizes
+    colors = reference.colors
 
     if request.method == 'POST':
         form = ProductForm(request.POST, request.FILES, instance=product)
@@ -673,8 +626,8 @@ def editSellerProduct(request, pk):
 
             stock = stockForm.save(commit=False)
             stock.product = product
-            stock.size = Size.objects.get(id=request.POST.get('size'))
-            stock.color = Color.objects.get(id=request.POST.get('color'))
+            stock.size = reference.size(request.POST.get('size'))
+            stock.color = reference.color(request.POST.get('color'))
             stock.save()
             messages.success(request, 'Product Updated Successfully!')
 